@@ -48,6 +48,11 @@ cal_window = {'bias': 3, 'dark': 3, 'flat': 7}
 # maximum number of individual bias/dark/flat frames to combine
 ncal_max = {'bias': 20, 'dark': 20, 'flat': 15}
 
+# maximum memory [GB] used to combine the individual frames into a
+# master; frames are combined in strips of rows that fit within this
+# limit
+stack_mem_max = 2
+
 # degree polynomial fit to vertical overscan clipped means
 voscan_poldeg = 3
 
@@ -58,6 +63,10 @@ voscan_poldeg = 3
 # switch to keep tmp directories (True) or not (False)
 keep_tmp = False
 
+# minimum free space [GB] on the disk with the tmp folders; in night
+# mode, new images are only processed one at a time while the free
+# space is less than this
+tmp_free_min = 20
 
 # switch to save thumbnails in transient catalog
 save_thumbnails = {'ML1': False, 'BG': False}
@@ -88,6 +97,10 @@ else:
 # path for a given telescope
 raw_dir={}; red_dir={}; ref_dir={}; tmp_dir={}
 master_dir = {}; hdrtables_dir = {}; thumbnails_dir={}
+# local folder with indices of raw and reduced files, such as the
+# header index of each night folder, which are used to avoid reading
+# the same headers again
+index_dir = {}
 
 
 # ML/BG processing environment: 'test', 'staging', 'production'
@@ -119,6 +132,8 @@ for tel in ['ML1']:
                                                       proc_env_subdir, tel)
     master_dir[tel] = '{}{}/masters/{}'.format(run_dir_base[tel],
                                                proc_env_subdir, tel)
+    index_dir[tel] = '{}{}/index/{}'.format(run_dir_base[tel],
+                                            proc_env_subdir, tel)
 
 
 
@@ -143,6 +158,8 @@ for tel in ['BG2', 'BG3', 'BG4', 'BG']:
     ref_dir[tel] = '{}blackgem-ref'.format(proc_env_base)
     hdrtables_dir[tel] = '{}blackgem-hdrtables/{}'.format(proc_env_base, tel)
     thumbnails_dir[tel] = '{}blackgem-thumbnails/{}'.format(proc_env_base, tel)
+    # the index folder is on the local disk
+    index_dir[tel] = '{}/RunBlackBOX/index/{}'.format(run_dir_base['BG'], tel)
 
 
     if proc_env == 'test':
@@ -165,6 +182,37 @@ trans_extract_exts = ['_D.fits', '_Scorr.fits', '_Fpsf.fits',
 ref_2keep = img_reduce_exts + cat_extract_exts
 all_2keep = ref_2keep + trans_extract_exts
 
+# maximum memory [GB] used by each process to cache master
+# bias/dark/flat frames, so that a master does not need to be read
+# and decompressed again for every image; 0 switches off the cache
+master_cache_mem = 3
+
+# node-local folder where decompressed master frames are saved as
+# numpy files, which are memory-mapped such that all processes on the
+# same node share a single copy of each master; None switches this off
+master_cache_dir = {'ML1': '{}/master_cache'.format(tmp_dir['ML1']),
+                    'BG': '{}/master_cache'.format(tmp_dir_base['BG'])}
+
+# node-local folder where decompressed reference images and their
+# accompanying files are cached, such that the same reference is
+# copied and decompressed only once on each node and hard linked into
+# the tmp folder of each image; None switches this off
+ref_cache_dir = {'ML1': '{}/ref_cache'.format(tmp_dir['ML1']),
+                 'BG': '{}/ref_cache'.format(tmp_dir_base['BG'])}
+
+# maximum size [GB] of the node-local reference cache; the least
+# recently used references are removed when it is exceeded
+ref_cache_size = 50
+
+# maximum number of bad pixel masks (one per filter) cached by each
+# process; 0 switches off the cache
+bpm_cache_size = 2
+
+# maximum number of fits headers cached by each process, so that the
+# header of the same raw, reference or catalog file is not parsed
+# again during the same run; 0 switches off the cache
+header_cache_size = 256
+
 #===============================================================================
 # Calibration files
 #===============================================================================
@@ -7,6 +7,14 @@ import sys
 import calendar
 import warnings
 import socket
+import collections
+import fcntl
+import heapq
+import sqlite3
+import gzip
+import io
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
 
 #import multiprocessing as mp
 #mp_ctx = mp.get_context('spawn')
@@ -63,6 +71,7 @@ from watchdog.events import FileSystemEventHandler
 
 from qc import qc_check, run_qc_check
 import platform
+from google.cloud import storage
 
 from ASTA import ASTA
 
@@ -76,7 +85,7 @@ from matplotlib.colors import Normalize
 
 
 import fitsio
-from PIL import Image
+from PIL import Image, ImageDraw
 
 
 # due to regular problems with downloading default IERS file (needed
@@ -264,6 +273,11 @@ def run_blackbox (telescope=None, mode=None, date=None, read_path=None,
     mem_use (label='in run_blackbox at start')
 
 
+    # remove tmp folders left behind in the trash folder by a
+    # previous run, in the background
+    tmp_submit (sweep_trash, tel)
+
+
     # create master bias, dark and/or flat if [master_date] is specified
     if master_date is not None:
         create_masters (master_date, nproc=nproc)
@@ -382,6 +396,10 @@ def run_blackbox (telescope=None, mode=None, date=None, read_path=None,
         log.info ('{} filenames reduced: {}'.format(len(filenames_reduced),
                                                     filenames_reduced))
 
+        # remove tmp folders left in the trash folder by the workers
+        tmp_wait ()
+        sweep_trash (tel=tel)
+
         #snapshot2 = tracemalloc.take_snapshot()
         #top_stats = snapshot2.compare_to(snapshot1, 'lineno')
         #print("[ Top 10 differences ]")
@@ -429,7 +447,6 @@ def run_blackbox (telescope=None, mode=None, date=None, read_path=None,
 
 
         # create pool of workers
-        results = []
         # use function from zogy to use same mp start method
         pool = get_mp_Pool(nproc)
 
@@ -439,18 +456,14 @@ def run_blackbox (telescope=None, mode=None, date=None, read_path=None,
 
 
         # keep monitoring queue - which is being filled with new files
-        # detected by watchdog - as long as it is nighttime or the
-        # queue is not empty yet
-        while ephem.now()-sunrise < ephem.hour or not queue.empty():
-
-            if queue.empty():
-                time.sleep(60)
-            else:
-                filename = get_file (queue)
-                if filename is not None:
-                    # process it by one of the workers
-                    results.append(pool.apply_async(try_blackbox_reduce,
-                                                    [filename]))
+        # detected by watchdog - as long as it is nighttime or there
+        # are files waiting to be processed; new files are checked
+        # for completeness by a pool of threads, so that a file that
+        # is still arriving does not hold up other files, and files
+        # that can be read are processed by the pool of workers in
+        # order of priority: calibration frames first, so that the
+        # master frames needed by the science frames are available
+        night_queue (queue, pool, sunrise, nproc)
 
 
         log.info ('night has finished and queue is empty')
@@ -466,6 +479,11 @@ def run_blackbox (telescope=None, mode=None, date=None, read_path=None,
         pool.join()
 
 
+        # remove tmp folders left in the trash folder by the workers
+        tmp_wait ()
+        sweep_trash (tel=tel)
+
+
         # create and email obslog
         log.info ('night processing has finished; creating and emailing obslog')
         try:
@@ -483,6 +501,160 @@ def run_blackbox (telescope=None, mode=None, date=None, read_path=None,
     return
 
 
+################################################################################
+
+def night_queue (queue, pool, sunrise, nproc):
+
+    """Process the files entering [queue] with the multiprocessing
+       [pool] of [nproc] workers until one hour after [sunrise] and
+       all files have been processed. Files are first checked for
+       completeness in separate threads by function [check_file],
+       for up to [wait_max] seconds after detection. Files that are
+       complete are sorted by image type (bias, dark, flat, object)
+       and time of detection, and submitted to the pool when a worker
+       is available, so that a calibration frame that arrives later
+       is processed before science frames that are still waiting.
+       If the free space on the tmp disk is less than
+       set_bb.tmp_free_min GB, files are only submitted when no
+       other files are being processed, and the trash folder with
+       the tmp folders of finished images is emptied.
+
+    """
+
+    # maximum time to wait for a file to arrive completely, and the
+    # time interval between completeness checks
+    wait_max = 180
+    wait_check = 5
+
+    # processing priority of the different image types
+    priority = {'bias': 0, 'dark': 1, 'flat': 2}
+
+    # files that have been detected
+    detected = set()
+    # files that are not yet complete: filename: [time detected,
+    # time of next check]
+    pending = {}
+    # completeness checks that are running: future: filename
+    checks = {}
+    # heap of files ready to be processed: (priority, time detected,
+    # filename)
+    ready = []
+    # files that were submitted to the pool: (filename, result)
+    results = []
+    # is admission of new files limited by the free tmp space?
+    throttled = False
+    sweep = None
+
+
+    executor = ThreadPoolExecutor(max_workers=max(nproc,2))
+
+
+    while (ephem.now()-sunrise < ephem.hour or not queue.empty()
+           or pending or checks or ready):
+
+
+        # add new files from the queue to the pending files; wait
+        # at most 1s for the first one, or 0.1s if completeness
+        # checks are running
+        timeout = 0.1 if checks else 1
+        while True:
+            try:
+                event = queue.get(True, timeout)
+            except Empty:
+                break
+
+            timeout = 0
+            filename = get_filename (event)
+            if filename is not None and filename not in detected:
+                detected.add(filename)
+                t = time.time()
+                pending[filename] = [t, t]
+
+
+        # start completeness check of pending files for which the
+        # time of the next check has passed
+        for filename in list(pending):
+            if (pending[filename][1] <= time.time() and
+                filename not in checks.values()):
+                checks[executor.submit(check_file, filename)] = filename
+
+
+        # collect finished checks
+        for future in [f for f in checks if f.done()]:
+
+            filename = checks.pop(future)
+            t_detect = pending[filename][0]
+
+            if future.exception() is None:
+                # file is complete
+                del pending[filename]
+                log.info ('successfully read file {} within {:.1f}s'
+                          .format(filename, time.time()-t_detect))
+                heapq.heappush(ready, (priority.get(future.result(), 3),
+                                       t_detect, filename))
+
+            elif time.time()-t_detect > wait_max:
+                # dropped; remove from the detected files, so that a
+                # later watchdog event for the same file is tried again
+                del pending[filename]
+                detected.discard(filename)
+                log.info ('{}s limit for reading file reached, not processing '
+                          '{}'.format(wait_max, filename))
+
+            else:
+                if pending[filename][1] == t_detect:
+                    log.warning ('file {} has not completely arrived yet; will '
+                                 'keep trying to read it in for {}s'
+                                 .format(filename, wait_max))
+
+                pending[filename][1] = time.time() + wait_check
+
+
+        # submit ready files in order of priority to the pool, as
+        # long as there are workers available; finished files are
+        # removed from the detected files, so that a later watchdog
+        # event for the same file, e.g. when it is copied again, is
+        # processed again
+        results_running = []
+        for filename, result in results:
+            if result.ready():
+                detected.discard(filename)
+            else:
+                results_running.append((filename, result))
+
+        results = results_running
+        while ready and len(results) < nproc:
+
+            # check free space on the tmp disk
+            if results:
+                space_ok = tmp_space_ok (tel=tel)
+                if space_ok == throttled:
+                    throttled = not space_ok
+                    if throttled:
+                        log.warning ('free space on tmp disk is less than {} '
+                                     'GB; submitting files one at a time'
+                                     .format(get_par(set_bb.tmp_free_min,tel)))
+                    else:
+                        log.info ('free space on tmp disk is sufficient '
+                                  'again; submitting files to all workers')
+
+                if throttled:
+                    # empty the trash folder in the background
+                    if sweep is None or sweep.done():
+                        sweep = executor.submit(sweep_trash, tel)
+                    break
+
+            __, __, filename = heapq.heappop(ready)
+            results.append((filename, pool.apply_async(try_blackbox_reduce,
+                                                       [filename])))
+
+
+    executor.shutdown()
+
+
+    return
+
+
 ################################################################################
 
 def adjust_horizon (observer, height):
@@ -505,18 +677,16 @@ def adjust_horizon (observer, height):
 
 ################################################################################
 
-def get_file (queue):
+def get_filename (event):
 
-    """Get file from queue after making sure it arrived completely; None
-    is returned if the file is not a fits file or still having trouble
-    reading the fits file even after waiting for 60s; otherwise the
-    filename is returned.
+    """Get filename from [event] taken from the night queue, which is
+    either a watchdog event or a filename of a file that was already
+    present; None is returned if the file is not a fits file. If the
+    filename is a temporary rsync copy, the name of the eventual file
+    is returned.
 
     """
 
-    # get event from queue
-    event = queue.get(True)
-
     try:
         # get name of new file
         filename = str(event.src_path)
@@ -552,45 +722,49 @@ def get_file (queue):
             log.info ('changed filename from rsync temporary file {} to {}'
                       .format(event.src_path, filename))
 
-        # this while loop below replaces the old [copying]
-        # function; it times out after wait_max is reached
-        wait_max = 180
-        t0 = time.time()
-        nsleep = 0
-        while time.time()-t0 < wait_max:
 
-            try:
-                # read the file
-                data = read_hdulist(filename, memmap=None)
+    return filename
 
-            except:
 
-                process = False
-                if nsleep==0:
-                    log.warning ('file {} has not completely arrived yet; '
-                                 'will keep trying to read it in for {}s'
-                                 .format(filename, wait_max))
+################################################################################
 
-                # give file a bit of time to arrive before next read attempt
-                time.sleep(5)
-                nsleep += 1
+def check_file (filename):
 
-            else:
-                # if fits file was read fine, set process flag to True
-                process = True
-                log.info ('successfully read file {} within {:.1f}s'
-                          .format(filename, time.time()-t0))
-                # and break out of while loop
-                break
+    """Check if [filename] has completely arrived by reading it; an
+    exception is raised if it cannot be read (yet). Returns the
+    lowercase image type determined by [get_imgtype], used to set
+    the processing priority of the file in the night queue.
+
+    """
 
+    data, header = read_hdulist(filename, get_header=True, memmap=None)
 
-        if not process:
-            log.info ('{}s limit for reading file reached, not processing {}'
-                      .format(wait_max, filename))
-            filename = None
 
+    return get_imgtype (header, filename)
 
-    return filename
+
+################################################################################
+
+def get_imgtype (header, filename):
+
+    """return lowercase image type of raw image [filename] with
+    [header], in the same way as [set_header]: for some flatfields,
+    IMAGETYP was erroneously set to Object, so an object frame with
+    'flat' in its filename is considered a flat. An empty string is
+    returned if IMAGETYP is not in [header].
+
+    """
+
+    if 'IMAGETYP' in header:
+        imgtype = str(header['IMAGETYP']).lower()
+    else:
+        imgtype = ''
+
+    if 'flat' in filename.lower() and imgtype == 'object':
+        imgtype = 'flat'
+
+
+    return imgtype
 
 
 ################################################################################
@@ -807,11 +981,238 @@ def already_exists (filename, get_filename=False):
         return exists
 
 
+################################################################################
+
+def get_file_stat (filename):
+
+    """return tuple (modification time, size) of [filename], which
+       can be a local file or a file in a google cloud bucket; for a
+       bucket file, the modification time is the update time of the
+       blob in seconds since the epoch. If the file does not exist,
+       (None, None) is returned."""
+
+    if filename[0:5] == 'gs://':
+
+        bucket_name, bucket_file = get_bucket_name (filename)
+        blob = storage.Client().bucket(bucket_name).get_blob(bucket_file)
+        if blob is None:
+            return None, None
+        else:
+            return blob.updated.timestamp(), blob.size
+
+    else:
+
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None, None
+        else:
+            return stat.st_mtime, stat.st_size
+
+
+################################################################################
+
+def map_threads (func, items, nthreads=1):
+
+    """return list with the results of [func] applied to each of
+       [items], in the same order; a pool of [nthreads] threads is
+       used if [nthreads] is larger than 1 and there is more than one
+       item, otherwise the items are processed in a simple loop"""
+
+    items = list(items)
+    if nthreads > 1 and len(items) > 1:
+        with ThreadPoolExecutor(max_workers=min(nthreads, len(items))) \
+             as executor:
+            return list(executor.map(func, items))
+    else:
+        return [func(item) for item in items]
+
+
+################################################################################
+
+def read_table_unmasked (fits_table):
+
+    """read fits table [fits_table] without masking NaNs and empty
+       strings; astropy>=6 masks these by default, while older
+       versions do not mask them and do not know the [mask_invalid]
+       argument"""
+
+    try:
+        return Table.read(fits_table, mask_invalid=False)
+    except TypeError:
+        return Table.read(fits_table)
+
+
+def read_table_dict (fits_table, tmp_dir=None):
+
+    """return fits table [fits_table] as dictionary with the values of
+       the first column as keys and the rows (lists) as values; empty
+       if the table does not exist (yet) or cannot be read. A table in
+       a google cloud bucket is first copied to local folder
+       [tmp_dir]."""
+
+    table_dict = {}
+
+    if not isfile(fits_table):
+        return table_dict
+
+    try:
+        if fits_table[0:5] == 'gs://':
+            os.makedirs(tmp_dir, exist_ok=True)
+            fits_local = '{}/{}.{}.read'.format(
+                tmp_dir, fits_table.split('/')[-1], os.getpid())
+            copy_file (fits_table, fits_local, verbose=False)
+            table = read_table_unmasked (fits_local)
+            os.remove(fits_local)
+        else:
+            table = read_table_unmasked (fits_table)
+
+        for row in table:
+            table_dict[row[0]] = list(row)
+
+    except Exception as e:
+        log.warning ('exception was raised while reading table {}: {}'
+                     .format(fits_table, e))
+
+
+    return table_dict
+
+
+def locked_table_update (fits_table, update_func, colnames, dtypes,
+                         lock_dir=None):
+
+    """read fits table [fits_table] with [read_table_dict], apply
+       [update_func] to the resulting dictionary, which should modify
+       it in place, and save it as table with [colnames] and [dtypes];
+       the updated dictionary is returned. A lock file in [lock_dir]
+       (default: the folder of [fits_table]) is held while the table
+       is read, updated and saved, and the table is saved to a
+       temporary file that is renamed (or moved for a google cloud
+       bucket), so that other processes never read a partially
+       written table. For a table in a bucket [lock_dir] needs to be
+       a local folder; updates from different machines are then not
+       protected."""
+
+    if lock_dir is None:
+        lock_dir = os.path.dirname(fits_table)
+
+    os.makedirs(lock_dir, exist_ok=True)
+    basename = fits_table.split('/')[-1]
+
+
+    with open('{}/{}.lock'.format(lock_dir, basename), 'w') as flock:
+
+        fcntl.flock(flock, fcntl.LOCK_EX)
+
+        try:
+            table_dict = read_table_dict (fits_table, tmp_dir=lock_dir)
+            update_func (table_dict)
+
+            table = Table(rows=list(table_dict.values()), names=colnames,
+                          dtype=dtypes)
+            fits_tmp = '{}/{}.{}.tmp'.format(lock_dir, basename, os.getpid())
+            table.write(fits_tmp, format='fits', overwrite=True)
+            if fits_table[0:5] == 'gs://':
+                copy_file (fits_tmp, fits_table, move=True, verbose=False)
+            else:
+                os.replace(fits_tmp, fits_table)
+
+        finally:
+            fcntl.flock(flock, fcntl.LOCK_UN)
+
+
+    return table_dict
+
+
+################################################################################
+
+# per-process cache of fits headers used by [read_header], with keys
+# returned by [header_cache_key] and values the header
+header_cache = collections.OrderedDict()
+
+
+def header_cache_key (filename):
+
+    """return key of [filename] used in the header cache: a tuple
+       (filename, modification time, size) so that a file that is
+       remade is read again. Raw files are never modified, so for raw
+       files in a google cloud bucket the bucket is not queried and
+       the key is (filename,). If [filename] does not exist, its
+       fpacked version is tried; if that does not exist either, None
+       is returned."""
+
+    if filename[0:5] == 'gs://' and filename.startswith(
+            get_par(set_bb.raw_dir,tel)):
+        return (filename,)
+
+    for fn in [filename, '{}.fz'.format(filename)]:
+        mtime, size = get_file_stat (fn)
+        if mtime is not None:
+            return (fn, mtime, size)
+
+    return None
+
+
+def cache_get (cache, key):
+
+    """return copy of header in [cache] with [key], or None if
+       it is not present"""
+
+    if key is None or get_par(set_bb.header_cache_size,tel) <= 0:
+        return None
+
+    try:
+        header = cache[key]
+        cache.move_to_end(key)
+    except KeyError:
+        return None
+
+    return header.copy()
+
+
+def cache_put (cache, key, header):
+
+    """save copy of [header] in [cache] with [key], removing the least
+       recently used header(s) if the cache is full"""
+
+    cache_size = get_par(set_bb.header_cache_size,tel)
+    if key is None or cache_size <= 0:
+        return
+
+    cache[key] = header.copy()
+    while len(cache) > cache_size:
+        try:
+            cache.popitem(last=False)
+        except KeyError:
+            break
+
+
+def read_header (filename, **kwargs):
+
+    """read header of [filename] using [read_hdulist], using a
+       least-recently-used cache such that the header of the same file
+       is only parsed once by this process. A copy of the cached
+       header is returned, so the caller is free to modify it.
+
+    """
+
+    key = header_cache_key (filename)
+    header = cache_get (header_cache, key)
+
+    if header is None:
+        header = read_hdulist(filename, get_data=False, get_header=True,
+                              **kwargs)
+        cache_put (header_cache, key, header)
+
+    return header
+
+
 ################################################################################
 
 def fpack (filename):
 
-    """fpack fits images; skip fits tables"""
+    """fpack fits images in process, i.e. without running the fpack
+       executable; skip fits tables"""
 
     try:
 
@@ -822,19 +1223,6 @@ def fpack (filename):
 
             # check if it is an image
             if int(header['NAXIS'])==2:
-                # determine if integer or float image
-                if int(header['BITPIX']) > 0:
-                    cmd = ['fpack', '-D', '-Y', '-v', filename]
-                else:
-                    if 'Scorr' in filename or 'limmag' in filename:
-                        quant = 2
-                    elif 'Fpsf' in filename:
-                        quant = 4
-                    else:
-                        quant = 16
-
-                    cmd = ['fpack', '-q', str(quant), '-D', '-Y', '-v', filename]
-
 
                 # if output fpacked file already exists, delete it
                 filename_packed = '{}.fz'.format(filename)
@@ -844,7 +1232,12 @@ def fpack (filename):
                     log.warning ('fpacking over already existing file {}'
                                  .format(filename_packed))
 
-                subprocess.run(cmd)
+                with fits.open(filename, memmap=True) as hdulist:
+                    write_fpack (filename_packed, hdulist[0].data,
+                                 hdulist[0].header, datasum=True)
+
+                # remove the uncompressed file, as done by fpack -D
+                remove_files([filename])
                 filename = filename_packed
 
 
@@ -859,9 +1252,183 @@ def fpack (filename):
 
 ################################################################################
 
-def create_jpg (filename, cmap='gray', ext='jpg'):
+def write_fpack (fits_fz, data, header, overwrite=True, datasum=False):
+
+    """write [data] and [header] to the tile-compressed image [fits_fz],
+       using RICE_1 compression like fpack; images stored as integers
+       according to BITPIX in [header] are compressed losslessly,
+       also if [data] was scaled to floats using BSCALE and BZERO
+       when it was read, while float images are quantized with the
+       same levels as used before with fpack -q: 2 for the Scorr and
+       limmag images, 4 for the Fpsf images and 16 for the rest. If
+       [header] does not contain BITPIX, the data type of [data] is
+       used instead.
+       If [datasum] is True, the checksum of the data as stored,
+       i.e. after quantization, is recorded as DATASUM in the header,
+       which [copy_files2keep] uses to check if an image contains the
+       same data as [fits_fz] without reading the data of the latter;
+       otherwise any DATASUM and CHECKSUM in [header] are removed, as
+       these would not match the compressed data.
+
+    """
+
+    if 'BITPIX' in header:
+        lossless = (int(header['BITPIX']) > 0)
+    else:
+        lossless = np.issubdtype(data.dtype, np.integer)
+
+    if lossless and np.issubdtype(data.dtype, np.integer):
+        quant = None
+    elif lossless:
+        # scaled integers; a quantize level of 0 compresses the
+        # floats losslessly
+        quant = 0
+    elif 'Scorr' in fits_fz or 'limmag' in fits_fz:
+        quant = 2
+    elif 'Fpsf' in fits_fz:
+        quant = 4
+    else:
+        quant = 16
+
+
+    header = header.copy()
+    for key in ['DATASUM', 'CHECKSUM']:
+        header.remove(key, ignore_missing=True)
+
+    if datasum:
+        # for quantized images the checksum is only known after
+        # compression, so a placeholder is replaced after writing
+        if not quant:
+            header['DATASUM'] = (data_sum(data), 'data unit checksum')
+        else:
+            header['DATASUM'] = ('0', 'data unit checksum')
+
+
+    if quant is None:
+        hdu = fits.CompImageHDU(data=data, header=header,
+                                compression_type='RICE_1')
+    else:
+        hdu = fits.CompImageHDU(data=data, header=header,
+                                compression_type='RICE_1',
+                                quantize_level=quant)
+
+    hdu.writeto(fits_fz, overwrite=overwrite)
+
+
+    if datasum and quant:
+
+        with fits.open(fits_fz) as hdulist:
+            value = data_sum(hdulist[1].data)
+
+        # the DATASUM of the compressed image is saved as ZDATASUM
+        # in the binary table header, which precedes the data; the
+        # card is replaced in place, as it has the same length
+        card_old = fits.Card('ZDATASUM', '0', 'data unit checksum').image
+        card_new = fits.Card('ZDATASUM', value, 'data unit checksum').image
+        with open(fits_fz, 'r+b') as f:
+            index = f.read(2**20).find(card_old.encode())
+            if index >= 0:
+                f.seek(index)
+                f.write(card_new.encode())
+            else:
+                log.warning ('DATASUM placeholder not found in header of {}'
+                             .format(fits_fz))
+
+
+################################################################################
+
+def try_write_fpack (fits_fz, data, header, overwrite=True):
+
+    """write [data] and [header] to the tile-compressed image [fits_fz]
+       with [write_fpack]; if the compression fails, the possibly
+       partly written [fits_fz] is removed and False is returned, so
+       that the caller can write the image uncompressed instead"""
+
+    try:
+        write_fpack (fits_fz, data, header, overwrite=overwrite)
+    except Exception as e:
+        log.exception ('exception was raised while writing compressed image '
+                       '{}; writing it uncompressed instead: {}'
+                       .format(fits_fz, e))
+        if os.path.isfile(fits_fz):
+            os.remove(fits_fz)
+
+        return False
+
+
+    return True
+
+
+################################################################################
+
+def funpack (filename):
+
+    """uncompress tile-compressed fits file [filename] in process,
+       i.e. without running the funpack executable, and delete
+       [filename] as done by funpack -D; the compressed image in the
+       first extension of a file created by fpack is restored as the
+       primary image. The name of the uncompressed file is returned.
+
+    """
+
+    filename_out = filename.replace('.fz','')
+
+    with fits.open(filename) as hdulist:
+
+        hdus = []
+        for i_hdu, hdu in enumerate(hdulist):
+
+            if isinstance(hdu, fits.CompImageHDU):
+                # remove the checksums recorded by [write_fpack], so
+                # that they do not end up in the headers of images
+                # that are modified or created from this one
+                header = hdu.header.copy()
+                for key in ['DATASUM', 'CHECKSUM']:
+                    header.remove(key, ignore_missing=True)
+
+                if (i_hdu==1 and hdulist[0].data is None and
+                    'SIMPLE' in hdu.header):
+                    # fpacked primary image
+                    hdus[0] = fits.PrimaryHDU(data=hdu.data, header=header)
+                else:
+                    hdus.append(fits.ImageHDU(data=hdu.data, header=header))
+            else:
+                hdus.append(hdu)
+
+
+        fits.HDUList(hdus).writeto(filename_out, overwrite=True)
+
+
+    remove_files([filename])
+
+
+    return filename_out
+
+
+################################################################################
+
+def data_sum (data):
+
+    """return FITS data unit checksum (DATASUM) of image [data] as
+       string"""
+
+    return str(fits.ImageHDU(data=data).add_datasum())
+
+
+################################################################################
+
+def create_jpg (filename, cmap='gray', ext='jpg', data=None, header=None,
+                size_max=1200, annotate=True):
+
+    """Create jpg image from fits image [filename], or from [data] and
+       [header] if these are provided, so that the image does not
+       need to be read again. The image is binned with block
+       averaging to at most [size_max] pixels on a side, scaled
+       between the zscale limits, and saved using PIL. If [annotate]
+       is True, a title with some header values and a colorbar are
+       added to the image.
 
-    """Create jpg image from fits"""
+    """
 
     mem_use (label='at start of create_jpg')
 
@@ -874,8 +1441,9 @@ def create_jpg (filename, cmap='gray', ext='jpg'):
             log.info ('saving {} to {}'.format(filename, image_jpg))
 
             # read input image
-            data, header = read_hdulist(filename, get_header=True,
-                                        dtype='float32')
+            if data is None or header is None:
+                data, header = read_hdulist(filename, get_header=True,
+                                            dtype='float32')
 
 
             imgtype = header['IMAGETYP'].lower()
@@ -902,20 +1470,41 @@ def create_jpg (filename, cmap='gray', ext='jpg'):
                 label = 'pixel value (e-)'
 
 
-            fig, ax = plt.subplots(layout='constrained', figsize=(8.27,8.27))
+            # zscale limits; ZScaleInterval determines these from a
+            # subsample of at most 1000 pixels of the unbinned image
             vmin, vmax = zscale(contrast=0.35).get_limits(data)
+
+
+            # bin image by averaging blocks of nbin x nbin pixels
+            ysize, xsize = data.shape
+            nbin = int(np.ceil(max(ysize, xsize) / size_max))
+            if nbin > 1:
+                ny, nx = ysize // nbin, xsize // nbin
+                data_bin = (data[0:ny*nbin, 0:nx*nbin]
+                            .reshape(ny, nbin, nx, nbin)
+                            .mean(axis=(1,3), dtype='float32'))
+            else:
+                data_bin = data
+
+
+            # map to the 256 colors of the colormap, with y-axis
+            # pointing up; non-finite pixels (NaNs spread over their
+            # whole bin by the block averaging) are set to the lowest
+            # color, as casting them to uint8 is undefined
             norm = Normalize(vmin=vmin, vmax=vmax, clip=True)
-            mapped_data = colormaps.get_cmap(cmap)(norm(data), bytes=True)
-            plt.imshow(mapped_data, cmap=cmap, origin='lower')
-            plt.colorbar(matplotlib.cm.ScalarMappable(norm=norm, cmap=cmap),
-                         ax=ax, label=label, orientation='vertical',
-                         fraction=0.05, pad=0.05)
-            plt.title(title, fontsize=10)
-            plt.xlabel('X (pixels)')
-            plt.ylabel('Y (pixels)')
-            plt.grid(None)
-            plt.savefig(image_jpg, dpi=175)
-            plt.close()
+            cmap_lut = colormaps.get_cmap(cmap)(np.arange(256), bytes=True)
+            index = (np.nan_to_num(norm(data_bin).filled(0), nan=0,
+                                   posinf=1, neginf=0) * 255).astype('uint8')
+            image = Image.fromarray(np.ascontiguousarray(
+                cmap_lut[index[::-1], 0:3]))
+
+
+            if annotate:
+                image = annotate_jpg (image, title, label, vmin, vmax,
+                                      cmap_lut)
+
+
+            image.save(image_jpg, quality=90)
 
             mem_use (label='at end of create_jpg')
 
@@ -928,6 +1517,51 @@ def create_jpg (filename, cmap='gray', ext='jpg'):
     return image_jpg
 
 
+################################################################################
+
+def annotate_jpg (image, title, label, vmin, vmax, cmap_lut):
+
+    """add [title] above PIL [image] and a colorbar with colors
+       [cmap_lut] between [vmin] and [vmax] to the right of it, with
+       [label] alongside; returns the new image"""
+
+    xsize, ysize = image.size
+    dy_title = 30
+    dx_cbar = 160
+
+    # white canvas with image below the title
+    canvas = Image.new('RGB', (xsize+dx_cbar, ysize+dy_title), 'white')
+    canvas.paste(image, (0, dy_title))
+    draw = ImageDraw.Draw(canvas)
+    draw.text((5, 8), title, fill='black')
+
+    # colorbar with vmax at the top
+    x1 = xsize + 15
+    x2 = x1 + 25
+    cbar = cmap_lut[np.linspace(255, 0, ysize).astype(int), 0:3]
+    cbar = np.repeat(cbar[:,None,:], x2-x1, axis=1)
+    canvas.paste(Image.fromarray(np.ascontiguousarray(cbar)), (x1, dy_title))
+    draw.rectangle((x1, dy_title, x2-1, dy_title+ysize-1), outline='black')
+
+    # tick values at top, middle and bottom of colorbar
+    for frac in [0, 0.5, 1]:
+        y = dy_title + int(frac * (ysize-1))
+        value = vmax - frac * (vmax-vmin)
+        draw.line((x2, y, x2+4, y), fill='black')
+        y_text = min(max(y-5, dy_title), dy_title+ysize-12)
+        draw.text((x2+7, y_text), '{:.4g}'.format(value), fill='black')
+
+    # label rotated by 90 degrees
+    image_label = Image.new('RGB', (ysize, 15), 'white')
+    ImageDraw.Draw(image_label).text((ysize//2-3*len(label), 2), label,
+                                     fill='black')
+    canvas.paste(image_label.rotate(90, expand=True),
+                 (xsize+dx_cbar-20, dy_title))
+
+
+    return canvas
+
+
 ################################################################################
 
 class WrapException(Exception):
@@ -996,18 +1630,32 @@ def try_blackbox_reduce (filename):
                              .format(filename, e))
 
 
-    return filename_reduced
+        # wait for the tmp folders of previous images to be removed,
+        # so that at most the removal of the tmp folder of this image
+        # is still running in the background when the next image is
+        # processed; pool workers exit without waiting for the
+        # background thread, so a removal that is interrupted leaves
+        # a folder in the trash, which is removed by [run_blackbox]
+        # with [sweep_trash] after the pool has finished
+        tmp_wait (nkeep=1)
 
 
-################################################################################
+    # add reduced file to the obslog table of the night
+    if filename_reduced is not None:
+        obslog_add (filename_reduced)
 
-def get_filename_red (fits_raw):
+
+    return filename_reduced
+
+
+################################################################################
+
+def get_filename_red (fits_raw):
 
     """determine reduced filename from raw fits header"""
 
     # read header
-    header = read_hdulist(fits_raw, get_data=False, get_header=True,
-                          memmap=None)
+    header = read_header(fits_raw, memmap=None)
 
     # use [set_header] to update raw header so that also DATE-OBS
     # is updated to be mid-exposure time
@@ -1044,11 +1692,10 @@ def blackbox_reduce (filename):
 
     # just read the header for the moment
     try:
-        header = read_hdulist(filename, get_data=False, get_header=True,
-                              memmap=None)
+        header = read_header(filename, memmap=None)
     except Exception as e:
         #log.exception (traceback.format_exc())
-        log.exception ('exception was raised in read_hdulist at top of '
+        log.exception ('exception was raised in read_header at top of '
                        '[blackbox_reduce]: {}; not processing {}'
                        .format(e, filename))
         return None
@@ -1204,71 +1851,42 @@ def blackbox_reduce (filename):
         # [ref_path]/ML1_[obj]_[filt]_[date]_red.fits.fz - google
         # [ref_path]/BG_[obj]_[filt]_[date]_red.fits.fz - google
 
-        # do not use telescope name here, to allow ML references to be
-        # used for BG
-        list_ref = list_files(ref_path, search_str='_{}_{}_'
-                              .format(obj, filt), end_str='_red.fits.fz')
+        # look up the reference images of this field and filter in
+        # the reference index maintained by [buildref], which avoids
+        # listing the reference folder and reading the reference
+        # headers; if they are not in the index, or the selected
+        # reference image no longer exists, list the folder
+        ref_rows = refindex_lookup (obj, filt)
+        if ref_rows is not None:
+            list_ref = [row['FILENAME'] for row in ref_rows]
+            ref_fits_in = select_ref (list_ref, ref_rows, obj, filt)
+            if not isfile('{}.fz'.format(ref_fits_in)):
+                log.warning ('reference image {}.fz in reference index does '
+                             'not exist; listing reference folder instead'
+                             .format(ref_fits_in))
+                ref_rows = None
+
+        if ref_rows is None:
+            # do not use telescope name here, to allow ML references to
+            # be used for BG
+            list_ref = list_files(ref_path, search_str='_{}_{}_'
+                                  .format(obj, filt), end_str='_red.fits.fz')
+            ref_fits_in = select_ref (list_ref, None, obj, filt)
 
 
         # check if there is a reference image at all
-        nrefs = len(list_ref)
-        if nrefs==0:
-
-            ref_present = False
-            ref_fits_in = None
-
-        else:
-
-            ref_present = True
-
-            # if there is a single ref image, use that one
-            if nrefs==1:
-
-                ref_fits_in = list_ref[0].replace('.fz','')
-
-            elif nrefs > 1:
-
-                # in case of multiple ref images, select the deepest
-                # one according to the LIMMAG header keyword
-                log.info ('available reference images: {}'.format(list_ref))
-
-                try:
-
-                    limmags_ref = np.zeros(nrefs)
-                    for i, fits_tmp in enumerate(list_ref):
-                        hdr_tmp = read_hdulist(fits_tmp, get_data=False,
-                                               get_header=True)
-                        if 'LIMMAG' in hdr_tmp:
-                            limmags_ref[i] = hdr_tmp['LIMMAG']
-                        else:
-                            log.warning('LIMMAG keyword not present in header '
-                                        'of {}'.format(fits_tmp))
-
-                    if np.all(limmags_ref==0):
-                        log.error('limiting magnitudes of available reference '
-                                  'images for field {} in filter {} are all '
-                                  'zero; reverting to using most recent one '
-                                  'according to date in the filename'
-                                  .format(obj, filt))
-                        raise
-
-                    else:
-                        idx = np.argmax(limmags_ref)
-                        ref_fits_in = list_ref[idx].replace('.fz','')
-
-                except:
-
-                    # instead of deepest, pick the most recent one
-                    ref_fits_in = sorted(list_ref)[-1].replace('.fz','')
-
-
+        ref_present = (ref_fits_in is not None)
+        if ref_present:
 
             # check if the image being processed is not used as the
             # only image for the current referent image; if that is
             # the case, leave the function
             log.info ('ref image selected: {}'.format(ref_fits_in))
-            header_ref = read_hdulist(ref_fits_in, get_data=False,
-                                      get_header=True)
+            if ref_rows is not None:
+                header_ref = ref_rows[list_ref.index(
+                    '{}.fz'.format(ref_fits_in))]
+            else:
+                header_ref = read_header(ref_fits_in)
             if header_ref['R-NUSED']==1 and header_ref['R-IM1'] in fits_out:
                 log.warning ('this image {} is the current reference image '
                              'of field {} in filter {}; not processing it'
@@ -1294,7 +1912,8 @@ def blackbox_reduce (filename):
         #shutil.rmtree(get_par(set_bb.tmp_dir_base,tel))
 
         # instead, go through separate entries (files or
-        # directories) in that folder and remove them one by one
+        # directories) in that folder and move them one by one to
+        # the trash folder, which is emptied in the background
         with os.scandir(get_par(set_bb.tmp_dir_base,tel)) as it:
             for entry in it:
                 # only consider folders that start with 'BG';
@@ -1302,7 +1921,16 @@ def blackbox_reduce (filename):
                 # remove 'Constant.pm' or '.XIM-unix'
                 if entry.is_dir() and entry.name.startswith('BG'):
                     log.info ('removing folder {}'.format(entry.path))
-                    shutil.rmtree(entry.path, ignore_errors=True)
+                    try:
+                        move2trash (entry.path)
+                    except Exception as e:
+                        log.warning ('exception was raised while moving {} '
+                                     'to trash folder; removing it directly: '
+                                     '{}'.format(entry.path, e))
+                        shutil.rmtree(entry.path, ignore_errors=True)
+
+        # remove contents of trash folder in the background
+        tmp_submit (sweep_trash, tel)
 
 
 
@@ -1533,7 +2161,8 @@ def blackbox_reduce (filename):
         try:
             log.info('correcting for the overscan')
             os_processed = False
-            data = os_corr(data, header, imgtype, tel=tel)
+            data = os_corr(data, header, imgtype, tel=tel,
+                           nthreads=set_bb.nthreads)
         except Exception as e:
             #log.exception(traceback.format_exc())
             log.exception('exception was raised during [os_corr] of image {}; '
@@ -1631,8 +2260,8 @@ def blackbox_reduce (filename):
             # call [run_qc_check] to update header with any QC flags
             run_qc_check (header, tel)
             # write fits
-            fits_out = write_fits (fits_out, data.astype('float32'), header,
-                                   tel=tel, logfile=logfile)
+            fits_out = write_fits (fits_out, data.astype('float32', copy=False),
+                                   header, tel=tel, logfile=logfile)
             # close down logging and leave
             close_log(log, logfile)
 
@@ -1642,14 +2271,18 @@ def blackbox_reduce (filename):
 
         # master bias creation
         ######################
+        fits_mbias = None
+        flock = None
         try:
-            # put an multi-processing lock on this block so that only 1
-            # process at a time can create the master bias
-            lock.acquire()
-
             # prepare or point to the master bias
             fits_master = '{}/bias/{}_bias_{}.fits'.format(master_path, tel,
                                                            date_eve)
+
+            # lock this particular master so that only 1 process at a
+            # time can create it, while other masters can be prepared
+            # in parallel
+            flock = lock_master (fits_master, tel=tel)
+
             fits_mbias = master_prep (fits_master, data.shape,
                                       get_par(set_bb.create_master,tel),
                                       tel=tel, proc_mode=proc_mode)
@@ -1660,26 +2293,112 @@ def blackbox_reduce (filename):
                           'master {}: {}'.format(fits_master, e))
 
         finally:
-            lock.release()
+            unlock_master (flock)
+
+
+
+        # master flat creation
+        ######################
+        # for object images, the master flat is prepared before the
+        # master bias is applied, so that both masters can be applied
+        # in a single pass through the image by [calib_corr]
+        fits_mflat = None
+        if imgtype == 'object':
+
+            flock = None
+            try:
+                # prepare or point to the master flat
+                fits_master = '{}/flat/{}_flat_{}_{}.fits'.format(master_path,
+                                                                  tel, date_eve,
+                                                                  filt)
+
+                # lock this particular master so that only 1 process
+                # at a time can create it; processes that need the
+                # master flat in a different filter are not held up
+                flock = lock_master (fits_master, tel=tel)
+
+                fits_mflat = master_prep (fits_master, data.shape,
+                                          get_par(set_bb.create_master,tel),
+                                          tel=tel, proc_mode=proc_mode)
+
+            except Exception as e:
+                #log.exception(traceback.format_exc())
+                log.exception('exception was raised during flat [master_prep] '
+                              'of master {}: {}'.format(fits_master, e))
+
+            finally:
+                unlock_master (flock)
 
 
 
-        # master bias subtraction
-        #########################
+        # master bias subtraction and master flat division
+        ##################################################
         mbias_processed = False
         header['MBIAS-P'] = (mbias_processed, 'corrected for master bias?')
         header['MBIAS-F'] = ('None', 'name of master bias applied')
 
-        # check if mbias needs to be subtracted
+        # read master bias if it needs to be subtracted
+        data_mbias = None
         if fits_mbias is not None and get_par(set_bb.subtract_mbias,tel):
+            try:
+                data_mbias, header_mbias = read_master(fits_mbias, tel=tel)
+            except Exception as e:
+                #log.exception(traceback.format_exc())
+                log.exception('exception was raised while reading master bias '
+                              '{}: {}'.format(fits_mbias, e))
+
+
+        # read master flat
+        data_mflat = None
+        if imgtype == 'object':
 
+            mflat_processed = False
+            header['MFLAT-P'] = (mflat_processed, 'corrected for master flat?')
+            header['MFLAT-F'] = ('None', 'name of master flat applied')
+
+            if fits_mflat is not None:
+                try:
+                    data_mflat, header_mflat = read_master(fits_mflat, tel=tel)
+                except Exception as e:
+                    #log.exception(traceback.format_exc())
+                    log.exception('exception was raised while reading master '
+                                  'flat {}: {}'.format(fits_mflat, e))
+
+
+        # for object images the saturated pixels are identified after
+        # the bias subtraction and before the flat division in the
+        # same pass through the image; the resulting mask is used in
+        # [mask_init]. N.B.: as the flat division is now done before
+        # [mask_init] instead of after it, non-finite values resulting
+        # from the flat division, e.g. where the master flat is zero,
+        # are set to zero and masked as bad pixels by [mask_init]
+        satlevel_chans = None
+        if imgtype == 'object':
             try:
-                # and subtract it from the flat or object image
-                log.info('subtracting the master bias')
-                data_mbias, header_mbias = read_hdulist(fits_mbias,
-                                                        get_header=True)
-                data -= data_mbias
-                del data_mbias
+                nchans = get_par(set_bb.ny,tel) * get_par(set_bb.nx,tel)
+                satlevel_chans = get_satlevels (header, nchans)
+            except Exception as e:
+                log.exception('exception was raised while determining the '
+                              'channel saturation levels of image {}: {}'
+                              .format(filename, e))
+
+
+        mask_sat = None
+        try:
+            log.info('subtracting the master bias and dividing by the master '
+                     'flat')
+            mask_sat = calib_corr (data, data_mbias=data_mbias,
+                                   data_mflat=data_mflat,
+                                   satlevel_chans=satlevel_chans,
+                                   nthreads=set_bb.nthreads)
+        except Exception as e:
+            #log.exception(traceback.format_exc())
+            log.exception('exception was raised during [calib_corr] of image '
+                          '{}: {}'.format(filename, e))
+        else:
+
+            if data_mbias is not None:
+                mbias_processed = True
                 header['MBIAS-F'] = fits_mbias.split('/')[-1].split('.fits')[0]
 
                 # for object image, add number of days separating
@@ -1691,19 +2410,32 @@ def blackbox_reduce (filename):
                         np.abs(mjd_obs-mjd_obs_mb),
                         '[days] time between image and master bias used')
 
-            except Exception as e:
-                #log.exception(traceback.format_exc())
-                log.exception('exception was raised during master bias '
-                              'subtraction of image {}: {}'.format(filename, e))
-            else:
-                mbias_processed = True
-            finally:
-                header['MBIAS-P'] = mbias_processed
+
+            if data_mflat is not None:
+                mflat_processed = True
+                header['MFLAT-F'] = (fits_mflat.split('/')[-1].split('.fits')[0],
+                                     'name of master flat applied')
+
+                # for object image, add number of days separating
+                # image and master flat
+                mjd_obs = header['MJD-OBS']
+                mjd_obs_mf = header_mflat['MJD-OBS']
+                header['MF-NDAYS'] = (
+                    np.abs(mjd_obs-mjd_obs_mf),
+                    '[days] time between image and master flat used')
+
+        finally:
+            header['MBIAS-P'] = mbias_processed
+            if imgtype == 'object':
+                header['MFLAT-P'] = (mflat_processed, 'corrected for master '
+                                     'flat?')
+
+        del data_mbias, data_mflat
 
 
         # display
         if get_par(set_zogy.display,tel):
-            ds9_arrays(bias_sub=data)
+            ds9_arrays(calib_cor=data)
 
 
         # if IMAGETYP=dark, write [data] to fits and return
@@ -1711,8 +2443,8 @@ def blackbox_reduce (filename):
             # call [run_qc_check] to update header with any QC flags
             run_qc_check (header, tel)
             # write fits
-            fits_out = write_fits (fits_out, data.astype('float32'), header,
-                                   tel=tel, logfile=logfile)
+            fits_out = write_fits (fits_out, data.astype('float32', copy=False),
+                                   header, tel=tel, logfile=logfile)
             # close down logging and leave
             close_log(log, logfile)
 
@@ -1724,14 +2456,16 @@ def blackbox_reduce (filename):
         ######################
         if get_par(set_bb.create_mdark,tel):
 
+            flock = None
             try:
-                # put an multi-processing lock on this block so that only 1
-                # process at a time can create the master bias
-                lock.acquire()
-
                 # prepare or point to the master dark
                 fits_master = '{}/dark/{}_dark_{}.fits'.format(master_path, tel,
                                                                date_eve)
+
+                # lock this particular master so that only 1 process
+                # at a time can create it
+                flock = lock_master (fits_master, tel=tel)
+
                 fits_mdark = master_prep (fits_master, data.shape,
                                           get_par(set_bb.create_master,tel),
                                           tel=tel, proc_mode=proc_mode)
@@ -1742,7 +2476,7 @@ def blackbox_reduce (filename):
                               'master {}: {}'.format(fits_master, e))
 
             finally:
-                lock.release()
+                unlock_master (flock)
 
 
 
@@ -1752,7 +2486,8 @@ def blackbox_reduce (filename):
             try:
                 log.info('preparing the initial mask')
                 mask_processed = False
-                data_mask, header_mask = mask_init (data, header, filt, imgtype)
+                data_mask, header_mask = mask_init (data, header, filt, imgtype,
+                                                    mask_sat=mask_sat)
             except Exception as e:
                 #log.exception(traceback.format_exc())
                 log.exception('exception was raised during [mask_init] for image '
@@ -1779,8 +2514,8 @@ def blackbox_reduce (filename):
             # call [run_qc_check] to update header with any QC flags
             run_qc_check (header, tel)
             # write fits
-            fits_out = write_fits (fits_out, data.astype('float32'), header,
-                                   tel=tel, logfile=logfile)
+            fits_out = write_fits (fits_out, data.astype('float32', copy=False),
+                                   header, tel=tel, logfile=logfile)
             # close down logging and leave
             close_log(log, logfile)
 
@@ -1788,68 +2523,6 @@ def blackbox_reduce (filename):
 
 
 
-        # master flat creation
-        ######################
-        try:
-            # put an multi-processing lock on this block so that only 1
-            # process at a time can create the master flat
-            lock.acquire()
-
-            # prepare or point to the master flat
-            fits_master = '{}/flat/{}_flat_{}_{}.fits'.format(master_path, tel,
-                                                              date_eve, filt)
-            fits_mflat = master_prep (fits_master, data.shape,
-                                      get_par(set_bb.create_master,tel),
-                                      tel=tel, proc_mode=proc_mode)
-
-        except Exception as e:
-            #log.exception(traceback.format_exc())
-            log.exception('exception was raised during flat [master_prep] of '
-                          'master {}: {}'.format(fits_master, e))
-
-        finally:
-            lock.release()
-
-
-
-        # master flat division
-        ######################
-        mflat_processed = False
-        header['MFLAT-P'] = (mflat_processed, 'corrected for master flat?')
-        header['MFLAT-F'] = ('None', 'name of master flat applied')
-
-        if fits_mflat is not None:
-            try:
-                # and divide the object image by the master flat
-                log.info('dividing by the master flat')
-                data_mflat, header_mflat = read_hdulist(fits_mflat,
-                                                        get_header=True)
-                data /= data_mflat
-                del data_mflat
-                header['MFLAT-F'] = (fits_mflat.split('/')[-1].split('.fits')[0],
-                                     'name of master flat applied')
-
-                # for object image, add number of days separating
-                # image and master bias
-                if imgtype == 'object':
-                    mjd_obs = header['MJD-OBS']
-                    mjd_obs_mf = header_mflat['MJD-OBS']
-                    header['MF-NDAYS'] = (
-                        np.abs(mjd_obs-mjd_obs_mf),
-                        '[days] time between image and master flat used')
-
-            except Exception as e:
-                #log.exception(traceback.format_exc())
-                log.exception('exception was raised during master flat division '
-                              'of image {}: {}'.format(filename, e))
-            else:
-                mflat_processed = True
-            finally:
-                header['MFLAT-P'] = (mflat_processed, 'corrected for master flat?')
-
-
-
-
         # PMV 2018/12/20: fringe correction is not yet done, but
         # still add these keywords to the header
         header['MFRING-P'] = (False, 'corrected for master fringe map?')
@@ -1868,7 +2541,8 @@ def blackbox_reduce (filename):
         try:
             log.info('detecting cosmic rays')
             cosmics_processed = False
-            data, data_mask = cosmics_corr(data, header, data_mask, header_mask)
+            data, data_mask = cosmics_corr(data, header, data_mask, header_mask,
+                                           nthreads=set_bb.nthreads)
         except Exception as e:
             header['NCOSMICS'] = ('None', '[/s] number of cosmic rays identified')
             #log.exception(traceback.format_exc())
@@ -1901,7 +2575,8 @@ def blackbox_reduce (filename):
             xtalk_processed = False
             crosstalk_file = get_par(set_bb.crosstalk_file,tel)
             # data array is corrected in place; data_mask remains unchanged
-            xtalk_corr (data, crosstalk_file, data_mask)
+            xtalk_corr (data, crosstalk_file, data_mask,
+                        nthreads=set_bb.nthreads)
         except Exception as e:
             #log.exception(traceback.format_exc())
             log.exception('exception was raised during [xtalk_corr] of image '
@@ -2436,15 +3111,19 @@ def blackbox_reduce (filename):
         # make symbolic links but copying is cleaner to avoid editing
         # the files (at least the header is updated by zogy in
         # function prep_optimal_subtraction)
-        ref_files = list_files(ref_fits_in.split('_red.fits')[0])
-        for ref_file in ref_files:
+        # the files are taken from the node-local reference cache if
+        # it is defined, see [ref_cache_link]
+        if not ref_cache_link (ref_fits_in, tmp_path, tel=tel):
+
+            ref_files = list_files(ref_fits_in.split('_red.fits')[0])
+            for ref_file in ref_files:
 
-            tmp_file = '{}/{}'.format(tmp_path, ref_file.split('/')[-1])
+                tmp_file = '{}/{}'.format(tmp_path, ref_file.split('/')[-1])
 
-            # copy the file to tmp_path
-            copy_file (ref_file, tmp_file)
-            # and unzip if needed
-            unzip(tmp_file, put_lock=False)
+                # copy the file to tmp_path
+                copy_file (ref_file, tmp_file)
+                # and unzip if needed
+                unzip(tmp_file, put_lock=False)
 
 
 
@@ -2673,14 +3352,19 @@ def blackbox_reduce (filename):
 
 ################################################################################
 
-def save_png_thumbnails (fits_trans, dir_dest, tel=None, nthreads=1):
+def save_png_thumbnails (fits_trans, dir_dest, tel=None, nthreads=1,
+                         nrows_chunk=500):
 
     """function to convert thumbnails in transient catalog
     [fits_trans] to separate png files (to be used by the Database)
     with names [number]_RED.png, [number]_REF.png, [number]_D.png,
     [number]_SCORR.png, where number is the row number - also
-    indicated by the NUMBER column - in [fits_trans]. The pngs are
-    copied/moved to [dest_folder].
+    indicated by the NUMBER column - in [fits_trans]. The thumbnail
+    columns are read in chunks of [nrows_chunk] rows and the pngs are
+    created using a pool of [nthreads] threads. If [dest_folder] is a
+    Google Cloud bucket, the pngs are saved in a tmp folder and
+    copied/moved with a single command, otherwise they are saved
+    directly in [dest_folder].
 
     """
 
@@ -2704,26 +3388,6 @@ def save_png_thumbnails (fits_trans, dir_dest, tel=None, nthreads=1):
         cols2save = ['THUMBNAIL_{}'.format(c) for c in cols2save]
 
 
-        # define tmp folder to put the pngs, which is a subfolder in
-        # the tmp folder with the image basename, making it more
-        # efficient to copy the files to a bucket
-        dir_tmp = '{}/thumbnails'.format(os.path.dirname(fits_trans))
-        # make it
-        make_dir(dir_tmp)
-
-
-        # use multiprocessing to process rows in fits_trans, creating
-        # pngs in subfolder of tmp folder
-        pool_func (save_thumbs_row, range(nrows), fits_trans,
-                   cols2save, dir_tmp, nproc=nthreads)
-
-
-
-        # search string to identify the pngs created (to distinguish
-        # them from other png files in tmp folder)
-        search_str = '{}/[0-9]*_[DRS]*.png'.format(dir_tmp)
-
-
         # make sure destination folder is empty, otherwise different
         # reductions of the same image might lead to a mix of pngs
         if isdir(dir_dest):
@@ -2741,20 +3405,47 @@ def save_png_thumbnails (fits_trans, dir_dest, tel=None, nthreads=1):
         elif dir_dest[0:5] != 'gs://':
             make_dir (dir_dest, empty=True)
 
-        # copy or move to destination folder; if the destination is a
-        # Google Cloud bucket, then copying one by one just after
-        # creation in function save_thumbs_row() is very slow (about
-        # 1min for 100 files), so best to copy/move them with single
-        # command here
-        move = (not get_par(set_bb.keep_tmp,tel))
+
+        if dir_dest[0:5] == 'gs://':
+            # define tmp folder to put the pngs, which is a subfolder
+            # in the tmp folder with the image basename, making it
+            # more efficient to copy the files to a bucket
+            dir_png = '{}/thumbnails'.format(os.path.dirname(fits_trans))
+            # make it
+            make_dir(dir_png)
+        else:
+            dir_png = dir_dest
+
+
+        # read the thumbnail columns in chunks of rows and save them
+        # as pngs
+        for i1 in range(0, nrows, nrows_chunk):
+            i2 = min(i1+nrows_chunk, nrows)
+            table_chunk = fitsio.read(fits_trans, ext=-1,
+                                      columns=['NUMBER']+cols2save,
+                                      rows=range(i1,i2))
+            save_thumbs_chunk (table_chunk, cols2save, dir_png,
+                               nthreads=nthreads)
+
+
+        # if the destination is a Google Cloud bucket, then copying
+        # one by one just after creation is very slow (about 1min for
+        # 100 files), so best to copy/move them with single command
+        # here
         if dir_dest[0:5] == 'gs://':
 
+            move = (not get_par(set_bb.keep_tmp,tel))
             if move:
                 cp_cmd = 'mv'
             else:
                 cp_cmd = 'cp'
 
 
+            # search string to identify the pngs created (to
+            # distinguish them from other png files in tmp folder)
+            search_str = '{}/[0-9]*_[DRS]*.png'.format(dir_png)
+
+
             # gsutil command (not actively supported anymore)
             cmd = ['gsutil', '-m', '-q', cp_cmd, search_str, dir_dest]
             # gcloud storage alternative; best to use cp command
@@ -2765,17 +3456,7 @@ def save_png_thumbnails (fits_trans, dir_dest, tel=None, nthreads=1):
 
             # remove thumbnails from tmp folder if not kept
             if not get_par(set_bb.keep_tmp,tel):
-                shutil.rmtree(dir_tmp, ignore_errors=True)
-
-
-        else:
-
-            # if not in Google cloud, copy files one by one
-            filenames_png = glob.glob(search_str)
-
-            for png_tmp in filenames_png:
-                png_dest = '{}/{}'.format(dir_dest, png_tmp.split('/')[-1])
-                copy_file (png_tmp, png_dest, move=move, verbose=False)
+                shutil.rmtree(dir_png, ignore_errors=True)
 
 
     else:
@@ -2789,29 +3470,63 @@ def save_png_thumbnails (fits_trans, dir_dest, tel=None, nthreads=1):
 
 ################################################################################
 
-def save_thumbs_row (i_row, fits_trans, cols2save, dir_tmp, move=False):
+def save_thumbs_chunk (table_chunk, cols2save, dir_png, nthreads=1):
+
+    """save thumbnails in columns [cols2save] of the rows in numpy
+       recarray [table_chunk] as pngs in [dir_png], using a pool of
+       [nthreads] threads to scale and encode them
 
-    # read all columns of fits_trans row with index i_row
-    table_row = Table(fitsio.read(fits_trans, ext=-1, rows=i_row))[0]
+    """
 
+    nrows = len(table_chunk)
+    numbers = table_chunk['NUMBER']
 
-    # transient number in catalog
-    #number = i_row+1
-    number = table_row['NUMBER']
 
-    # loop thumbnails
+    # the zscale limits are determined by ZScaleInterval from a
+    # sample of the (flipped) thumbnail values, which is sorted; this
+    # sampling and sorting is done for all thumbnails of a column at
+    # once, and ZScaleInterval is then applied to the sorted sample,
+    # leading to the same limits
+    n_samples = 1000
+    samples = {}
     for col in cols2save:
 
-        # fetch data array from table column and flip/scale it
-        data = np.flipud(table_row[col])
-        vmin, vmax = zscale().get_limits(data)
-        data = scale_data(data, vmin, vmax)
+        data_col = table_chunk[col][:,::-1,:].reshape(nrows, -1)
+
+        # only possible if all values are finite, because
+        # ZScaleInterval discards non-finite values before sampling
+        if np.all(np.isfinite(data_col)):
+            stride = int(max(1.0, data_col.shape[1] / n_samples))
+            samples[col] = np.sort(data_col[:,::stride][:,:n_samples], axis=1)
+        else:
+            samples[col] = None
+
+
+    def save_thumb (i_row):
+
+        # transient number in catalog
+        number = numbers[i_row]
 
-        # save to file in tmp folder
-        fn = '{}_{}.png'.format(number, col.split('_')[-1])
-        png_tmp = '{}/{}'.format(dir_tmp, fn)
-        image = Image.fromarray(data)
-        image.save(png_tmp)
+        # loop thumbnails
+        for col in cols2save:
+
+            # fetch data array from table column and flip/scale it
+            data = np.flipud(table_chunk[col][i_row])
+            if samples[col] is not None:
+                vmin, vmax = zscale().get_limits(samples[col][i_row])
+            else:
+                vmin, vmax = zscale().get_limits(data)
+
+            data = scale_data(data, vmin, vmax)
+
+            # save to file
+            fn = '{}_{}.png'.format(number, col.split('_')[-1])
+            png = '{}/{}'.format(dir_png, fn)
+            image = Image.fromarray(data)
+            image.save(png)
+
+
+    map_threads (save_thumb, range(nrows), nthreads=nthreads)
 
 
 
@@ -2882,7 +3597,7 @@ def is_dumcat (fits_cat):
 
     dumcat = False
     if isfile(fits_cat):
-        header_cat = read_hdulist(fits_cat, get_data=False, get_header=True)
+        header_cat = read_header(fits_cat)
         if 'DUMCAT' in header_cat:
             dumcat = header_cat['DUMCAT']
         elif 'NAXIS2' in header_cat and header_cat['NAXIS2']==0:
@@ -3367,10 +4082,7 @@ def create_obslog (date, email=True, tel=None, weather_screenshot=True):
     #max_length = max([len(f.strip()) for f in filenames])
 
     # keywords to add to table
-    keys = ['ORIGFILE', 'IMAGETYP', 'DATE-OBS', 'PROGNAME', 'PROGID', 'OBJECT',
-            'FILTER', 'EXPTIME', 'RA', 'DEC', 'AIRMASS', 'FOCUSPOS',
-            'S-SEEING', 'CL-BASE', 'RH-MAST', 'WINDAVE', 'LIMMAG', 'QC-FLAG',
-            'QCRED1', 'QCRED2', 'QCRED3']
+    keys = list(obslog_keys.keys())
     formats = {#'ORIGFILE': '{:60}',
         #'IMAGETYP': '{:<8}',
         'DATE-OBS': '{:.19}',
@@ -3386,31 +4098,41 @@ def create_obslog (date, email=True, tel=None, weather_screenshot=True):
     }
 
 
-    # loop input list of filenames
-    log.info ('reading headers of reduced frames')
+    # the header values of the reduced frames are taken from the
+    # obslog table of this night, to which each frame is added when
+    # it has been reduced; only the headers of frames that are
+    # missing from this table are read, and added to it
+    obslog = obslog_read (date_eve, tel=tel)
+
+    # frames recorded under the name before fpacking, e.g. by an
+    # earlier version of [obslog_add], are matched to their fpacked
+    # name without reading their headers again
+    filenames_set = set(filenames)
+    for key in list(obslog):
+        key_fz = '{}.fz'.format(key)
+        if key_fz in filenames_set and key_fz not in obslog:
+            obslog[key_fz] = [key_fz] + list(obslog.pop(key)[1:])
+
+    files2read = [f for f in filenames if f not in obslog]
+    log.info ('{} of {} reduced frames found in obslog table'
+              .format(len(filenames)-len(files2read), len(filenames)))
+    if len(files2read) > 0:
+        log.info ('reading headers of {} reduced frames missing from obslog '
+                  'table'.format(len(files2read)))
+        rows_new = [obslog_row(f) for f in files2read]
+        obslog_update (date_eve, rows_new, tel=tel)
+        for row in rows_new:
+            obslog[row[0]] = row
+
+
+    # prepare rows of header values, masking missing values
     rows = []
+    masks = []
     for filename in filenames:
-
-        fn_hdr = filename.replace('.fits.fz', '_hdr.fits')
-        if isfile (fn_hdr):
-            file2read = fn_hdr
-        else:
-            file2read = filename
-
-
-        # read file header
-        header = read_hdulist (file2read, get_data=False, get_header=True)
-
-        # prepare row of filename and header values
-        row = []
-        for key in keys:
-            if key in header:
-                row.append(header[key])
-            else:
-                row.append(' ')
-
-        # append to rows
+        row = obslog[filename][1:len(keys)+1]
         rows.append(row)
+        masks.append([(value == '' if dtype is str else np.isnan(value))
+                      for value, dtype in zip(row, obslog_keys.values())])
 
 
     # create table from rows
@@ -3422,7 +4144,10 @@ def create_obslog (date, email=True, tel=None, weather_screenshot=True):
         # rows without entries: create empty table
         table = Table(names=names)
     else:
-        table = Table(rows=rows, names=names)
+        table = Table(rows=rows, names=names,
+                      dtype=list(obslog_keys.values()), masked=True)
+        for i_key, key in enumerate(keys):
+            table[key].mask = [mask[i_key] for mask in masks]
 
     # order by DATE-OBS
     index_sort = np.argsort(table['DATE-OBS'])
@@ -3529,17 +4254,33 @@ def create_obslog (date, email=True, tel=None, weather_screenshot=True):
 
     log.info ('collecting lists of full-source, transient and sso catalogs, and '
               'counting how many of them are flagged red')
-    cat_list = [c for c in all_cats_list if c.endswith('_red_cat.fits')]
-    body += ('# full-source cats: {} ({} red-flagged)\n'.format(
-        len(cat_list), count_redflags(cat_list)))
 
-    trans_list = [c for c in all_cats_list if c.endswith('_red_trans.fits')]
-    body += ('# transient cats:   {} ({} red-flagged)\n'.format(
-        len(trans_list), count_redflags(trans_list, key='TQC-FLAG')))
+    # red flags of the catalogs recorded in the obslog table
+    nredflags = {}
+    for i_col, col in enumerate(obslog_cats.keys()):
+
+        ext, key = obslog_cats[col]
+        cats = [c for c in all_cats_list if c.endswith(ext)]
+
+        # catalogs of which the flag is in the obslog table
+        flags = {}
+        for filename in object_list:
+            flag = obslog[filename][len(keys)+1+i_col]
+            if flag >= 0:
+                flags[filename.split('_red.fits')[0]+ext] = flag
 
-    sso_list = [c for c in all_cats_list if c.endswith('_red_trans_sso.fits')]
-    body += ('# SSO cats:         {} ({} empty)\n'.format(
-        len(sso_list), count_redflags(sso_list, key='SDUMCAT')))
+        nredflags[col] = (len(cats),
+                          sum([flags[c] for c in cats if c in flags]) +
+                          count_redflags([c for c in cats if c not in flags],
+                                         key=key))
+
+
+    body += ('# full-source cats: {} ({} red-flagged)\n'
+             .format(*nredflags['CAT-RED']))
+    body += ('# transient cats:   {} ({} red-flagged)\n'
+             .format(*nredflags['TRANS-RED']))
+    body += ('# SSO cats:         {} ({} empty)\n'
+             .format(*nredflags['SSO-RED']))
     body += '\n'
 
 
@@ -3619,102 +4360,433 @@ def count_redflags(catlist, key='QC-FLAG'):
 
 ################################################################################
 
-def send_email (recipients, subject, body,
-                attachments=None,
-                sender='Radboud GW Alert <scheduler@blackgem.org>',
-                reply_to='bg-admin@blackgem.org',
-                smtp_server='smtp-relay.gmail.com',
-                port=465, use_SSL=True):
+# header keywords recorded in the obslog table of a night, with their
+# types
+obslog_keys = {'ORIGFILE': str, 'IMAGETYP': str, 'DATE-OBS': str,
+               'PROGNAME': str, 'PROGID': str, 'OBJECT': str, 'FILTER': str,
+               'EXPTIME': float, 'RA': float, 'DEC': float, 'AIRMASS': float,
+               'FOCUSPOS': float, 'S-SEEING': float, 'CL-BASE': float,
+               'RH-MAST': float, 'WINDAVE': float, 'LIMMAG': float,
+               'QC-FLAG': str, 'QCRED1': str, 'QCRED2': str, 'QCRED3': str}
 
-    if use_SSL:
-        smtpObj = smtplib.SMTP_SSL(smtp_server, port)
-    else:
-        smtpObj = smtplib.SMTP(smtp_server, port)
+# catalogs of reduced object frames of which the red flag is recorded
+# in the obslog table: column name: (catalog extension, header key
+# indicating red flag); flag is 1 for red, 0 otherwise and -1 if the
+# catalog does not exist
+obslog_cats = {'CAT-RED':   ('_red_cat.fits', 'QC-FLAG'),
+               'TRANS-RED': ('_red_trans.fits', 'TQC-FLAG'),
+               'SSO-RED':   ('_red_trans_sso.fits', 'SDUMCAT')}
 
-    smtpObj.ehlo()
-    send_from = sender
-    send_to = recipients.split(',')
-    msg = MIMEMultipart()
-    msg['from'] = send_from
-    msg['to'] = recipients
-    msg['reply-to'] = reply_to
-    msg['date'] = formatdate(localtime=True)
-    msg['subject'] = subject
 
-    if body is None:
-        text = ''
-    elif isfile(body):
-        with open(body, 'r') as f:
-            text = f.read()
-    else:
-        text = body
+def obslog_key (filename):
 
-    msg.attach( MIMEText(text) )
+    """return name of the final reduced product of [filename], which
+       is the key of the frame in the obslog table: the fpacked name
+       if [filename] does not end with .fz and its fpacked version
+       exists. This is the name that [list_files] returns in
+       [create_obslog], while e.g. [blackbox_reduce] returns the name
+       of a reduced object frame before it was fpacked."""
 
-    if attachments is not None:
-        att_list = attachments.split(',')
-        for attachment in att_list:
-            if isfile(attachment):
-                part = MIMEBase('application', "octet-stream")
-                part.set_payload( open(attachment,"rb").read() )
-                encoders.encode_base64(part)
-                part.add_header('Content-Disposition', 'attachment; filename={}'
-                                .format(attachment.split('/')[-1]))
-                msg.attach(part)
+    if filename.endswith('.fits') and isfile('{}.fz'.format(filename)):
+        filename = '{}.fz'.format(filename)
 
-    smtpObj.sendmail(send_from, send_to, msg.as_string())
-    smtpObj.close()
+    return filename
 
 
 ################################################################################
 
-def get_flatstats (data, header, data_mask, tel=None):
+def obslog_row (filename):
 
+    """return obslog table row of reduced frame [filename], consisting
+       of the filename, the values of the header keywords
+       [obslog_keys] and the red flags of the catalogs
+       [obslog_cats]; missing values are recorded as an empty string
+       or NaN. The filename recorded is the final product name
+       returned by [obslog_key].
 
-    if get_par(set_zogy.timing,tel):
-        t = time.time()
+    """
 
-    # mask of valid pixels
-    mask_use = (data_mask == 0)
+    filename = obslog_key (filename)
 
+    fn_hdr = '{}_hdr.fits'.format(filename.split('.fits')[0])
+    if isfile (fn_hdr):
+        file2read = fn_hdr
+    else:
+        file2read = filename
 
-    # add some header keywords with the statistics
-    sec_tmp = get_par(set_bb.flat_norm_sec,tel)
-    value_tmp = '[{}:{},{}:{}]'.format(
-        sec_tmp[0].start+1, sec_tmp[0].stop+1,
-        sec_tmp[1].start+1, sec_tmp[1].stop+1)
-    header['STATSEC'] = (
-        value_tmp, 'pre-defined statistics section [y1:y2,x1:x2]')
 
+    # read file header
+    header = read_hdulist (file2read, get_data=False, get_header=True)
 
-    # statistics on STATSEC
-    mask_use_tmp = mask_use[sec_tmp]
-    median_sec = np.nanmedian(data[sec_tmp][mask_use_tmp])
-    std_sec = np.nanstd(data[sec_tmp][mask_use_tmp])
-    # using masked array (slow!)
-    #median_sec = np.ma.median(data_masked[sec_tmp])
-    #std_sec = np.ma.std(data_masked[sec_tmp])
+    # prepare row of filename and header values
+    row = [filename]
+    for key, dtype in obslog_keys.items():
+        try:
+            row.append(dtype(header[key]))
+        except:
+            if dtype is str:
+                row.append('')
+            else:
+                row.append(np.nan)
 
-    # check if values are finite
-    median_sec = check_finite(median_sec, 'MEDSEC', 'None')
-    std_sec = check_finite(std_sec, 'STDSEC', 'None')
-    if median_sec != 'None' and std_sec != 'None':
-        ratio_sec = std_sec/median_sec
-    else:
-        ratio_sec = 'None'
 
-    header['MEDSEC'] = (median_sec, '[e-] median flat over STATSEC')
-    header['STDSEC'] = (std_sec, '[e-] sigma (STD) flat over STATSEC')
-    header['RSTDSEC'] = (ratio_sec, 'relative sigma (STD) flat over STATSEC')
+    # red flags of catalogs
+    for ext, key in obslog_cats.values():
+        fits_cat = '{}{}'.format(filename.split('_red.fits')[0], ext)
+        if '_red.fits' in filename and isfile(fits_cat):
+            row.append(count_redflags([fits_cat], key=key))
+        else:
+            row.append(-1)
 
 
-    # full image statistics
-    index_stat = get_rand_indices(data.shape)
-    mask_use_tmp = mask_use[index_stat]
-    median = np.nanmedian(data[index_stat][mask_use_tmp])
-    std = np.nanstd(data[index_stat][mask_use_tmp])
-    # masked array (slow!)
-    #median = np.ma.median(data_masked[index_stat])
+    return row
+
+
+################################################################################
+
+def obslog_file (date_eve, tel=None):
+
+    """return name of obslog table of night [date_eve] in the local
+       folder set_bb.index_dir"""
+
+    return '{}/{}_{}_obslog.fits'.format(get_par(set_bb.index_dir,tel), tel,
+                                         date_eve)
+
+
+################################################################################
+
+def obslog_read (date_eve, tel=None):
+
+    """return obslog table of night [date_eve] as dictionary with the
+       filename as key and the row as value; empty if the table does
+       not exist yet or cannot be read"""
+
+    return read_table_dict (obslog_file (date_eve, tel=tel))
+
+
+################################################################################
+
+def obslog_update (date_eve, rows, tel=None):
+
+    """add or replace [rows] in the obslog table of night [date_eve];
+       the table is locked while it is updated, as the different
+       processes reducing the images of the night all add to it"""
+
+    def update (obslog):
+        for row in rows:
+            obslog[row[0]] = row
+
+    colnames = ['FILENAME'] + list(obslog_keys.keys()) + list(obslog_cats)
+    dtypes = [str] + list(obslog_keys.values()) + ['i2' for col in obslog_cats]
+    locked_table_update (obslog_file (date_eve, tel=tel), update, colnames,
+                         dtypes)
+
+
+################################################################################
+
+def obslog_add (filename):
+
+    """add reduced frame [filename] to the obslog table of the night it
+       was observed, which is used by [create_obslog] and avoids
+       reading the headers of all reduced frames of the night at the
+       end of the night"""
+
+    try:
+        row = obslog_row (filename)
+        __, date_eve = get_path(row[3], 'write')
+        obslog_update (date_eve, [row], tel=tel)
+
+    except Exception as e:
+        log.warning ('exception was raised while adding {} to obslog table: {}'
+                     .format(filename, e))
+
+
+################################################################################
+
+# reference index columns besides FILENAME, FIELD_ID and FILTER, with
+# the corresponding reference image header keywords and their dtypes
+refindex_keys = {'LIMMAG': float, 'R-NUSED': int, 'R-IM1': str, 'DATE': str}
+
+# per-process reference index used by [refindex_lookup]: dictionary
+# with (field ID, filter) as key and a list of rows as value, and the
+# (modification time, size) of the index file when it was loaded
+refindex = None
+refindex_stat = None
+
+
+def refindex_file (tel=None):
+
+    """return name of reference index table, which is located in the
+       reference folder set_bb.ref_dir"""
+
+    return '{}/refindex.fits'.format(get_par(set_bb.ref_dir,tel))
+
+
+################################################################################
+
+def refindex_read (tel=None):
+
+    """return reference index table as dictionary with the reference
+       image filename as key and the row as value; empty if the table
+       does not exist (yet) or cannot be read. If the table is in a
+       google cloud bucket, it is first copied to the local folder
+       set_bb.index_dir."""
+
+    return read_table_dict (refindex_file (tel=tel),
+                            tmp_dir=get_par(set_bb.index_dir,tel))
+
+
+################################################################################
+
+def refindex_update (rows, files_remove=[], tel=None):
+
+    """add or replace [rows] in the reference index table and remove
+       the rows with FILENAME in [files_remove]; the table is locked
+       while it is updated. If the table is in a google cloud bucket,
+       the lock file is in the local folder set_bb.index_dir, so
+       updates from different machines are not protected."""
+
+    def update (refs):
+        for filename in files_remove:
+            refs.pop(filename, None)
+
+        for row in rows:
+            refs[row[0]] = row
+
+    fits_refindex = refindex_file (tel=tel)
+    if fits_refindex[0:5] == 'gs://':
+        lock_dir = get_par(set_bb.index_dir,tel)
+    else:
+        lock_dir = None
+
+    colnames = ['FILENAME', 'FIELD_ID', 'FILTER'] + list(refindex_keys)
+    dtypes = [str, str, str] + list(refindex_keys.values())
+    locked_table_update (fits_refindex, update, colnames, dtypes,
+                         lock_dir=lock_dir)
+
+
+################################################################################
+
+def refindex_row (filename, header, field_ID, filt):
+
+    """return reference index row of reference image [filename] with
+       [header]"""
+
+    row = [filename, field_ID, filt]
+    for key, dtype in refindex_keys.items():
+        if key == 'DATE':
+            # creation date of the reference image as recorded in
+            # the filename
+            value = filename.split('_')[-2]
+        elif key in header and header[key] != 'None':
+            value = dtype(header[key])
+        elif dtype is float:
+            value = np.nan
+        elif dtype is int:
+            value = 0
+        else:
+            value = ''
+
+        row.append(value)
+
+
+    return row
+
+
+################################################################################
+
+def refindex_lookup (obj, filt):
+
+    """return list of dictionaries, one for each reference image of
+       field [obj] in filter [filt] listed in the reference index, with
+       keys FILENAME and the header keywords in [refindex_keys]; the
+       index is only read again by this process if the modification
+       time or size of the index file changed. None is returned if
+       there are no reference images of this field and filter in the
+       index."""
+
+    global refindex, refindex_stat
+
+    stat = get_file_stat (refindex_file (tel=tel))
+    if refindex is None or stat != refindex_stat:
+        refindex_stat = stat
+        refindex = {}
+        for row in refindex_read (tel=tel).values():
+            dict_row = {'FILENAME': row[0]}
+            for key, value in zip(refindex_keys, row[3:]):
+                # skip undefined values, so that the keyword is
+                # considered absent as in a header
+                if not (isinstance(value, float) and not np.isfinite(value)):
+                    dict_row[key] = value
+
+            refindex.setdefault((row[1], row[2]), []).append(dict_row)
+
+
+    return refindex.get((obj, filt))
+
+
+################################################################################
+
+def select_ref (list_ref, ref_rows, obj, filt):
+
+    """return name (without .fz extension) of the reference image in
+       [list_ref] of field [obj] in filter [filt] to use: the deepest
+       one according to the LIMMAG header keyword, or the most recent
+       one according to the date in the filename if the LIMMAG values
+       are not available. The LIMMAG values are taken from [ref_rows]
+       returned by [refindex_lookup] if it is not None, otherwise
+       from the reference image headers. None is returned if
+       [list_ref] is empty."""
+
+    nrefs = len(list_ref)
+    if nrefs==0:
+
+        ref_fits_in = None
+
+    # if there is a single ref image, use that one
+    elif nrefs==1:
+
+        ref_fits_in = list_ref[0].replace('.fz','')
+
+    else:
+
+        # in case of multiple ref images, select the deepest
+        # one according to the LIMMAG header keyword
+        log.info ('available reference images: {}'.format(list_ref))
+
+        try:
+
+            limmags_ref = np.zeros(nrefs)
+            for i, fits_tmp in enumerate(list_ref):
+                if ref_rows is not None:
+                    hdr_tmp = ref_rows[i]
+                else:
+                    hdr_tmp = read_header(fits_tmp)
+                if 'LIMMAG' in hdr_tmp:
+                    limmags_ref[i] = hdr_tmp['LIMMAG']
+                else:
+                    log.warning('LIMMAG keyword not present in header '
+                                'of {}'.format(fits_tmp))
+
+            if np.all(limmags_ref==0):
+                log.error('limiting magnitudes of available reference '
+                          'images for field {} in filter {} are all '
+                          'zero; reverting to using most recent one '
+                          'according to date in the filename'
+                          .format(obj, filt))
+                raise
+
+            else:
+                idx = np.argmax(limmags_ref)
+                ref_fits_in = list_ref[idx].replace('.fz','')
+
+        except:
+
+            # instead of deepest, pick the most recent one
+            ref_fits_in = sorted(list_ref)[-1].replace('.fz','')
+
+
+    return ref_fits_in
+
+
+################################################################################
+
+def send_email (recipients, subject, body,
+                attachments=None,
+                sender='Radboud GW Alert <scheduler@blackgem.org>',
+                reply_to='bg-admin@blackgem.org',
+                smtp_server='smtp-relay.gmail.com',
+                port=465, use_SSL=True):
+
+    if use_SSL:
+        smtpObj = smtplib.SMTP_SSL(smtp_server, port)
+    else:
+        smtpObj = smtplib.SMTP(smtp_server, port)
+
+    smtpObj.ehlo()
+    send_from = sender
+    send_to = recipients.split(',')
+    msg = MIMEMultipart()
+    msg['from'] = send_from
+    msg['to'] = recipients
+    msg['reply-to'] = reply_to
+    msg['date'] = formatdate(localtime=True)
+    msg['subject'] = subject
+
+    if body is None:
+        text = ''
+    elif isfile(body):
+        with open(body, 'r') as f:
+            text = f.read()
+    else:
+        text = body
+
+    msg.attach( MIMEText(text) )
+
+    if attachments is not None:
+        att_list = attachments.split(',')
+        for attachment in att_list:
+            if isfile(attachment):
+                part = MIMEBase('application', "octet-stream")
+                part.set_payload( open(attachment,"rb").read() )
+                encoders.encode_base64(part)
+                part.add_header('Content-Disposition', 'attachment; filename={}'
+                                .format(attachment.split('/')[-1]))
+                msg.attach(part)
+
+    smtpObj.sendmail(send_from, send_to, msg.as_string())
+    smtpObj.close()
+
+
+################################################################################
+
+def get_flatstats (data, header, data_mask, tel=None):
+
+
+    if get_par(set_zogy.timing,tel):
+        t = time.time()
+
+    # mask of valid pixels
+    mask_use = (data_mask == 0)
+
+
+    # add some header keywords with the statistics
+    sec_tmp = get_par(set_bb.flat_norm_sec,tel)
+    value_tmp = '[{}:{},{}:{}]'.format(
+        sec_tmp[0].start+1, sec_tmp[0].stop+1,
+        sec_tmp[1].start+1, sec_tmp[1].stop+1)
+    header['STATSEC'] = (
+        value_tmp, 'pre-defined statistics section [y1:y2,x1:x2]')
+
+
+    # statistics on STATSEC
+    mask_use_tmp = mask_use[sec_tmp]
+    median_sec = np.nanmedian(data[sec_tmp][mask_use_tmp])
+    std_sec = np.nanstd(data[sec_tmp][mask_use_tmp])
+    # using masked array (slow!)
+    #median_sec = np.ma.median(data_masked[sec_tmp])
+    #std_sec = np.ma.std(data_masked[sec_tmp])
+
+    # check if values are finite
+    median_sec = check_finite(median_sec, 'MEDSEC', 'None')
+    std_sec = check_finite(std_sec, 'STDSEC', 'None')
+    if median_sec != 'None' and std_sec != 'None':
+        ratio_sec = std_sec/median_sec
+    else:
+        ratio_sec = 'None'
+
+    header['MEDSEC'] = (median_sec, '[e-] median flat over STATSEC')
+    header['STDSEC'] = (std_sec, '[e-] sigma (STD) flat over STATSEC')
+    header['RSTDSEC'] = (ratio_sec, 'relative sigma (STD) flat over STATSEC')
+
+
+    # full image statistics
+    index_stat = get_rand_indices(data.shape)
+    mask_use_tmp = mask_use[index_stat]
+    median = np.nanmedian(data[index_stat][mask_use_tmp])
+    std = np.nanstd(data[index_stat][mask_use_tmp])
+    # masked array (slow!)
+    #median = np.ma.median(data_masked[index_stat])
     #std = np.ma.std(data_masked[index_stat])
 
     # check if values are finite
@@ -3907,12 +4979,65 @@ def make_dir (path, empty=False):
     return
 
 
+################################################################################
+
+# per-process pool with a single thread that removes or fpacks tmp
+# folders in the background, see [clean_tmp]; created on first use,
+# with the list of futures of the tasks submitted to it and the ID
+# of the process that created it
+tmp_executor = None
+tmp_futures = []
+tmp_pid = None
+
+
+def tmp_submit (func, *args):
+
+    """run [func] with [args] in the background tmp thread"""
+
+    global tmp_executor, tmp_futures, tmp_pid
+
+    # a process forked from the process that created the pool
+    # inherits it without its thread, so it creates its own
+    if tmp_executor is None or tmp_pid != os.getpid():
+        tmp_executor = ThreadPoolExecutor(max_workers=1)
+        tmp_futures = []
+        tmp_pid = os.getpid()
+
+    future = tmp_executor.submit(func, *args)
+    tmp_futures.append(future)
+
+    return future
+
+
+def tmp_wait (nkeep=0):
+
+    """wait for the tasks submitted to the background tmp thread by
+       this process to finish, except for the last [nkeep] tasks"""
+
+    if tmp_pid != os.getpid():
+        return
+
+    while len(tmp_futures) > nkeep:
+        try:
+            tmp_futures.pop(0).result()
+        except Exception as e:
+            log.warning ('exception was raised in background tmp task: {}'
+                         .format(e))
+
+
 ################################################################################
 
 def clean_tmp (tmp_path, keep_tmp):
 
     """ Function that removes the tmp folder corresponding to the
         reduced image / reference image if [set_bb.keep_tmp] not True.
+        The folder is first moved to the trash folder (see
+        [trash_dir]), which is immediate, after which it is removed in
+        a background thread, so that the next image does not need to
+        wait for it. Trash folders that are left behind, e.g. because
+        the process ended before the removal was finished, are removed
+        by [sweep_trash]. If [set_bb.keep_tmp] is True, the fits images
+        in the folder are fpacked in the background instead.
     """
 
     # check if folder exists
@@ -3921,15 +5046,19 @@ def clean_tmp (tmp_path, keep_tmp):
         # delete [tmp_path] folder if [set_bb.keep_tmp] not True
         if not keep_tmp:
             #log.info ('removing temporary folder: {}'.format(tmp_path))
-            shutil.rmtree(tmp_path, ignore_errors=True)
+            try:
+                path2remove = move2trash (tmp_path)
+            except Exception as e:
+                log.warning ('exception was raised while moving {} to trash '
+                             'folder; removing it directly: {}'
+                             .format(tmp_path, e))
+                path2remove = tmp_path
+
+            tmp_submit (remove_tmp, path2remove, tmp_path)
 
         else:
             # otherwise fpack its fits images
-            #list_2pack = glob.glob('{}/*.fits'.format(tmp_path))
-            list_2pack = list_files(tmp_path, end_str='.fits')
-
-            for filename in list_2pack:
-                fpack (filename)
+            tmp_submit (fpack_tmp, tmp_path)
 
     else:
         log.warning ('tmp folder {} does not exist'.format(tmp_path))
@@ -3938,6 +5067,113 @@ def clean_tmp (tmp_path, keep_tmp):
     return
 
 
+################################################################################
+
+def trash_dir (tel=None):
+
+    """return trash folder in set_bb.tmp_dir_base, which is on the same
+       filesystem as the tmp folders of the images"""
+
+    return '{}/trash'.format(get_par(set_bb.tmp_dir_base,tel))
+
+
+################################################################################
+
+def move2trash (path):
+
+    """move folder [path] to a uniquely named folder inside the trash
+       folder and return its new name"""
+
+    dir_trash = trash_dir (tel=tel)
+    os.makedirs(dir_trash, exist_ok=True)
+    path_trash = '{}/{}_{}_{}'.format(dir_trash, path.rstrip('/').split('/')[-1],
+                                      os.getpid(), time.time())
+    os.rename(path, path_trash)
+
+    return path_trash
+
+
+################################################################################
+
+def dir_size (path):
+
+    """return total size in bytes of the files in folder [path],
+       including its subfolders"""
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+
+    return size
+
+
+################################################################################
+
+def remove_tmp (path, tmp_path):
+
+    """remove folder [path], which was the tmp folder [tmp_path] of an
+       image, logging the disk space it used"""
+
+    try:
+        log.info ('removing tmp folder {} that used {:.2f} GB'
+                  .format(tmp_path, dir_size(path)/1024**3))
+        shutil.rmtree(path, ignore_errors=True)
+    except Exception as e:
+        log.warning ('exception was raised while removing tmp folder {}: {}'
+                     .format(path, e))
+
+
+################################################################################
+
+def fpack_tmp (tmp_path):
+
+    """fpack the fits images in folder [tmp_path]"""
+
+    try:
+        #list_2pack = glob.glob('{}/*.fits'.format(tmp_path))
+        list_2pack = list_files(tmp_path, end_str='.fits')
+
+        for filename in list_2pack:
+            fpack (filename)
+
+    except Exception as e:
+        log.warning ('exception was raised while fpacking tmp folder {}: {}'
+                     .format(tmp_path, e))
+
+
+################################################################################
+
+def sweep_trash (tel=None):
+
+    """remove folders that were left behind in the trash folder"""
+
+    dir_trash = trash_dir (tel=tel)
+    if isdir(dir_trash):
+        with os.scandir(dir_trash) as it:
+            for entry in it:
+                if entry.is_dir():
+                    shutil.rmtree(entry.path, ignore_errors=True)
+
+
+################################################################################
+
+def tmp_space_ok (tel=None):
+
+    """return True if free space on the tmp disk is at least
+       set_bb.tmp_free_min GB"""
+
+    try:
+        free = shutil.disk_usage(get_par(set_bb.tmp_dir_base,tel)).free
+    except OSError:
+        return True
+
+    return free >= get_par(set_bb.tmp_free_min,tel) * 1024**3
+
+
 ################################################################################
 
 def copy_files2keep (src_base, dest_base, ext2keep, move=True, run_fpack=True):
@@ -3945,6 +5181,12 @@ def copy_files2keep (src_base, dest_base, ext2keep, move=True, run_fpack=True):
     """Function to copy/move files with base name [src_base] and
     extensions [ext2keep] to files with base name [dest_base] with the
     same extensions. The base names should include the full path.
+
+    The files are first prepared, i.e. fpacked and their jpg created,
+    using a pool of set_bb.nthreads threads, after which they are
+    copied/moved in the order of [ext2keep]. Files that are copied to
+    a google cloud bucket with the same name are copied in one go,
+    except for the last file, which is copied last.
     """
 
     log.info ('extensions to copy (in this order): {}'.format(ext2keep))
@@ -3961,7 +5203,8 @@ def copy_files2keep (src_base, dest_base, ext2keep, move=True, run_fpack=True):
     src_files_sort = [f for ext in ext2keep for f in src_files if ext in f]
 
 
-    # loop this list
+    # list of (src_file, dest_file) to process
+    files2process = []
     for src_file in src_files_sort:
         # determine file string following [src_base]
         src_ext = src_file.split(src_base)[-1]
@@ -3972,127 +5215,210 @@ def copy_files2keep (src_base, dest_base, ext2keep, move=True, run_fpack=True):
                 # if so, and the source and destination names are not
                 # identical, go ahead and copy
                 if src_file != dest_file:
+                    files2process.append((src_file, dest_file))
+
+
+
+    def prep_file (src_file, dest_file):
+
+        # if the data of an unpacked src_file image is the same as
+        # the data of the fpacked dest_file image, then only modify
+        # the destination file header with that of the src_file to
+        # avoid unnecessary funpacking and fpacking
+        skip = False
+        dest_file_fz = '{}.fz'.format(dest_file)
+        if (src_file.split('.')[-1] == 'fits'
+            and '_ldac.fits' not in src_file
+            and isfile(dest_file_fz)
+            # in Google cloud, do not execute the block
+            # below: not possible to only update the
+            # header of a file in a bucket
+            and dest_file[0:5] != 'gs://'):
+
+
+            # read src_file data and header
+            data_src, header_src = read_hdulist(src_file, get_header=True)
+
+            # check if src_file is an image
+            if int(header_src['NAXIS'])==2:
+
+                # compare the checksum of the data with the DATASUM
+                # recorded in the header of dest_file_fz by
+                # [write_fpack] when it was written, instead of
+                # reading and comparing the data of dest_file_fz
+                header_dest = read_hdulist(dest_file_fz, get_data=False,
+                                           get_header=True)
+                if ('DATASUM' in header_dest and
+                    header_dest['DATASUM'] == data_sum(data_src)):
+
+                    # skip copying/moving below
+                    skip = True
+
+                    log.info ('existing image {} contains same data as {}; '
+                              'skipping copy/move'.format(dest_file_fz,
+                                                          src_file))
+
+                    exts_keephead = [
+                        '_red.fits', '_red_limmag.fits', '_D.fits',
+                        '_Scorr.fits', '_trans_limmag.fits',
+                        '_Fpsf.fits']
+
+                    for ext_tmp in exts_keephead:
+
+                        if ext_tmp in dest_file:
+                            # for various images, update header of
+                            # already existing destination file with
+                            # that of src_file; header file does not
+                            # need to be updated - already done if
+                            # properly processed by zogy
+                            log.info ('updating fits header of {}'
+                                      .format(dest_file_fz))
+                            # keep the DATASUM of dest_file_fz, which
+                            # still applies as the data are the same
+                            header_src['DATASUM'] = (
+                                header_dest['DATASUM'], 'data unit checksum')
+                            update_imcathead (dest_file_fz, header_src)
+
+                else:
+                    log.info ('data of existing image {} is different from '
+                              'that of {}'.format(dest_file_fz, src_file))
+
+
+        src_file_jpg = None
+        if run_fpack:
+            # fpack src_file if needed
+            src_file = fpack (src_file)
+
+            # add '.fz' extension to [dest_file] in case [src_file]
+            # was fpacked (not all files are fpacked)
+            if '.fz' in src_file and '.fz' not in dest_file:
+                dest_file = '{}.fz'.format(dest_file)
+
+            # create a jpg image of [src_file] now that files are
+            # being copied from tmp to red or ref and not vice versa,
+            # and file is reduced, D or Scorr image
+            if ('_red.fits' in src_file or '_D.fits' in src_file or
+                '_Scorr.fits' in src_file):
+                src_file_jpg = create_jpg (src_file)
+
+
+        return src_file, dest_file, skip, src_file_jpg
+
+
+
+    # prepare files using a pool of threads
+    files_prep = map_threads (lambda f: prep_file(*f), files2process,
+                              nthreads=set_bb.nthreads)
+
+
+
+    # list of (src_file, dest_file, move) to copy or move in this
+    # order
+    files2copy = []
+    for src_file, dest_file, skip, src_file_jpg in files_prep:
+
+        # copy/move the jpg over to the destination folder
+        if src_file_jpg is not None:
+            dest_file_jpg = '{}.jpg'.format(dest_file.split('.fits')[0])
+            files2copy.append((src_file_jpg, dest_file_jpg, move))
+
+
+        # remove the potentially existing f/unpacked counterparts of
+        # [dest_file] already present in the destination folder for
+        # some reason, to avoid that both the unpacked and packed file
+        # will be present in the destination folder
+        if '.fz' in dest_file:
+            file_2remove = dest_file.split('.fz')[0]
+        else:
+            file_2remove = '{}.fz'.format(dest_file)
+
+        if isfile(file_2remove):
+            #log.info('removing existing {}'.format(file_2remove))
+            #os.remove(file_2remove)
+            remove_files ([file_2remove], verbose=True)
+
+
+        # move or copy file if it does not need to be skipped
+        if not skip:
+            if 'log' in src_file:
+                # copy logfile as it is still being used
+                files2copy.append((src_file, dest_file, False))
+            else:
+                files2copy.append((src_file, dest_file, move))
+
+
+
+    # copy or move files; consecutive files that are copied to a
+    # bucket with the same name and the same [move] are copied with a
+    # single call to [copy_flist], except for the last file
+    i_file = 0
+    while i_file < len(files2copy):
+
+        src_file, dest_file, move_file = files2copy[i_file]
+        dest_folder = os.path.dirname(dest_file)
+
+        # collect batch
+        batch = [src_file]
+        if (dest_file[0:5] == 'gs://' and
+            os.path.basename(dest_file) == os.path.basename(src_file)):
+
+            for src_tmp, dest_tmp, move_tmp in files2copy[i_file+1:-1]:
+                if (move_tmp != move_file or
+                    os.path.dirname(dest_tmp) != dest_folder or
+                    os.path.basename(dest_tmp) != os.path.basename(src_tmp)):
+                    break
+
+                batch.append(src_tmp)
+
+
+        if len(batch) > 1:
+            copy_flist (batch, dest_folder+'/', move=move_file)
+        else:
+            copy_file (src_file, dest_file, move=move_file)
+
+        i_file += len(batch)
+
+
+
+    return
+
 
+################################################################################
 
-                    # if the data of an unpacked src_file image is the
-                    # same as the data of the fpacked dest_file image,
-                    # then only modify the destination file header
-                    # with that of the src_file to avoid unnecessary
-                    # funpacking and fpacking
-                    skip = False
-                    dest_file_fz = '{}.fz'.format(dest_file)
-                    if (src_file.split('.')[-1] == 'fits'
-                        and '_ldac.fits' not in src_file
-                        and isfile(dest_file_fz)
-                        # in Google cloud, do not execute the block
-                        # below: not possible to only update the
-                        # header of a file in a bucket
-                        and dest_file[0:5] != 'gs://'):
-
-
-                        # read src_file data and header
-                        data_src, header_src = read_hdulist(src_file,
-                                                            get_header=True)
-
-                        # check if src_file is an image
-                        if int(header_src['NAXIS'])==2:
-
-                            # read dest_file data
-                            data_dest = read_hdulist(dest_file_fz)
-
-                            # compare data arrays; this comparison is
-                            # done before fpacking src_file, so data
-                            # arrays should be very close if
-                            # destination file was already fully
-                            # reduced; still, allow for absolute
-                            # difference of 1e- between the data sets
-                            if np.allclose(data_src, data_dest, atol=1):
-
-                                # skip copying/moving below
-                                skip = True
-
-                                log.info ('existing image {} contains same data '
-                                          'as {}; skipping copy/move'
-                                          .format(dest_file_fz, src_file))
-
-                                exts_keephead = [
-                                    '_red.fits', '_red_limmag.fits', '_D.fits',
-                                    '_Scorr.fits', '_trans_limmag.fits',
-                                    '_Fpsf.fits']
-
-                                for ext_tmp in exts_keephead:
-
-                                    if ext_tmp in dest_file:
-                                        # for various images, update
-                                        # header of already existing
-                                        # destination file with that
-                                        # of src_file; header file
-                                        # does not need to be updated
-                                        # - already done if properly
-                                        # processed by zogy
-                                        log.info ('updating fits header of {}'
-                                                  .format(dest_file_fz))
-                                        update_imcathead (dest_file_fz, header_src)
-
-                            else:
-                                log.info ('data of existing image {} is '
-                                          'significantly different from that of '
-                                          '{}'.format(dest_file_fz, src_file))
-
-
-                    if run_fpack:
-                        # fpack src_file if needed
-                        src_file = fpack (src_file)
-
-                        # add '.fz' extension to [dest_file] in case
-                        # [src_file] was fpacked (not all files are
-                        # fpacked)
-                        if '.fz' in src_file and '.fz' not in dest_file:
-                            dest_file = '{}.fz'.format(dest_file)
-
-                        # create a jpg image of [src_file] now that
-                        # files are being copied from tmp to red or
-                        # ref and not vice versa, and file is reduced,
-                        # D or Scorr image
-                        if ('_red.fits' in src_file or '_D.fits' in src_file or
-                            '_Scorr.fits' in src_file):
-                            src_file_jpg = create_jpg (src_file)
-                            # copy/move it over to the destination folder
-                            #dest_folder = os.path.dirname(dest_file)
-                            #copy_file (src_file_jpg, dest_folder+'/', move=move)
-                            dest_file_jpg = '{}.jpg'.format(
-                                dest_file.split('.fits')[0])
-                            copy_file (src_file_jpg, dest_file_jpg, move=move)
-
-
-
-                    # remove the potentially existing f/unpacked
-                    # counterparts of [dest_file] already present in
-                    # the destination folder for some reason, to avoid
-                    # that both the unpacked and packed file will be
-                    # present in the destination folder
-                    if '.fz' in dest_file:
-                        file_2remove = dest_file.split('.fz')[0]
-                    else:
-                        file_2remove = '{}.fz'.format(dest_file)
+# per-process ASTA instances used by [run_asta], with the model file
+# as key, so that each process loads the model only once
+asta_cache = {}
 
-                    if isfile(file_2remove):
-                        #log.info('removing existing {}'.format(file_2remove))
-                        #os.remove(file_2remove)
-                        remove_files ([file_2remove], verbose=True)
 
+def get_asta (asta_model):
 
-                    # move or copy file if it does not need to be skipped
-                    if not skip:
-                        if 'log' in src_file:
-                            # copy logfile as it is still being used
-                            copy_file (src_file, dest_file, move=False)
-                        else:
-                            copy_file (src_file, dest_file, move=move)
+    """return ASTA instance for [asta_model], loading the model on
+       the first call"""
 
+    if asta_model not in asta_cache:
+        log.info ('loading ASTA model {}'.format(asta_model))
+        asta_cache[asta_model] = ASTA(asta_model)
 
+    return asta_cache[asta_model]
 
-    return
+
+################################################################################
+
+def mask_unbin (data_mask, mask_binned, nbin, value):
+
+    """add [value] to the pixels of [data_mask] covered by the binned
+       boolean mask [mask_binned], where each binned pixel corresponds
+       to [nbin] x [nbin] pixels of [data_mask]; this is done through
+       a reshaped view of [data_mask] and broadcasting, so that the
+       unbinned mask is not created"""
+
+    if nbin == 1:
+        data_mask[mask_binned] |= value
+    else:
+        ny, nx = np.shape(mask_binned)
+        data_mask_view = data_mask.reshape(ny, nbin, nx, nbin)
+        data_mask_view |= np.where(mask_binned, value, 0).astype(
+            data_mask.dtype)[:,None,:,None]
 
 
 ################################################################################
@@ -4120,31 +5446,23 @@ def run_asta (data, header, data_mask, header_mask, tmp_path):
 
 
     asta_model = get_par(set_bb.asta_model,tel)
-    processor = ASTA(asta_model)
+    processor = get_asta (asta_model)
     #mask_sat, __, __ = processor.process_image(fits_tmp)
     mask_sat_binned, results_df, __, __ = processor.process_image(
         data_binned, header, area_threshold=int(3000/nbin**2),
         min_size=int(500/nbin**2))
 
-    #unbin mask
-    if nbin == 1:
-        mask_sat = mask_sat_binned
-    else:
-        mask_sat = np.kron(
-            mask_sat_binned, np.ones((nbin, nbin))).astype(np.uint8)
-
-
     # add pixels affected by satellite trails to [data_mask]
-    data_mask[mask_sat==1] |= get_par(set_zogy.mask_value['satellite trail'],
-                                      tel)
-    #nsatpixels = np.sum(mask_sat)
+    mask_unbin (data_mask, (mask_sat_binned==1), nbin,
+                get_par(set_zogy.mask_value['satellite trail'],tel))
+    #nsatpixels = np.sum(mask_sat_binned) * nbin**2
 
 
     # determining number of trails; 2 pixels are considered from the
     # same trail also if they are only connected diagonally
     if False:
         struct = np.ones((3,3), dtype=bool)
-        __, nsats = ndimage.label(mask_sat, structure=struct)
+        __, nsats = ndimage.label(mask_sat_binned, structure=struct)
     else:
         # alternatively, just count number of rows in results_df
         nsats = len(results_df)
@@ -4168,10 +5486,69 @@ def run_asta (data, header, data_mask, header_mask, tmp_path):
     return data_mask
 
 
+################################################################################
+
+def fits_memory (data):
+
+    """return in-memory fits file (io.BytesIO object) with [data] in
+       the primary extension, which can be read with fits.getdata like
+       a fits file on disk"""
+
+    f_mem = io.BytesIO()
+    fits.PrimaryHDU(data).writeto(f_mem)
+    f_mem.seek(0)
+
+    return f_mem
+
+
+################################################################################
+
+def detsat_array (data, fits_tmp, sigma=3, h_thresh=0.2, buf=40):
+
+    """Function to detect satellite trails in [data] with the Hough
+       transform based algorithm of acstools.satdet.detsat, without
+       writing [data] to disk: the array is provided to detsat's
+       single-image function as an in-memory fits file. That function
+       is not part of the public acstools interface, so if it is not
+       available, [data] is written to [fits_tmp] and the public
+       [detsat] is used instead. Returns the array of trail segments;
+       an exception is raised if the detection fails.
+
+    """
+
+    try:
+        from acstools.satdet import _detsat_one
+    except ImportError:
+        _detsat_one = None
+
+
+    if _detsat_one is not None:
+        return _detsat_one(fits_memory(data), 0, sigma=sigma,
+                           h_thresh=h_thresh, buf=buf, plot=False,
+                           verbose=False)
+
+    else:
+        fits.writeto(fits_tmp, data, overwrite=True)
+        results, errors = detsat(fits_tmp, chips=[0], n_processes=1, buf=buf,
+                                 sigma=sigma, h_thresh=h_thresh, plot=False,
+                                 verbose=False)
+        if len(errors) != 0:
+            raise RuntimeError ('detsat errors: {}'.format(errors))
+
+        return results[(fits_tmp, 0)]
+
+
 ################################################################################
 
 def sat_detect (data, header, data_mask, header_mask, tmp_path, nbin=2):
 
+    """Function to detect satellite trails in [data] binned by [nbin]
+       using [detsat_array] and acstools' [make_mask], which are
+       provided with the binned data in memory. The pixels affected
+       are added to [data_mask].
+
+    """
+
     # could also try skimage.transform.probabilistic_hough_line()
 
     if get_par(set_zogy.timing,tel):
@@ -4181,37 +5558,29 @@ def sat_detect (data, header, data_mask, header_mask, tmp_path, nbin=2):
     binned_data = data.reshape(np.shape(data)[0] // nbin, nbin,
                                np.shape(data)[1] // nbin, nbin).sum(3).sum(1)
     satellite_fitting = False
+    mask_old = None
 
     for j in range(1):
-        #write binned data to tmp file
-        fits_binned_mask = ('{}/{}'.format(
-            tmp_path, tmp_path.split('/')[-1].replace('_red',
-                                                      '_binned_satmask.fits')))
-        fits.writeto(fits_binned_mask, binned_data, overwrite=True)
         #detect satellite trails
         try:
-            results, errors = detsat(fits_binned_mask, chips=[0],
-                                     n_processes=1, buf=40, sigma=3,
-                                     h_thresh=0.2, plot=False, verbose=False)
+            fits_binned_mask = ('{}/{}'.format(
+                tmp_path, tmp_path.split('/')[-1].replace(
+                    '_red', '_binned_satmask.fits')))
+            trail_coords = detsat_array(binned_data, fits_binned_mask,
+                                        sigma=3, h_thresh=0.2, buf=40)
         except Exception as e:
             log.exception('exception was raised during [detsat]: {}'.format(e))
             # raise exception
             raise RuntimeError ('problem with running detsat module')
-        else:
-            # also raise exception if detsat module returns errors
-            if len(errors) != 0:
-                log.error('detsat errors: {}'.format(errors))
-                raise RuntimeError ('problem with running detsat module')
 
-        #create satellite trail if found
-        trail_coords = results[(fits_binned_mask,0)]
         #continue if satellite trail found
         if len(trail_coords) > 0:
             trail_segment = trail_coords[0]
             try:
                 #create satellite trail mask
-                mask_binned = make_mask(fits_binned_mask, 0, trail_segment,
-                                        sublen=5, pad=0, sigma=5).astype('uint8')
+                mask_binned = make_mask(fits_memory(binned_data), 0,
+                                        trail_segment, sublen=5, pad=0,
+                                        sigma=5).astype('uint8')
             except ValueError:
                 #if error occurs, add comment
                 log.exception ('satellite trail found but could not be '
@@ -4221,26 +5590,22 @@ def sat_detect (data, header, data_mask, header_mask, tmp_path, nbin=2):
 
             satellite_fitting = True
             binned_data[mask_binned == 1] = np.median(binned_data)
-            fits_old_mask = '{}/old_mask.fits'.format(tmp_path)
-            if isfile(fits_old_mask):
-                old_mask = read_hdulist(fits_old_mask)
-                mask_binned = old_mask+mask_binned
-            fits.writeto(fits_old_mask, mask_binned, overwrite=True)
+            if mask_old is not None:
+                mask_binned = mask_old+mask_binned
+            mask_old = mask_binned
         else:
             break
 
     if satellite_fitting == True:
-        #unbin mask
-        mask_sat = np.kron(
-            mask_binned, np.ones((nbin, nbin))).astype(np.uint8)
         # add pixels affected by satellite trails to [data_mask]
-        data_mask[mask_sat==1] |= get_par(set_zogy.mask_value['satellite trail'],
-                                          tel)
+        mask_unbin (data_mask, (mask_binned==1), nbin,
+                    get_par(set_zogy.mask_value['satellite trail'],tel))
         # determining number of trails; 2 pixels are considered from the
-        # same trail also if they are only connected diagonally
+        # same trail also if they are only connected diagonally, which
+        # is the same in the binned and unbinned mask
         struct = np.ones((3,3), dtype=bool)
-        __, nsats = ndimage.label(mask_sat, structure=struct)
-        nsatpixels = np.sum(mask_sat)
+        __, nsats = ndimage.label(mask_binned, structure=struct)
+        nsatpixels = np.sum(mask_binned) * nbin**2
     else:
         nsats = 0
         nsatpixels = 0
@@ -4251,13 +5616,6 @@ def sat_detect (data, header, data_mask, header_mask, tmp_path, nbin=2):
     log.info('number of satellite trails identified: {}'.format(nsats))
 
 
-    # remove file(s) if not keeping intermediate/temporary files
-    if not get_par(set_bb.keep_tmp,tel):
-        remove_files ([fits_binned_mask])
-        if 'fits_old_mask' in locals():
-            remove_files ([fits_old_mask])
-
-
     if get_par(set_zogy.timing,tel):
         log_timing_memory (t0=t, label='in sat_detect')
 
@@ -4266,7 +5624,20 @@ def sat_detect (data, header, data_mask, header_mask, tmp_path, nbin=2):
 
 ################################################################################
 
-def cosmics_corr (data, header, data_mask, header_mask):
+def cosmics_corr (data, header, data_mask, header_mask, halo=64,
+                  nthreads=1):
+
+    """Function to detect and clean the cosmic rays in [data] with
+       astroscrappy and to add them to [data_mask]. The image is
+       processed in tiles, i.e. the reduced data sections of the
+       channels, each extended with a border of [halo] pixels so that
+       the cosmics detected and the cleaned pixels inside the channel
+       are not affected by the tile edges. The tiles are processed by
+       a pool of [nthreads] threads. The cosmics are counted per tile
+       and the ones that cross the tile boundaries are joined with
+       function [count_tiles].
+
+    """
 
     if get_par(set_zogy.timing,tel):
         t = time.time()
@@ -4284,65 +5655,105 @@ def cosmics_corr (data, header, data_mask, header_mask):
 
     # determine reduced data sections
     __, __, __, __, data_sec_red = define_sections(np.shape(data), tel=tel)
+    ysize, xsize = np.shape(data)
 
 
-    if False:
+    # pixels excluded from the detection are determined before any
+    # cosmics are added to [data_mask]
+    inmask = (data_mask!=0)
+    value_cr = get_par(set_zogy.mask_value['cosmic ray'],tel)
 
-        # when using 1.0.9+ version of astroscrappy:
+    # cleaned data, filled in tile by tile
+    data_out = np.empty(np.shape(data), dtype='float32')
 
-        # create readnoise image to use
-        data_rdnoise2 = np.zeros_like (data)
+    # 2 pixels are considered from the same cosmic also if they are
+    # only connected diagonally
+    struct = np.ones((3,3), dtype=bool)
 
 
-        # loop channels
-        nchans = np.shape(data_sec_red)[0]
-        for i_chan in range(nchans):
+    def detect_tile (i_chan):
 
-            # channel section
-            sec_tmp = data_sec_red[i_chan]
+        # channel section and the tile section including the halo
+        sec_tmp = data_sec_red[i_chan]
+        y0, y1 = sec_tmp[0].start, sec_tmp[0].stop
+        x0, x1 = sec_tmp[1].start, sec_tmp[1].stop
+        y0h, y1h = max(y0-halo, 0), min(y1+halo, ysize)
+        x0h, x1h = max(x0-halo, 0), min(x1+halo, xsize)
+        sec_halo = (slice(y0h,y1h), slice(x0h,x1h))
+        # channel section within the tile
+        sec_core = (slice(y0-y0h,y1-y0h), slice(x0-x0h,x1-x0h))
+
+
+        if False:
+
+            # when using 1.0.9+ version of astroscrappy:
+
+            # create readnoise image to use
+            data_rdnoise2 = np.zeros_like (data[sec_halo])
 
             rdn_str = 'RDN{}'.format(i_chan+1)
             if rdn_str not in header:
                 log.error ('keyword {} expected but not present in header'
                            .format(rdn_str))
             else:
-                data_rdnoise2[sec_tmp] = header[rdn_str]**2
+                data_rdnoise2[:] = header[rdn_str]**2
 
 
-        # add Poisson noise
-        data_var = data_rdnoise2 + data
+            # add Poisson noise
+            data_var = data_rdnoise2 + data[sec_halo]
 
-        mask_cr, data = astroscrappy.detect_cosmics(
-            data, inmask=(data_mask!=0), invar=data_var,
-            sigclip=get_par(set_bb.sigclip,tel),
-            sigfrac=get_par(set_bb.sigfrac,tel),
-            objlim=get_par(set_bb.objlim,tel),
-            niter=get_par(set_bb.niter,tel),
-            satlevel=satlevel_electrons,
-            cleantype='medmask',
-            #fsmode='convolve', psfmodel='gauss', psffwhm=4.5, psfsize=7,
-            sepmed=get_par(set_bb.sepmed,tel))
+            mask_cr, data_tile = astroscrappy.detect_cosmics(
+                data[sec_halo], inmask=inmask[sec_halo], invar=data_var,
+                sigclip=get_par(set_bb.sigclip,tel),
+                sigfrac=get_par(set_bb.sigfrac,tel),
+                objlim=get_par(set_bb.objlim,tel),
+                niter=get_par(set_bb.niter,tel),
+                satlevel=satlevel_electrons,
+                cleantype='medmask',
+                #fsmode='convolve', psfmodel='gauss', psffwhm=4.5, psfsize=7,
+                sepmed=get_par(set_bb.sepmed,tel))
 
 
-    else:
+        else:
+
+            # when using 1.0.8 version of astroscrappy:
+
+            readnoise = header['RDNOISE']
+
+            mask_cr, data_tile = astroscrappy.detect_cosmics(
+                data[sec_halo], inmask=inmask[sec_halo],
+                sigclip=get_par(set_bb.sigclip,tel),
+                sigfrac=get_par(set_bb.sigfrac,tel),
+                objlim=get_par(set_bb.objlim,tel),
+                niter=get_par(set_bb.niter,tel),
+                readnoise=readnoise, gain=1.0,
+                satlevel=satlevel_electrons,
+                cleantype='medmask',
+                sepmed=get_par(set_bb.sepmed,tel))
+
+
+        # save channel section of cleaned data and add pixels
+        # affected by cosmic rays to [data_mask]
+        data_out[sec_tmp] = data_tile[sec_core]
+        mask_cr = mask_cr[sec_core]
+        data_mask[sec_tmp][mask_cr] |= value_cr
+
 
-        # when using 1.0.8 version of astroscrappy:
+        # label cosmics in this tile and return the tile edges of
+        # the label image
+        labels, ncosmics_tile = ndimage.label(mask_cr, structure=struct)
+        edges = (labels[0,:].copy(), labels[-1,:].copy(),
+                 labels[:,0].copy(), labels[:,-1].copy())
 
-        readnoise = header['RDNOISE']
 
-        mask_cr, data = astroscrappy.detect_cosmics(
-            data, inmask=(data_mask!=0),
-            sigclip=get_par(set_bb.sigclip,tel),
-            sigfrac=get_par(set_bb.sigfrac,tel),
-            objlim=get_par(set_bb.objlim,tel),
-            niter=get_par(set_bb.niter,tel),
-            readnoise=readnoise, gain=1.0,
-            satlevel=satlevel_electrons,
-            cleantype='medmask',
-            sepmed=get_par(set_bb.sepmed,tel))
+        return (y0, y1, x0, x1), ncosmics_tile, edges
 
 
 
+    nchans = np.shape(data_sec_red)[0]
+    tiles = map_threads (detect_tile, range(nchans), nthreads=nthreads)
+
+
     mem_use (label='in cosmics_corr just after astroscrappy')
 
     # from astroscrappy 'manual': To reproduce the most similar
@@ -4355,14 +5766,9 @@ def cosmics_corr (data, header, data_mask, header_mask):
     #    niter=get_par(set_bb.niter,tel),
     #    readnoise=header['RDNOISE'], satlevel=np.inf)
 
-    # add pixels affected by cosmic rays to [data_mask]
-    data_mask[mask_cr==1] |= get_par(set_zogy.mask_value['cosmic ray'],tel)
-
 
-    # determining number of cosmics; 2 pixels are considered from the
-    # same cosmic also if they are only connected diagonally
-    struct = np.ones((3,3), dtype=bool)
-    __, ncosmics = ndimage.label(mask_cr, structure=struct)
+    # determining number of cosmics
+    ncosmics = count_tiles (tiles)
     ncosmics_persec = ncosmics / float(header['EXPTIME'])
     header['NCOSMICS'] = (ncosmics_persec,
                           '[/s] number of cosmic rays identified')
@@ -4377,29 +5783,153 @@ def cosmics_corr (data, header, data_mask, header_mask):
         log_timing_memory (t0=t, label='in cosmics_corr')
 
 
-    return data, data_mask
+    return data_out, data_mask
 
 
 ################################################################################
 
-def mask_init (data, header, filt, imgtype):
+def count_tiles (tiles):
 
-    """Function to create initial mask from the bad pixel mask (defining
-       the bad and edge pixels), and pixels that are saturated and
-       pixels connected to saturated pixels.
+    """Function to count the connected objects in an image that was
+       labelled in separate tiles. [tiles] is a list with for each
+       tile a tuple ((y0, y1, x0, x1), nobj, edges), with (y0, y1,
+       x0, x1) the tile position in the image, nobj the number of
+       objects in the tile and edges a tuple with the labels in the
+       first (y0) and last (y1-1) row and the first (x0) and last
+       (x1-1) column of the tile. Objects in adjacent tiles that touch
+       each other, also diagonally, are joined with a union-find and
+       counted once.
 
     """
 
-    if get_par(set_zogy.timing,tel):
-        t = time.time()
+    # offset of labels of each tile, so that labels are unique
+    offsets = np.cumsum([0] + [nobj for __, nobj, __ in tiles])
+
+    parent = {}
+    def find (label):
+        while parent.get(label, label) != label:
+            label = parent[label]
+        return label
+
+
+    # pairs of labels of adjacent tiles that are connected
+    pairs = []
+    for i, ((y0a, y1a, x0a, x1a), __, edges_a) in enumerate(tiles):
+        for j, ((y0b, y1b, x0b, x1b), __, edges_b) in enumerate(tiles):
+
+            if x1a == x0b:
+                # tile b is to the right of tile a: compare right
+                # column of a with left column of b, shifted by -1, 0
+                # and 1 pixel
+                pos0a, pos1a, pos0b, pos1b = y0a, y1a, y0b, y1b
+                labels_a, labels_b = edges_a[3], edges_b[2]
+            elif y1a == y0b:
+                # tile b follows tile a in y: compare last row of a
+                # with first row of b
+                pos0a, pos1a, pos0b, pos1b = x0a, x1a, x0b, x1b
+                labels_a, labels_b = edges_a[1], edges_b[0]
+            else:
+                continue
+
+            for d in [-1, 0, 1]:
+                p0 = max(pos0a, pos0b-d)
+                p1 = min(pos1a, pos1b-d)
+                if p1 <= p0:
+                    continue
+
+                la = labels_a[p0-pos0a:p1-pos0a]
+                lb = labels_b[p0+d-pos0b:p1+d-pos0b]
+                mask = (la > 0) & (lb > 0)
+                if np.any(mask):
+                    pairs.append(np.stack([la[mask] + offsets[i],
+                                           lb[mask] + offsets[j]], axis=1))
+
+
+    # join connected objects
+    nmerge = 0
+    if pairs:
+        for la, lb in np.unique(np.concatenate(pairs), axis=0):
+            root_a, root_b = find(la), find(lb)
+            if root_a != root_b:
+                parent[root_a] = root_b
+                nmerge += 1
+
+
+    return offsets[-1] - nmerge
+
+
+################################################################################
+
+# per-process cache of bad pixel masks used by [read_bpm], with keys
+# (filename, modification time, size) and values the read-only mask
+bpm_cache = collections.OrderedDict()
+
+
+def read_bpm (filt, tel=None):
+
+    """return tuple (filename, data) of the bad pixel mask
+       set_bb.bad_pixel_mask for filter [filt], where data is None if
+       the mask does not exist. The set_bb.bpm_cache_size most
+       recently used masks are kept in memory by this process, and a
+       mask is read again if its file has changed. N.B.: the data
+       returned is read-only and shared between calls.
+
+    """
 
     fits_bpm = (get_par(set_bb.bad_pixel_mask,tel)
                 .replace('bpm', 'bpm_{}'.format(filt)))
 
     bpm_present, fits_bpm = already_exists (fits_bpm, get_filename=True)
-    if bpm_present:
-        # if it exists, read it
-        data_mask = read_hdulist(fits_bpm, dtype='uint8')
+    if not bpm_present:
+        return fits_bpm, None
+
+
+    mtime, size = get_file_stat (fits_bpm)
+    key = (fits_bpm, mtime, size)
+
+    if key in bpm_cache:
+        bpm_cache.move_to_end(key)
+        return fits_bpm, bpm_cache[key]
+
+
+    data_bpm = read_hdulist(fits_bpm, dtype='uint8')
+    data_bpm.flags.writeable = False
+
+    # remove outdated version(s) of this mask and the least recently
+    # used masks if the cache is full
+    for key_old in [k for k in bpm_cache if k[0] == fits_bpm]:
+        del bpm_cache[key_old]
+
+    cache_size = get_par(set_bb.bpm_cache_size,tel)
+    if cache_size > 0:
+        bpm_cache[key] = data_bpm
+        while len(bpm_cache) > cache_size:
+            bpm_cache.popitem(last=False)
+
+
+    return fits_bpm, data_bpm
+
+
+################################################################################
+
+def mask_init (data, header, filt, imgtype, mask_sat=None):
+
+    """Function to create initial mask from the bad pixel mask (defining
+       the bad and edge pixels), and pixels that are saturated and
+       pixels connected to saturated pixels. If the boolean mask of
+       saturated pixels [mask_sat] is provided, e.g. as determined by
+       [calib_corr] before the master flat division, it is used
+       instead of comparing [data] with the saturation levels.
+
+    """
+
+    if get_par(set_zogy.timing,tel):
+        t = time.time()
+
+    fits_bpm, data_bpm = read_bpm (filt, tel=tel)
+    if data_bpm is not None:
+        # if it exists, use a copy of it
+        data_mask = data_bpm.copy()
         log.info ('using bad pixel mask {}'.format(fits_bpm))
     else:
         # if not, create uint8 array of zeros with same shape as
@@ -4414,7 +5944,9 @@ def mask_init (data, header, filt, imgtype):
 
     if imgtype == 'object':
 
-        # mask of pixels with non-finite values in [data]
+        # mask of pixels with non-finite values in [data], which
+        # includes those resulting from the master flat division in
+        # [calib_corr]
         mask_infnan = ~np.isfinite(data)
         # replace those pixel values with zeros
         data[mask_infnan] = 0
@@ -4424,26 +5956,6 @@ def mask_init (data, header, filt, imgtype):
         data_mask[(mask_infnan) & (data_mask==0)] |= mask_value['bad']
 
 
-        if False:
-
-            # old block to identify saturated pixels, where
-            # set_bb.satlevel was an image-average number; saturation
-            # level (ADU) is taken from blackbox settings file, which
-            # needs to be multiplied by the gain and have the mean
-            # biaslevel subtracted
-            satlevel_electrons = (np.array(get_par(set_bb.satlevel,tel)) *
-                                  np.min(get_par(set_bb.gain,tel))
-                                  - header['BIASMEAN'])
-            mask_sat = (data >= satlevel_electrons)
-
-
-            header_mask['SATURATE'] = (satlevel_electrons, '[e-] adopted '
-                                       'saturation threshold')
-            header['SATURATE'] = (satlevel_electrons, '[e-] adopted '
-                                  'saturation threshold')
-
-
-
         # to use starting from August 2024: channel-specific
         # saturation levels
 
@@ -4454,14 +5966,8 @@ def mask_init (data, header, filt, imgtype):
         nchans = np.shape(data_sec_red)[0]
 
 
-        # determine saturated pixels for each channel separately
-        biaslevel_chans = np.array([header['BIASM{}'.format(i_chan+1)]
-                                    for i_chan in range(nchans)])
-
         # array of satlevels in e- for different channels
-        satlevel_chans = (np.array(get_par(set_bb.satlevel,tel)) *
-                          np.array(get_par(set_bb.gain,tel))
-                          - biaslevel_chans)
+        satlevel_chans = get_satlevels (header, nchans)
 
 
         # add mean saturation level to both header and header_mask;
@@ -4476,7 +5982,11 @@ def mask_init (data, header, filt, imgtype):
         # initialize full-image mask of saturated pixels, needed
         # also for further down below to identify
         # saturation-connected pixels
-        mask_sat = np.zeros_like(data, dtype=bool)
+        if mask_sat is None:
+            mask_sat_input = False
+            mask_sat = np.zeros_like(data, dtype=bool)
+        else:
+            mask_sat_input = True
 
 
         # loop channels
@@ -4494,140 +6004,564 @@ def mask_init (data, header, filt, imgtype):
             header_mask[key] = (round(satlevel_chan,1), descr)
 
 
-            # based on saturated pixels in current channel, define
-            # pixels in other (victim) channels that are most affected
-            # by high pixel values in this (source) channel due to
-            # crosstalk
+            # add saturated pixels in current channel to full-image
+            # saturation mask
+            if not mask_sat_input:
+                chan_sec = data_sec_red[i_chan]
+                mask_sat[chan_sec] = (data[chan_sec] >= satlevel_chan)
+
+
+
+        # based on saturated pixels in the (source) channels, define
+        # pixels in other (victim) channels that are most affected by
+        # high pixel values in the source channels due to crosstalk;
+        # source channels in the same row as the victim affect the
+        # same pixel positions, while those in the other row affect
+        # the positions flipped in y. Instead of adding each source
+        # channel to each victim channel, the number of saturated
+        # source channels at each pixel position is determined for
+        # each row of channels once
+        nchans_row = 8
+        nrows_chan = nchans // nchans_row
+        nsat_rows = []
+        for row in range(nrows_chan):
+            nsat_row = np.zeros(np.shape(mask_sat[data_sec_red[0]]),
+                                dtype='uint8')
+            for i_chan in range(row*nchans_row, (row+1)*nchans_row):
+                nsat_row += mask_sat[data_sec_red[i_chan]]
+
+            nsat_rows.append(nsat_row)
+
+
+        # loop victim channels
+        for i_victim in range(nchans):
+
+            # victim channel image section
+            chan_sec_victim = data_sec_red[i_victim]
+
+            # row of victim channel
+            row_victim = i_victim // nchans_row
+
+            # saturated pixels in the other channels of the same row,
+            # i.e. excluding the victim channel itself
+            mask_xtalk = (nsat_rows[row_victim] >
+                          mask_sat[chan_sec_victim])
+
+            # and in the channels of the other row(s), flipped in y
+            for row in range(nrows_chan):
+                if row != row_victim:
+                    mask_xtalk |= np.flipud(nsat_rows[row] > 0)
+
+
+            # add crosstalk pixels to the full-image mask
+            data_mask[chan_sec_victim][mask_xtalk] |= mask_value['crosstalk']
+
+
+
+        # add them to the mask of edge and bad pixels
+        data_mask[mask_sat] |= mask_value['saturated']
+
+
+        # determining number of saturated objects; 2 saturated pixels are
+        # considered from the same object also if they are only connected
+        # diagonally
+        struct = np.ones((3,3), dtype=bool)
+        labels_sat, nobj_sat = ndimage.label(mask_sat, structure=struct)
+
+
+        # add number of saturated objects to headers
+        header_mask['NOBJ-SAT'] = (nobj_sat, 'number of saturated objects')
+        header['NOBJ-SAT'] = (nobj_sat, 'number of saturated objects')
+        # rest of the mask header entries are added in one go using
+        # function [mask_header] once all the reduction steps have
+        # finished
+
+
+        # identify pixels connected to saturated pixels, only
+        # considering the bounding box of each saturated object
+        # extended by 1 pixel
+        for obj_sec in ndimage.find_objects(labels_sat):
+            box = pad_slices (obj_sec, 1, np.shape(mask_sat))
+            mask_satcon = ndimage.binary_dilation(mask_sat[box],
+                                                  structure=struct,
+                                                  iterations=1)
+            # add them to the mask
+            mask_satcon2add = (mask_satcon & ~mask_sat[box])
+            data_mask[box][mask_satcon2add] |= mask_value['saturated-connected']
+
+
+        # fill potential holes using function [fill_sat_holes]
+        fill_sat_holes (data_mask, mask_value)
+
+
+
+
+    #fits.writeto ('test_data.fits', data, overwrite=True)
+    #fits.writeto ('test_mask2.fits', data_mask, overwrite=True)
+    #raise SystemExit
+
+
+    if get_par(set_zogy.timing,tel):
+        log_timing_memory (t0=t, label='in mask_init')
+
+    return data_mask.astype('uint8'), header_mask
+
+
+################################################################################
+
+def fill_sat_holes (data_mask, mask_value):
+
+    """fill_holes and binary_close saturated pixels in data_mask; this
+       is done separately in the bounding box of each group of
+       saturated and saturated-connected pixels that are close enough
+       to affect each other, i.e. the objects in the mask dilated by 1
+       pixel, which gives the same result as processing the full
+       image"""
+
+    value_sat = mask_value['saturated']
+    value_satcon = mask_value['saturated-connected']
+    mask_satcon = ((data_mask & value_sat == value_sat) |
+                   (data_mask & value_satcon == value_satcon))
+    struct = np.ones((3,3), dtype=bool)
+
+    labels, __ = ndimage.label(ndimage.binary_dilation(mask_satcon,
+                                                       structure=struct),
+                               structure=struct)
+
+    for i_obj, obj_sec in enumerate(ndimage.find_objects(labels)):
+        box = pad_slices (obj_sec, 2, np.shape(data_mask))
+        mask_obj = mask_satcon[box] & (labels[box]==i_obj+1)
+        mask_obj = ndimage.binary_closing(mask_obj, structure=struct)
+        mask_obj = ndimage.binary_fill_holes(mask_obj, structure=struct)
+        mask_satcon2add = (mask_obj & (data_mask[box]==0))
+        data_mask[box][mask_satcon2add] = value_satcon
+
+
+################################################################################
+
+def pad_slices (slices, npad, shape):
+
+    """return tuple of [slices] extended by [npad] pixels on both
+       sides, limited to the array [shape]"""
+
+    return tuple([slice(max(sl.start-npad, 0), min(sl.stop+npad, size))
+                  for sl, size in zip(slices, shape)])
+
+
+################################################################################
+
+def mask_header(data_mask, header_mask):
+
+    """Function to add info from all reduction steps to mask header"""
+
+    mask = {}
+    text = {'bad': 'BP', 'edge': 'EP', 'saturated': 'SP',
+            'saturated-connected': 'SCP', 'satellite trail': 'STP',
+            'cosmic ray': 'CRP'}
+
+    for mask_type in text.keys():
+        value = get_par(set_zogy.mask_value[mask_type],tel)
+        mask[mask_type] = (data_mask & value == value)
+        header_mask['M-{}'.format(text[mask_type])] = (
+            True, '{} pixels included in mask?'.format(mask_type))
+        header_mask['M-{}VAL'.format(text[mask_type])] = (
+            value, 'value added to mask for {} pixels'.format(mask_type))
+        header_mask['M-{}NUM'.format(text[mask_type])] = (
+            np.sum(mask[mask_type]), 'number of {} pixels'.format(mask_type))
+
+    return
+
+
+################################################################################
+
+def lock_master (fits_master, tel=None):
+
+    """function to acquire an exclusive lock on master [fits_master],
+       which is used to make sure that only one process at a time
+       prepares a particular master (defined by its image type,
+       evening date and filter), while other processes waiting for
+       the same master are blocked until it is ready. Processes that
+       need a different master are not affected. The lock is a file
+       lock on a lock file in the tmp folder, so that it works for
+       independent processes as well, and it is automatically released
+       when the process holding it dies. Returns the open lock file,
+       which should be passed on to [unlock_master].
+
+    """
+
+    lock_dir = '{}/locks'.format(get_par(set_bb.tmp_dir,tel))
+    os.makedirs(lock_dir, exist_ok=True)
+    lock_file = '{}/{}.lock'.format(
+        lock_dir, fits_master.split('/')[-1].split('.fits')[0])
+
+    flock = open(lock_file, 'a')
+    try:
+        fcntl.flock(flock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        log.info ('waiting for master {} to be prepared by another process'
+                  .format(fits_master))
+        fcntl.flock(flock, fcntl.LOCK_EX)
+
+
+    return flock
+
+
+################################################################################
+
+def unlock_master (flock):
+
+    """release and close lock file [flock] returned by [lock_master];
+       if [flock] is None, nothing is done"""
+
+    if flock is not None:
+        fcntl.flock(flock, fcntl.LOCK_UN)
+        flock.close()
+
+
+################################################################################
+
+# per-process cache of master frames used by [read_master], with keys
+# (filename, modification time, size) and values [data, header, nbytes]
+master_cache = collections.OrderedDict()
+
+
+def read_master (fits_master, tel=None):
+
+    """function to read the data and header of master frame
+       [fits_master], using a least-recently-used cache in memory
+       such that the same master does not need to be read and
+       decompressed again for every image reduced by this process.
+       The cache key contains the modification time and size of
+       [fits_master], so a master that is remade is read again. The
+       amount of memory used by the cache is limited to
+       set_bb.master_cache_mem GB. If set_bb.master_cache_dir is
+       defined, the decompressed data is also saved in that node-local
+       folder as a numpy file which is memory-mapped, so that all
+       processes on the same node share a single copy of the master
+       through the page cache. N.B.: the data returned is read-only.
+
+    """
+
+    if get_par(set_zogy.timing,tel):
+        t = time.time()
+
+
+    mtime, size = get_file_stat (fits_master)
+    key = (fits_master, mtime, size)
+
+    if key in master_cache:
+        log.info ('using cached master {}'.format(fits_master))
+        master_cache.move_to_end(key)
+        data, header, __ = master_cache[key]
+        return data, header.copy()
+
+
+    # header is always read from the fits file
+    header = read_hdulist(fits_master, get_data=False, get_header=True)
+
+
+    # numpy file in node-local cache folder; its name contains the
+    # modification time and size so that an updated master does not
+    # match an outdated numpy file
+    data = None
+    cache_dir = get_par(set_bb.master_cache_dir,tel)
+    if cache_dir is not None:
+        fits_npy = '{}/{}_{}_{}.npy'.format(
+            cache_dir, fits_master.split('/')[-1].split('.fits')[0],
+            int(mtime), size)
+
+        try:
+            if os.path.isfile(fits_npy):
+                data = np.load(fits_npy, mmap_mode='r')
+                # update modification time to indicate recent use
+                os.utime(fits_npy)
+                log.info ('memory-mapped {} from node-local cache {}'
+                          .format(fits_master, fits_npy))
+            else:
+                data = read_hdulist(fits_master, dtype='float32')
+                # remove numpy files that have not been used for more
+                # than a day, to avoid filling up the local disk
+                os.makedirs(cache_dir, exist_ok=True)
+                for f_npy in glob.glob('{}/*.npy'.format(cache_dir)):
+                    if time.time() - os.path.getmtime(f_npy) > 86400:
+                        log.info ('removing {} from node-local cache'
+                                  .format(f_npy))
+                        os.remove(f_npy)
+
+                # write to temporary file and rename, so that other
+                # processes never see a partially written file
+                fits_tmp = '{}.{}.tmp'.format(fits_npy, os.getpid())
+                with open(fits_tmp, 'wb') as f:
+                    np.save(f, data)
+                os.replace(fits_tmp, fits_npy)
+                data = np.load(fits_npy, mmap_mode='r')
+                log.info ('saved {} to node-local cache {}'
+                          .format(fits_master, fits_npy))
+
+        except Exception as e:
+            log.warning ('exception was raised while using node-local master '
+                         'cache {} for {}; reading master directly: {}'
+                         .format(cache_dir, fits_master, e))
+            data = None
+
 
-            # mask of saturated pixels in current channel
-            chan_sec = data_sec_red[i_chan]
-            mask_sat_chan = (data[chan_sec] >= satlevel_chan)
+    if data is None:
+        data = read_hdulist(fits_master, dtype='float32')
+        data.flags.writeable = False
 
 
-            # add to full-image saturation mask
-            mask_sat[chan_sec] = mask_sat_chan
+    # add to cache and remove least recently used masters until
+    # the total memory used is below the maximum
+    mem_max = get_par(set_bb.master_cache_mem,tel) * 1024**3
+    if mem_max > 0:
+        master_cache[key] = [data, header, data.nbytes]
+        while (len(master_cache) > 1 and
+               sum([v[2] for v in master_cache.values()]) > mem_max):
+            key_old, __ = master_cache.popitem(last=False)
+            log.info ('removed master {} from cache'.format(key_old[0]))
 
 
-            # row of this source channel; if row of source and victim
-            # channel are different, mask_sat_chan needs to be flipped
-            # in y
-            row_source = i_chan // 8
+    if get_par(set_zogy.timing,tel):
+        log_timing_memory (t0=t, label='in read_master')
 
 
-            # flipped version of mask_sat_chan to be used in loop below
-            mask_sat_chan_flip = np.flipud(mask_sat_chan)
+    return data, header.copy()
 
 
-            # loop victim channels
-            for i_victim in range(nchans):
+################################################################################
 
-                if i_victim != i_chan:
+def ref_cache_link (ref_fits_in, tmp_path, tel=None):
+
+    """function to provide the reference image [ref_fits_in] and its
+       accompanying files in [tmp_path] from the node-local reference
+       cache set_bb.ref_cache_dir. The first process on a node that
+       needs a particular reference copies and decompresses its files
+       once into a cache folder whose name contains the modification
+       time and size of the fpacked reference image, so a reference
+       that is remade is cached again. The cached files are then hard
+       linked into [tmp_path], except for the reduced image, its
+       catalog and header files, which are copied as their headers
+       may be updated by zogy; the cached files are made read-only to
+       protect them. The cache folder is
+       locked while it is created and linked from, and the least
+       recently used folders are removed if the cache is larger than
+       set_bb.ref_cache_size GB. Returns False if the cache is not
+       used, in which case the files need to be copied as before.
 
-                    # victim channel image section
-                    chan_sec_victim = data_sec_red[i_victim]
+    """
 
+    cache_dir = get_par(set_bb.ref_cache_dir,tel)
+    if cache_dir is None:
+        return False
 
-                    # row of victim channel
-                    row_victim = i_victim // 8
 
-                    if row_source == row_victim:
-                        mask_use = mask_sat_chan
-                    else:
-                        mask_use = mask_sat_chan_flip
+    if get_par(set_zogy.timing,tel):
+        t = time.time()
 
 
-                    # add crosstalk pixels to the full-image mask
-                    data_mask[chan_sec_victim][mask_use] |= \
-                        mask_value['crosstalk']
+    ref_base = ref_fits_in.split('_red.fits')[0]
+    files_linked = []
+    cache_tmp = None
 
+    try:
 
+        mtime, size = get_file_stat ('{}.fz'.format(ref_fits_in))
+        if mtime is None:
+            mtime, size = get_file_stat (ref_fits_in)
+            if mtime is None:
+                return False
+
+        cache_ref = '{}/{}_{}_{}'.format(cache_dir, ref_base.split('/')[-1],
+                                         int(mtime), size)
+        os.makedirs(cache_dir, exist_ok=True)
+
+        with ref_cache_lock ('{}.lock'.format(cache_ref)) as flock:
+
+            if not os.path.isdir(cache_ref):
+
+                # copy and unzip the reference files into a
+                # temporary folder and rename it, so that the cache
+                # never contains an incomplete reference
+                cache_tmp = '{}.{}.tmp'.format(cache_ref, os.getpid())
+                os.makedirs(cache_tmp, exist_ok=True)
+                for ref_file in list_files(ref_base):
+                    tmp_file = '{}/{}'.format(cache_tmp,
+                                              ref_file.split('/')[-1])
+                    copy_file (ref_file, tmp_file)
+                    tmp_file = unzip(tmp_file, put_lock=False)
+                    os.chmod(tmp_file, 0o444)
+
+                os.rename(cache_tmp, cache_ref)
+                cache_tmp = None
+                log.info ('saved reference {} to node-local cache {}'
+                          .format(ref_base, cache_ref))
 
+            else:
+                log.info ('using reference {} from node-local cache {}'
+                          .format(ref_base, cache_ref))
+                # update modification time to indicate recent use
+                os.utime(cache_ref)
 
 
-        # add them to the mask of edge and bad pixels
-        data_mask[mask_sat] |= mask_value['saturated']
+            for name in os.listdir(cache_ref):
+                src_file = '{}/{}'.format(cache_ref, name)
+                tmp_file = '{}/{}'.format(tmp_path, name)
+                if name.endswith(('_red.fits', '_red_cat.fits', '_hdr.fits')):
+                    shutil.copyfile(src_file, tmp_file)
+                else:
+                    try:
+                        os.link(src_file, tmp_file)
+                    except OSError:
+                        # e.g. tmp_path is on a different filesystem
+                        shutil.copyfile(src_file, tmp_file)
 
+                files_linked.append(tmp_file)
 
-        # determining number of saturated objects; 2 saturated pixels are
-        # considered from the same object also if they are only connected
-        # diagonally
-        struct = np.ones((3,3), dtype=bool)
-        __, nobj_sat = ndimage.label(mask_sat, structure=struct)
 
+        ref_cache_evict (cache_dir, tel=tel)
 
-        # add number of saturated objects to headers
-        header_mask['NOBJ-SAT'] = (nobj_sat, 'number of saturated objects')
-        header['NOBJ-SAT'] = (nobj_sat, 'number of saturated objects')
-        # rest of the mask header entries are added in one go using
-        # function [mask_header] once all the reduction steps have
-        # finished
 
+    except Exception as e:
+        log.warning ('exception was raised while using node-local reference '
+                     'cache {} for {}; copying reference files directly: {}'
+                     .format(cache_dir, ref_fits_in, e))
+        # remove the files already linked, so that these cached
+        # files are not overwritten when copying the reference files
+        for tmp_file in files_linked:
+            os.remove(tmp_file)
+
+        # remove the incomplete cache folder
+        if cache_tmp is not None:
+            shutil.rmtree(cache_tmp, ignore_errors=True)
 
-        # identify pixels connected to saturated pixels
-        struct = np.ones((3,3), dtype=bool)
-        mask_satcon = ndimage.binary_dilation(mask_sat, structure=struct,
-                                              iterations=1)
-        # add them to the mask
-        mask_satcon2add = (mask_satcon & ~mask_sat)
-        data_mask[mask_satcon2add] |= mask_value['saturated-connected']
+        return False
 
 
-        # fill potential holes using function [fill_sat_holes]
-        fill_sat_holes (data_mask, mask_value)
+    if get_par(set_zogy.timing,tel):
+        log_timing_memory (t0=t, label='in ref_cache_link')
 
 
+    return True
 
 
-    #fits.writeto ('test_data.fits', data, overwrite=True)
-    #fits.writeto ('test_mask2.fits', data_mask, overwrite=True)
-    #raise SystemExit
+################################################################################
 
+def ref_cache_lock (lockname, blocking=True):
 
-    if get_par(set_zogy.timing,tel):
-        log_timing_memory (t0=t, label='in mask_init')
+    """return file object of lock file [lockname] of the node-local
+       reference cache, locked exclusively by this process; closing
+       it releases the lock. If [blocking] is False, None is returned
+       if the lock is held by another process. As lock files are
+       removed by [ref_cache_evict], the lock is only returned if
+       [lockname] still refers to the locked file, otherwise it is
+       opened and locked again."""
 
-    return data_mask.astype('uint8'), header_mask
+    while True:
+
+        flock = open(lockname, 'a')
+        try:
+            if blocking:
+                fcntl.flock(flock, fcntl.LOCK_EX)
+            else:
+                fcntl.flock(flock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            flock.close()
+            return None
+
+        try:
+            if os.fstat(flock.fileno()).st_ino == os.stat(lockname).st_ino:
+                return flock
+        except FileNotFoundError:
+            pass
+
+        flock.close()
 
 
 ################################################################################
 
-def fill_sat_holes (data_mask, mask_value):
+def ref_cache_evict (cache_dir, tel=None):
+
+    """remove the least recently used reference folders from the
+       node-local reference cache [cache_dir] until its size is below
+       set_bb.ref_cache_size GB; folders that are locked by another
+       process are skipped. Temporary folders left behind by
+       processes that failed while filling a cache folder, and lock
+       files of folders that no longer exist, are removed as well."""
+
+    size_max = get_par(set_bb.ref_cache_size,tel) * 1024**3
+
+    # size and modification time of each cached reference folder,
+    # and the temporary folders and lock files to check
+    sizes = {}
+    mtimes = {}
+    names_check = []
+    for name in os.listdir(cache_dir):
+        cache_ref = '{}/{}'.format(cache_dir, name)
+        if name.endswith(('.tmp', '.lock')):
+            names_check.append(name)
+        elif os.path.isdir(cache_ref):
+            try:
+                mtimes[cache_ref] = os.path.getmtime(cache_ref)
+                sizes[cache_ref] = sum([os.path.getsize('{}/{}'.format(
+                    cache_ref, f)) for f in os.listdir(cache_ref)])
+            except FileNotFoundError:
+                # folder removed by another process
+                mtimes.pop(cache_ref, None)
+                sizes.pop(cache_ref, None)
+
+
+    # a temporary folder [cache_ref].[pid].tmp is being filled while
+    # the lock of [cache_ref] is held, so if that lock is free, the
+    # folder was left behind
+    for name in names_check:
+        if name.endswith('.tmp'):
+            cache_ref = '{}/{}'.format(cache_dir, name.rsplit('.', 2)[0])
+        else:
+            cache_ref = '{}/{}'.format(cache_dir, name[:-len('.lock')])
 
-    """fill_holes and binary_close saturated pixels in data_mask"""
+        if cache_ref in sizes:
+            continue
 
-    value_sat = mask_value['saturated']
-    value_satcon = mask_value['saturated-connected']
-    mask_satcon = ((data_mask & value_sat == value_sat) |
-                   (data_mask & value_satcon == value_satcon))
-    struct = np.ones((3,3), dtype=bool)
-    mask_satcon = ndimage.binary_closing(mask_satcon, structure=struct)
-    mask_satcon = ndimage.binary_fill_holes(mask_satcon, structure=struct)
-    mask_satcon2add = (mask_satcon & (data_mask==0))
-    data_mask[mask_satcon2add] = value_satcon
+        lockname = '{}.lock'.format(cache_ref)
+        flock = ref_cache_lock (lockname, blocking=False)
+        if flock is None:
+            continue
 
+        with flock:
+            if name.endswith('.tmp'):
+                log.info ('removing {}/{} from node-local reference cache'
+                          .format(cache_dir, name))
+                shutil.rmtree('{}/{}'.format(cache_dir, name),
+                              ignore_errors=True)
 
-################################################################################
+            if not os.path.isdir(cache_ref) and os.path.isfile(lockname):
+                os.remove(lockname)
 
-def mask_header(data_mask, header_mask):
 
-    """Function to add info from all reduction steps to mask header"""
+    size_total = sum(sizes.values())
+    if size_total <= size_max:
+        return
 
-    mask = {}
-    text = {'bad': 'BP', 'edge': 'EP', 'saturated': 'SP',
-            'saturated-connected': 'SCP', 'satellite trail': 'STP',
-            'cosmic ray': 'CRP'}
 
-    for mask_type in text.keys():
-        value = get_par(set_zogy.mask_value[mask_type],tel)
-        mask[mask_type] = (data_mask & value == value)
-        header_mask['M-{}'.format(text[mask_type])] = (
-            True, '{} pixels included in mask?'.format(mask_type))
-        header_mask['M-{}VAL'.format(text[mask_type])] = (
-            value, 'value added to mask for {} pixels'.format(mask_type))
-        header_mask['M-{}NUM'.format(text[mask_type])] = (
-            np.sum(mask[mask_type]), 'number of {} pixels'.format(mask_type))
+    for cache_ref in sorted(sizes, key=lambda d: mtimes[d]):
 
-    return
+        if size_total <= size_max:
+            break
+
+        lockname = '{}.lock'.format(cache_ref)
+        flock = ref_cache_lock (lockname, blocking=False)
+        if flock is None:
+            # in use by another process
+            continue
+
+        with flock:
+            if os.path.isdir(cache_ref):
+                log.info ('removing {} from node-local reference cache'
+                          .format(cache_ref))
+                shutil.rmtree(cache_ref)
+
+            os.remove(lockname)
+            size_total -= sizes[cache_ref]
 
 
 ################################################################################
@@ -4731,12 +6665,15 @@ def master_prep (fits_master, data_shape, create_master, pick_alt=True,
             else:
                 search_str = '.fits'
 
-            # collect files
-            file_list.append(list_files(path_tmp, search_str=search_str))
+            # collect files from calibration-file catalogue, which
+            # also records their MJD-OBS and QC-FLAG
+            file_list.append(calcat_list(path_tmp, search_str=search_str,
+                                         tel=tel))
 
 
         # clean up lists in [file_list] and sort
-        file_list = sorted([f for sublist in file_list for f in sublist])
+        cal_list = sorted([f for sublist in file_list for f in sublist])
+        file_list = [c[0] for c in cal_list]
         nfiles = len(file_list)
 
 
@@ -4748,28 +6685,19 @@ def master_prep (fits_master, data_shape, create_master, pick_alt=True,
             # 2020; moreover, mjd_obs is read from header to be able
             # to sort the calibration files in time futher below
 
-            # execute this block only if [create_master] is switched
-            # on, otherwise the line with read_hdulist below leads to
-            # an exception when running both bias and flatfield
-            # reductions on Slurm with multiple tasks/processes:
-            # Header missing END card. [blackbox_reduce, line 1323]
+            # the QC-FLAG and MJD-OBS values are taken from the
+            # calibration-file catalogue
             mjd_obs = np.zeros(nfiles)
             mask_keep = np.ones(nfiles, dtype=bool)
             for i_file, filename in enumerate(file_list):
 
-                log.info ('reading header of {}'.format(filename))
-                # check!!! - the following line leads to an exception when
-                # running both bias and flatfield reductions on Slurm with
-                # multiple tasks/processes:
-                # Header missing END card. [blackbox_reduce, line 1323]
-                header_tmp = read_hdulist (filename, get_data=False,
-                                           get_header=True)
-                if 'QC-FLAG' in header_tmp and header_tmp['QC-FLAG'] == 'red':
+                __, __, __, mjd_obs_tmp, qc_flag = cal_list[i_file]
+                if qc_flag == 'red':
                     mask_keep[i_file] = False
 
                 # record MJD-OBS in array
-                if 'MJD-OBS' in header_tmp:
-                    mjd_obs[i_file] = header_tmp['MJD-OBS']
+                if np.isfinite(mjd_obs_tmp):
+                    mjd_obs[i_file] = mjd_obs_tmp
 
                 # for period from July 2019 until February 2020, avoid
                 # using MeerLICHT evening flats due to dome vignetting
@@ -4913,24 +6841,21 @@ def master_prep (fits_master, data_shape, create_master, pick_alt=True,
                              'image as [subtract_mbias] is set to False)')
 
 
-            # assuming that individual flats/biases have the same
-            # shape as the input data
-            ysize, xsize = data_shape
-            master_cube = np.zeros((nfiles, ysize, xsize), dtype='float32')
-
-
             # initialize master header
             header_master = fits.Header()
 
 
-            # fill the cube; ra_flats and dec_flats are used to check
-            # offsets between flats
+            # read the headers; for flats, the medians over the
+            # normalization section are recorded in [norm_flats], and
+            # ra_flats and dec_flats are used to check offsets between
+            # flats
+            norm_flats = [1 for f in file_list]
             ra_flats = []
             dec_flats = []
             for i_file, filename in enumerate(file_list):
 
-                master_cube[i_file], header_tmp = read_hdulist(filename,
-                                                               get_header=True)
+                header_tmp = read_hdulist(filename, get_data=False,
+                                          get_header=True)
 
                 if imgtype=='flat':
 
@@ -4940,7 +6865,8 @@ def master_prep (fits_master, data_shape, create_master, pick_alt=True,
                         median = header_tmp['MEDSEC']
                     else:
                         index_flat_norm = get_par(set_bb.flat_norm_sec,tel)
-                        median = np.median(master_cube[i_file][index_flat_norm])
+                        median = np.median(read_hdulist(
+                            filename, dtype='float32')[index_flat_norm])
 
 
                     # divide by median over the region [set_bb.flat_norm_sec]
@@ -4948,7 +6874,7 @@ def master_prep (fits_master, data_shape, create_master, pick_alt=True,
                               .format(filename, median))
 
                     if median != 0:
-                        master_cube[i_file] /= median
+                        norm_flats[i_file] = median
 
                     # collect RA and DEC to check for dithering
                     if 'RA' in header_tmp and 'DEC' in header_tmp:
@@ -4990,8 +6916,13 @@ def master_prep (fits_master, data_shape, create_master, pick_alt=True,
                                                   header_tmp.comments[key])
 
 
-            # determine the median
-            master_median = np.median(master_cube, axis=0)
+            # determine the median, combining the frames in strips of
+            # rows to limit the memory used
+            if imgtype=='flat':
+                master_median = median_stack (file_list, data_shape,
+                                              norm=norm_flats, tel=tel)
+            else:
+                master_median = median_stack (file_list, data_shape, tel=tel)
 
 
             # add number of files combined
@@ -5070,14 +7001,10 @@ def master_prep (fits_master, data_shape, create_master, pick_alt=True,
                 # master preparation is not necessariliy linked to the
                 # mask of an object image, e.g. in function
                 # [masters_left]
-                fits_bpm = (get_par(set_bb.bad_pixel_mask,tel)
-                            .replace('bpm', 'bpm_{}'.format(filt)))
-                bpm_present, fits_bpm = already_exists (fits_bpm,
-                                                        get_filename=True)
-
-                if bpm_present:
-                    # if mask exists, read it
-                    data_mask = read_hdulist(fits_bpm)
+                __, data_mask = read_bpm (filt, tel=tel)
+
+                if data_mask is not None:
+                    # if mask exists, use it
                     mask_replace = ((data_mask==get_par(
                         set_zogy.mask_value['edge'],tel)) | (master_median<=0))
                     master_median[mask_replace] = 1
@@ -5257,6 +7184,89 @@ def master_prep (fits_master, data_shape, create_master, pick_alt=True,
     return fits_master
 
 
+################################################################################
+
+def median_stack (file_list, data_shape, norm=None, tel=None):
+
+    """function to determine the pixel-by-pixel median of the images
+       in [file_list] with shape [data_shape], where each image is
+       first divided by the corresponding value in [norm] if provided.
+       Instead of reading all images into a single cube, the images
+       are read and combined in strips of rows using fitsio, with the
+       number of rows set by the memory ceiling set_bb.stack_mem_max
+       (GB); the memory used is therefore independent of the image
+       size. Returns the float32 median image.
+
+    """
+
+    if get_par(set_zogy.timing,tel):
+        t = time.time()
+
+
+    nfiles = len(file_list)
+    ysize, xsize = data_shape
+
+    # number of rows per strip; factor 2 accounts for the copy of
+    # the strip made by np.median
+    mem_max = get_par(set_bb.stack_mem_max,tel) * 1024**3
+    nrows = int(max(1, min(ysize, mem_max // (2 * nfiles * xsize * 4))))
+    log.info ('combining {} frames in strips of {} rows'.format(nfiles, nrows))
+
+
+    # fitsio cannot read from a google cloud bucket, so copy bucket
+    # files to a temporary local folder first
+    tmp_path = None
+    if np.any([f[0:5]=='gs://' for f in file_list]):
+        tmp_dir = get_par(set_bb.tmp_dir,tel)
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=tmp_dir)
+        file_list_local = []
+        for filename in file_list:
+            if filename[0:5]=='gs://':
+                copy_file (filename, tmp_path, verbose=False)
+                filename = '{}/{}'.format(tmp_path, filename.split('/')[-1])
+
+            file_list_local.append(filename)
+
+    else:
+        file_list_local = file_list
+
+
+    master_median = np.zeros(data_shape, dtype='float32')
+    strip = np.zeros((nfiles, nrows, xsize), dtype='float32')
+    fits_list = []
+    try:
+        # open all files; image is in the last extension
+        fits_list = [fitsio.FITS(f) for f in file_list_local]
+        hdu_list = [f[-1] for f in fits_list]
+
+        for y1 in range(0, ysize, nrows):
+
+            y2 = min(y1+nrows, ysize)
+            ny = y2-y1
+
+            for i_file, hdu in enumerate(hdu_list):
+                strip[i_file,0:ny] = hdu[y1:y2,:]
+                if norm is not None:
+                    strip[i_file,0:ny] /= norm[i_file]
+
+            master_median[y1:y2] = np.median(strip[:,0:ny], axis=0)
+
+    finally:
+        for f in fits_list:
+            f.close()
+
+        if tmp_path is not None:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+    if get_par(set_zogy.timing,tel):
+        log_timing_memory (t0=t, label='in median_stack')
+
+
+    return master_median
+
+
 ################################################################################
 
 def delta_one_month (date_eve, dmonth):
@@ -5357,15 +7367,16 @@ def get_nearest_master (date_eve, imgtype, fits_master, filt=None):
             else:
                 end_str = '.fits.fz'
 
-            # collect files
-            month_list = list_files(path_tmp, start_str=start_str,
-                                    end_str=end_str, recursive=True)
+            # collect files from calibration-file catalogue
+            month_list = calcat_list(path_tmp, start_str=start_str,
+                                     end_str=end_str, recursive=True, tel=tel)
             file_list.extend(month_list)
 
 
 
         # clean up lists in [file_list] and sort
-        file_list = sorted(file_list)
+        cal_list = sorted(file_list)
+        file_list = [c[0] for c in cal_list]
         nfiles = len(file_list)
 
 
@@ -5386,9 +7397,10 @@ def get_nearest_master (date_eve, imgtype, fits_master, filt=None):
             # loop these starting with nearest one, and select
             # nearest one that is not red-flagged
             for i_near in idx_sort:
-                # check if it is red-flagged
+                # check if it is red-flagged, using the QC-FLAG
+                # recorded in the catalogue
                 file_near = file_list[i_near]
-                if not qc_flagged (file_near):
+                if cal_list[i_near][4] != 'red':
                     par2return = file_near
                     break
             else:
@@ -5408,12 +7420,211 @@ def get_nearest_master (date_eve, imgtype, fits_master, filt=None):
     return par2return
 
 
+################################################################################
+
+def calcat_connect (tel=None):
+
+    """return connection to the calibration-file catalogue, an SQLite
+       database in the local folder set_bb.index_dir, with table
+       [calfiles] containing the filename, folder, image type, filter,
+       MJD-OBS, QC-FLAG and modification time of reduced calibration
+       files and master frames"""
+
+    index_dir = get_par(set_bb.index_dir,tel)
+    os.makedirs(index_dir, exist_ok=True)
+    con = sqlite3.connect('{}/calcat.db'.format(index_dir), timeout=60)
+    with con:
+        con.execute('CREATE TABLE IF NOT EXISTS calfiles (filename TEXT '
+                    'PRIMARY KEY, folder TEXT, imgtype TEXT, filter TEXT, '
+                    'mjdobs REAL, qcflag TEXT, mtime REAL)')
+        con.execute('CREATE INDEX IF NOT EXISTS idx_folder ON calfiles '
+                    '(folder)')
+
+        # catalogue created before the modification time was
+        # recorded; the headers of its files will be read again
+        columns = [c[1] for c in con.execute('PRAGMA table_info(calfiles)')]
+        if 'mtime' not in columns:
+            con.execute('ALTER TABLE calfiles ADD COLUMN mtime REAL')
+
+    return con
+
+
+################################################################################
+
+def calcat_row (filename, header):
+
+    """return row of calibration-file catalogue for [filename] with
+       [header]; missing values are set to an empty string or NaN"""
+
+    row = [filename, os.path.dirname(filename)]
+    for key in ['IMAGETYP', 'FILTER']:
+        if key in header:
+            row.append(str(header[key]).lower())
+        else:
+            row.append('')
+
+    if 'MJD-OBS' in header:
+        row.append(float(header['MJD-OBS']))
+    else:
+        row.append(np.nan)
+
+    if 'QC-FLAG' in header:
+        row.append(str(header['QC-FLAG']))
+    else:
+        row.append('')
+
+
+    return row
+
+
+################################################################################
+
+def calcat_add (filename, header, tel=None):
+
+    """add reduced calibration file or master frame [filename] with
+       [header] to the calibration-file catalogue; files with an
+       image type other than bias, dark or flat are ignored"""
+
+    if ('IMAGETYP' not in header or
+        str(header['IMAGETYP']).lower() not in ['bias', 'dark', 'flat']):
+        return
+
+    try:
+        mtime, __ = get_file_stat (filename)
+        con = calcat_connect (tel=tel)
+        try:
+            with con:
+                con.execute('INSERT OR REPLACE INTO calfiles VALUES '
+                            '(?,?,?,?,?,?,?)',
+                            calcat_row(filename, header) + [mtime])
+        finally:
+            con.close()
+
+    except Exception as e:
+        log.warning ('exception was raised while adding {} to calibration-file '
+                     'catalogue: {}'.format(filename, e))
+
+
+################################################################################
+
+def calcat_list (path, start_str=None, search_str='', end_str='',
+                 recursive=False, tel=None, nthreads=8):
+
+    """Function to list the reduced calibration files or master
+       frames starting with [path], with the same input parameters
+       as [list_files], using the calibration-file catalogue. [path]
+       is listed with [list_files] on every call, which is cheap, but
+       only the headers of fits files that are not yet in the
+       catalogue or whose modification time changed, e.g. because
+       their QC-FLAG was updated by another node, are read using
+       [nthreads] threads; files that no longer exist are removed from
+       the catalogue. Returns list of tuples (filename, imgtype,
+       filter, MJD-OBS, QC-FLAG). If the catalogue cannot be used, the
+       files are listed and their headers read without it.
+
+    """
+
+    def read_row (filename, mtime=None):
+        try:
+            header = read_hdulist(filename, get_data=False, get_header=True)
+            return calcat_row (filename, header) + [mtime]
+        except Exception as e:
+            log.warning ('exception was raised while reading header of {}: '
+                         '{}'.format(filename, e))
+            return None
+
+
+    def select (filename):
+        basename = filename.split('/')[-1]
+        return (filename.startswith(path) and search_str in filename and
+                filename.endswith(end_str) and
+                (start_str is None or basename.startswith(start_str)))
+
+
+    try:
+
+        # list [path] and the modification times of its fits files;
+        # the catalogue is updated for the full [path], so the list
+        # is not limited by the name selection parameters
+        files = [f for f in list_files(path, recursive=recursive)
+                 if f.endswith(('.fits', '.fits.fz'))]
+        stats = get_file_stats (path, files)
+
+
+        con = calcat_connect (tel=tel)
+        try:
+            rows = con.execute(
+                'SELECT filename, mtime FROM calfiles WHERE '
+                'substr(filename,1,?)=?', (len(path), path)).fetchall()
+            mtimes_cat = dict(rows)
+            files2read = [f for f in files
+                          if mtimes_cat.get(f, -1) != stats[f][0]]
+            files2remove = set(mtimes_cat) - set(files)
+            if not recursive:
+                # files in subfolders were not listed
+                folder = os.path.dirname(path)
+                files2remove = [f for f in files2remove
+                                if os.path.dirname(f) == folder]
+
+            if len(files2read) > 0:
+                log.info ('adding {} files in {} to calibration-file '
+                          'catalogue'.format(len(files2read), path))
+                rows = map_threads (lambda f: read_row(f, stats[f][0]),
+                                    files2read, nthreads=nthreads)
+                rows = [r for r in rows if r is not None]
+            else:
+                rows = []
+
+            with con:
+                con.executemany('INSERT OR REPLACE INTO calfiles VALUES '
+                                '(?,?,?,?,?,?,?)', rows)
+                con.executemany('DELETE FROM calfiles WHERE filename=?',
+                                [(f,) for f in files2remove])
+
+
+            # select files from catalogue
+            rows = con.execute(
+                'SELECT filename, imgtype, filter, mjdobs, qcflag FROM '
+                'calfiles WHERE substr(filename,1,?)=?', (len(path), path)
+            ).fetchall()
+
+        finally:
+            con.close()
+
+
+        # in case not recursive, only keep files in the folder of
+        # [path] itself
+        if not recursive:
+            folder = os.path.dirname(path)
+            rows = [r for r in rows if os.path.dirname(r[0]) == folder]
+
+
+        # catalogue stores NaN as NULL
+        rows = [tuple(r[0:3]) + (np.nan if r[3] is None else r[3], r[4])
+                for r in rows if select(r[0])]
+
+
+    except Exception as e:
+
+        log.warning ('exception was raised while using calibration-file '
+                     'catalogue for {}; listing files and reading headers '
+                     'instead: {}'.format(path, e))
+
+        files = list_files(path, start_str=start_str, search_str=search_str,
+                           end_str=end_str, recursive=recursive)
+        rows = [read_row(f) for f in files if f.endswith(('.fits', '.fits.fz'))]
+        rows = [tuple(r[0:1] + r[2:6]) for r in rows if r is not None]
+
+
+    return sorted(rows)
+
+
 ################################################################################
 
 def qc_flagged (fits_name, flag='red'):
 
     # check if header of [fits_name] contains red flag
-    header = read_hdulist (fits_name, get_data=False, get_header=True)
+    header = read_header (fits_name)
 
     if ('QC-FLAG' in header and header['QC-FLAG']==flag):
         return True
@@ -5773,9 +7984,8 @@ def set_header(header, filename, silent=False):
 
     # for some flatsfieds, IMAGETYP was erroneously set to Object;
     # update those
-    imgtype = header['IMAGETYP'].lower()
-    if 'flat' in filename.lower() and imgtype == 'object':
-        imgtype = 'flat'
+    imgtype = get_imgtype (header, filename)
+    if imgtype != header['IMAGETYP'].lower():
         edit_head(header, 'IMAGETYP', value=imgtype)
 
 
@@ -6341,6 +8551,11 @@ def jnow2icrs (ra_in, dec_in, equinox, icrs2jnow=False):
 
 ################################################################################
 
+# per-process cache of the sections returned by [define_sections],
+# with keys (data_shape, xbin, ybin, tel)
+sections_cache = {}
+
+
 def define_sections (data_shape, xbin=1, ybin=1, tel=None):
 
     """Function that defines and returns [chan_sec], [data_sec],
@@ -6352,6 +8567,13 @@ def define_sections (data_shape, xbin=1, ybin=1, tel=None):
 
     """
 
+    # the sections only depend on the input parameters and the
+    # settings, so they are determined only once by this process
+    key = (tuple(data_shape), xbin, ybin, tel)
+    if key in sections_cache:
+        return sections_cache[key]
+
+
     ysize, xsize = data_shape
     ny = get_par(set_bb.ny,tel)
     nx = get_par(set_bb.nx,tel)
@@ -6409,12 +8631,17 @@ def define_sections (data_shape, xbin=1, ybin=1, tel=None):
                           for x in range(0,xsize-nx*xsize_os,xsize_chan)])
 
 
-    return chan_sec, data_sec, os_sec_hori, os_sec_vert, data_sec_red
+    sections_cache[key] = (chan_sec, data_sec, os_sec_hori, os_sec_vert,
+                           data_sec_red)
+
+
+    return sections_cache[key]
 
 
 ################################################################################
 
-def os_corr (data, header, imgtype, xbin=1, ybin=1, data_limit=2000, tel=None):
+def os_corr (data, header, imgtype, xbin=1, ybin=1, data_limit=2000, tel=None,
+             nthreads=1):
 
     """Function that corrects [data] for the overscan signal in the
        vertical and horizontal overscan strips. The definitions of the
@@ -6431,6 +8658,11 @@ def os_corr (data, header, imgtype, xbin=1, ybin=1, data_limit=2000, tel=None):
        section that has a saturated pixel in the data section will not
        be fit; this is to avoid oversubtracting columns affected by
        saturated stars leaking flux into the overscan section.
+
+       The clipped statistics of the vertical and horizontal overscan
+       sections are determined for all channels at once, and the fits
+       to the horizontal overscans are performed by function
+       [fit_hos], using [nthreads] threads.
     """
 
     if get_par(set_zogy.timing,tel):
@@ -6470,9 +8702,30 @@ def os_corr (data, header, imgtype, xbin=1, ybin=1, data_limit=2000, tel=None):
 
 
     # channel saturation levels
-    satlevel = np.array(get_par(set_bb.satlevel,tel))
-    gain = np.array(get_par(set_bb.gain,tel))
-    satlevel_electrons = satlevel * gain
+    __, satlevel_electrons = get_chan_pars (tel=tel)
+
+
+    # the vertical overscan sections of all channels are stacked
+    # into a single array with shape (nchans, nrows_chan, ncols_vos)
+    # so that the clipped mean of each row (not median, because input
+    # pixels are still integers!) is determined for all channels at
+    # once; if this raises an exception, e.g. because all pixels of a
+    # channel are zero, the clipped means are determined per channel
+    # in the loop below
+    try:
+        mean_vos_chans, __, __ = sigma_clipped_stats(
+            np.stack([data[os_sec_vert[i_chan]] for i_chan in range(nchans)]),
+            axis=2, mask_value=0, cenfunc='mean')
+    except:
+        mean_vos_chans = None
+
+
+    # lists of horizontal overscan sections of the channels, their
+    # masks and columns affected by saturated stars, which are fit
+    # further below for all channels at once
+    data_hos_chans = []
+    mask_hos_chans = []
+    mask_sat_row_chans = []
 
 
     for i_chan in range(nchans):
@@ -6483,21 +8736,24 @@ def os_corr (data, header, imgtype, xbin=1, ybin=1, data_limit=2000, tel=None):
         # -----------------
 
         # first subtract a low-order polynomial fit to the clipped
-        # mean (not median, because input pixels are still integers!)
-        # of the vertical overcan section from the entire channel
+        # mean of the vertical overcan section from the entire channel
 
-        # determine clipped mean for each row
-        data_vos = data[os_sec_vert[i_chan]]
-        try:
-            mean_vos_col, __, __ = sigma_clipped_stats(
-                data_vos, axis=1, mask_value=0, cenfunc='mean')
-        except:
-            # do not mask out zero-valued pixels in data_vos; if all
-            # pixels are zero, this leads to an exception
-            log.warning ('exception was raised during determination of clipped '
-                         'mean for each row of vertical overscan section')
-            mean_vos_col, __, __ = sigma_clipped_stats(
-                data_vos, axis=1, cenfunc='mean')
+        # clipped mean for each row
+        if mean_vos_chans is not None:
+            mean_vos_col = mean_vos_chans[i_chan]
+        else:
+            data_vos = data[os_sec_vert[i_chan]]
+            try:
+                mean_vos_col, __, __ = sigma_clipped_stats(
+                    data_vos, axis=1, mask_value=0, cenfunc='mean')
+            except:
+                # do not mask out zero-valued pixels in data_vos; if all
+                # pixels are zero, this leads to an exception
+                log.warning ('exception was raised during determination of '
+                             'clipped mean for each row of vertical overscan '
+                             'section')
+                mean_vos_col, __, __ = sigma_clipped_stats(
+                    data_vos, axis=1, cenfunc='mean')
 
 
         # fit low order polynomial to vertical overscan, avoiding
@@ -6588,8 +8844,7 @@ def os_corr (data, header, imgtype, xbin=1, ybin=1, data_limit=2000, tel=None):
         # horizontal overscan
         # -------------------
 
-        # determine the running clipped mean of the overscan using all
-        # values for [ncols] columns
+        # horizontal overscan section with [ncols] columns
         data_hos = data[os_sec_hori[i_chan]][:,:ncols]
 
 
@@ -6623,6 +8878,9 @@ def os_corr (data, header, imgtype, xbin=1, ybin=1, data_limit=2000, tel=None):
                                                structure=np.ones((3,3)).astype('bool'),
                                                iterations=2)
 
+            # mask_sat_row is only used for BlackGEM
+            mask_sat_row = None
+
         else:
 
             # for BlackGEM identify columns where one/a few or more
@@ -6633,260 +8891,300 @@ def os_corr (data, header, imgtype, xbin=1, ybin=1, data_limit=2000, tel=None):
             # stars
             mask_hos = np.zeros_like(data_hos, dtype=bool)
             ypix_lim = {'BG2':(2640,5280), 'BG3':(1320,2640), 'BG4':(1320,2640)}
+
+            # the rows closest to the overscan within ypix_lim[tel][1]
+            # are compared to the saturation level once; the rows
+            # within ypix_lim[tel][0] are a subset of these
+            nlim1, nlim2 = ypix_lim[tel]
             if i_chan >= 8:
-                ypix_range1 = range(0, ypix_lim[tel][0])
-                ypix_range2 = range(0, ypix_lim[tel][1])
+                mask_sat = (data[data_sec[i_chan]][0:nlim2,:] >=
+                            0.9*satlevel_electrons[i_chan])
+                nsat_row1 = np.sum(mask_sat[0:nlim1,:], axis=0)
             else:
-                ypix_range1 = range(nrows-ypix_lim[tel][0], nrows)
-                ypix_range2 = range(nrows-ypix_lim[tel][1], nrows)
+                mask_sat = (data[data_sec[i_chan]][nrows-nlim2:nrows,:] >=
+                            0.9*satlevel_electrons[i_chan])
+                nsat_row1 = np.sum(mask_sat[nlim2-nlim1:nlim2,:], axis=0)
+
+
+            # define row pixels that were affected by nearby saturated
+            # stars
+            mask_sat_row = (nsat_row1 >= 3)
+            # for heavily saturated stars
+            mask_sat_row |= (np.sum(mask_sat, axis=0) >= 10)
+
+            # update mask_hos
+            mask_hos[:] |= mask_sat_row
+
+
+        data_hos_chans.append(data_hos)
+        mask_hos_chans.append(mask_hos)
+        mask_sat_row_chans.append(mask_sat_row)
+
+
+
+    # determine clipped mean for each column of the horizontal
+    # overscan sections of all channels at once, first defining
+    # masked array with shape (nchans, nrows_hos, ncols)
+    data_hos_ma = np.ma.masked_array(np.stack(data_hos_chans),
+                                     mask=np.stack(mask_hos_chans))
+    # sigma_clip
+    nsigma = 2.5
+    data_hos_ma = sigma_clip (data_hos_ma, axis=1, cenfunc='mean',
+                              sigma=nsigma)
+    # number of rows in each column, used in [fit_hos] to estimate
+    # the error in the mean
+    nvalues_chans = np.sum(~data_hos_ma.mask, axis=1)
+    # clipped mean and std
+    mean_hos_chans = np.nanmean(data_hos_ma, axis=1)
+    std_hos_chans = np.nanstd(data_hos_ma, axis=1, ddof=1)
+
+
+    # fit the column means of the different channels, using a
+    # pool of threads if [nthreads] is larger than 1
+    args = [(mean_hos_chans[i_chan], std_hos_chans[i_chan],
+             nvalues_chans[i_chan], mask_sat_row_chans[i_chan], i_chan, tel)
+            for i_chan in range(nchans)]
+    oscan_chans = map_threads (lambda a: fit_hos(*a), args, nthreads=nthreads)
+
+
+    for i_chan in range(nchans):
+
+        # finally, subtract horizontal overscan from data section and
+        # place into [data_out]
+        np.subtract(data[data_sec[i_chan]], oscan_chans[i_chan],
+                    out=data_out[data_sec_red[i_chan]])
+
+
+
+    # add headers outside above loop to make header more readable
+    for i_chan in range(nchans):
+        header['BIASM{}'.format(i_chan+1)] = (
+            mean_vos[i_chan], '[e-] channel {} mean vertical overscan'
+            .format(i_chan+1))
+
+    for i_chan in range(nchans):
+        header['RDN{}'.format(i_chan+1)] = (
+            std_vos[i_chan], '[e-] channel {} sigma (STD) vertical overscan'
+            .format(i_chan+1))
+
+
+    # write the average of both the means and standard deviations
+    # determined for each channel to the header
+    header['BIASMEAN'] = (np.nanmean(mean_vos), '[e-] average all channel means '
+                          'vert. overscan')
+    header['RDNOISE'] = (np.nanmean(std_vos), '[e-] average all channel sigmas '
+                         'vert. overscan')
 
 
-            # define row pixels that were affected by nearby saturated
-            # stars
-            mask_sat_row = (np.sum(data[data_sec[i_chan]][ypix_range1,:] >=
-                                   0.9*satlevel_electrons[i_chan], axis=0) >= 3)
-            # for heavily saturated stars
-            mask_sat_row |= (np.sum(data[data_sec[i_chan]][ypix_range2,:] >=
-                                    0.9*satlevel_electrons[i_chan], axis=0) >= 10)
+    # reset warnings
+    warnings.resetwarnings()
 
-            # update mask_hos
-            mask_hos[:] |= mask_sat_row
 
+    if get_par(set_zogy.timing,tel):
+        log_timing_memory (t0=t, label='in os_corr')
 
 
-        # determine clipped mean for each column, first defining
-        # masked array
-        data_hos_ma = np.ma.masked_array(data_hos, mask=mask_hos)
-        # sigma_clip
-        nsigma = 2.5
-        data_hos_ma = sigma_clip (data_hos_ma, axis=0, cenfunc='mean',
-                                  sigma=nsigma)
-        # number of rows in each column, used below
-        # to estimate the error in the mean
-        nvalues_col = np.sum(~data_hos_ma.mask, axis=0)
-        # clipped mean and std
-        mean_hos = np.nanmean(data_hos_ma, axis=0)
-        std_hos = np.nanstd(data_hos_ma, axis=0, ddof=1)
-        # mask of columns with more than 1 valid value after
-        # clipping
-        mask_valid = (nvalues_col > 1)
-
-
-        # spline fit errors
-        xcol = np.arange(len(mean_hos)) + 1
-        err_hos = np.zeros_like(mean_hos)
-        err_hos[mask_valid] = (std_hos[mask_valid] /
-                               np.sqrt(nvalues_col[mask_valid]))
-
-        # weights
-        weights = np.zeros_like(err_hos)
-        mask_nonzero = (err_hos != 0)
-        weights[mask_nonzero] = 1/err_hos[mask_nonzero]
-        # do not fit spline for first three columns if all of them are
-        # valid
-        if np.all(mask_valid[0:3]):
-            weights[0:3] = 0
-
-
-        # index up to which spline is used, and afterwards the
-        # polynomial fit
-        idx_switch = 150
-        overlap = 30
-
-        # perform spline fit
-        idx_fit = np.arange(idx_switch + overlap)
-        npoints = np.sum(mask_valid[idx_fit] & mask_nonzero[idx_fit])
-
-        # this make_splrep() is giving occasional issues, despite this
-        # method being recommended over the UnivariateSpline method
-        # below; for the moment use the latter
-        #
-        #fit = interpolate.make_splrep(xcol[idx_fit][mask_valid[idx_fit]],
-        #                              mean_hos[idx_fit][mask_valid[idx_fit]],
-        #                              w=weights[idx_fit][mask_valid[idx_fit]],
-        #                              k=2, s=npoints)
-        try:
-            m = mask_valid
-
-            # to avoid spline fitting single high points, median
-            # smooth the points to be fit
-            mean_hos_2fit = mean_hos[idx_fit][m[idx_fit]]
-            dpix = 1
-            nfit = len(mean_hos_2fit)
-            mean_hos_2fit[3:] = [np.ma.median(mean_hos_2fit[max(k-dpix,3):
-                                                            min(k+dpix+1,nfit)])
-                                 for k in range(3,nfit)]
-
-            splfit = interpolate.UnivariateSpline(xcol[idx_fit][m[idx_fit]],
-                                                  mean_hos_2fit,
-                                                  #mean_hos[idx_fit][m[idx_fit]],
-                                                  w=weights[idx_fit][m[idx_fit]],
-                                                  k=2, s=npoints)
-        except UserWarning as uw:
-            log.warning ('problem with fitting spline to channel {} overscan'
-                         '; trying again with k=3 and 50% higher smoothing '
-                         'parameter s; warning: {})'.format(i_chan+1, uw))
-            splfit = interpolate.UnivariateSpline(xcol[idx_fit][m[idx_fit]],
-                                                  mean_hos_2fit,
-                                                  #mean_hos[idx_fit][m[idx_fit]],
-                                                  w=weights[idx_fit][m[idx_fit]],
-                                                  k=3, s=1.5*npoints)
-
-
-
-        # lowish order polynomial fit for data beyond idx_switch
-        mask_valid_poly = mask_valid.copy()
-        mask_valid_poly[0:idx_switch-overlap] = False
-
-        # clean from high/low values
-        nsigma = 5
-        mean_hos_poly = mean_hos[mask_valid_poly]
-        mean, median, stddev = sigma_clipped_stats(
-            mean_hos_poly, sigma=nsigma, cenfunc='mean')
-        if stddev==0:
-            mask_fit_tmp = np.ones(len(mean_hos_poly), dtype=bool)
-        else:
-            mask_fit_tmp = (np.abs(mean_hos_poly-mean)/stddev <= nsigma)
+    return data_out
 
-        mask_valid_poly[mask_valid_poly] = mask_fit_tmp
 
+################################################################################
 
-        if not (tel=='BG2' and i_chan==8):
+def fit_hos (mean_hos, std_hos, nvalues_col, mask_sat_row, i_chan, tel):
 
-            for it in range(3):
-                p = np.polyfit(xcol[mask_valid_poly],
-                               mean_hos[mask_valid_poly], 7)
-                fit_poly = np.polyval(p, xcol)
-                # reject data
-                #log.info ('it: {}, np.sum(mask_valid_poly): {}'
-                #          .format(it, np.sum(mask_valid_poly)))
-                mask_valid_poly &= (np.abs(fit_poly - mean_hos) <= 3*err_hos)
+    """Function used in [os_corr] to fit the sigma-clipped mean
+       [mean_hos], standard deviation [std_hos] and number of valid
+       values [nvalues_col] of the columns of the horizontal overscan
+       of channel [i_chan] (zero-based), with a spline fit up to
+       column 150 and a polynomial fit beyond that; [mask_sat_row]
+       indicates the columns affected by saturated stars (BlackGEM
+       only, otherwise None). Returns the overscan to be subtracted
+       from each row of the channel data section.
 
+    """
 
-            # overscan array to be subtracted
-            oscan = fit_poly
+    # mask of columns with more than 1 valid value after
+    # clipping
+    mask_valid = (nvalues_col > 1)
 
-        else:
 
-            # for channel 9 of BG2, need to split polynomial fit into
-            # two pieces, separated at column x=654
-            idx_split = 654
+    # spline fit errors
+    xcol = np.arange(len(mean_hos)) + 1
+    err_hos = np.zeros_like(mean_hos)
+    err_hos[mask_valid] = (std_hos[mask_valid] /
+                           np.sqrt(nvalues_col[mask_valid]))
 
-            mask_fit = mask_valid_poly.copy()
-            mask_fit[idx_split:] = False
-            for it in range(3):
-                p = np.polyfit(xcol[mask_fit], mean_hos[mask_fit], 5)
-                fit1_poly = np.polyval(p, xcol)
-                # reject data
-                #log.info ('it: {}, np.sum(mask_fit) 1: {}'
-                #          .format(it, np.sum(mask_fit)))
-                mask_fit &= (np.abs(fit1_poly - mean_hos) <= 3*err_hos)
+    # weights
+    weights = np.zeros_like(err_hos)
+    mask_nonzero = (err_hos != 0)
+    weights[mask_nonzero] = 1/err_hos[mask_nonzero]
+    # do not fit spline for first three columns if all of them are
+    # valid
+    if np.all(mask_valid[0:3]):
+        weights[0:3] = 0
 
 
-            mask_fit = mask_valid_poly.copy()
-            mask_fit[:idx_split] = False
-            for it in range(3):
-                p = np.polyfit(xcol[mask_fit], mean_hos[mask_fit], 5)
-                fit2_poly = np.polyval(p, xcol)
-                # reject data
-                #log.info ('it: {}, np.sum(mask_fit) 2: {}'
-                #          .format(it, np.sum(mask_fit)))
-                mask_fit &= (np.abs(fit2_poly - mean_hos) <= 3*err_hos)
+    # index up to which spline is used, and afterwards the
+    # polynomial fit
+    idx_switch = 150
+    overlap = 30
 
+    # perform spline fit
+    idx_fit = np.arange(idx_switch + overlap)
+    npoints = np.sum(mask_valid[idx_fit] & mask_nonzero[idx_fit])
 
-            # overscan array to be subtracted
-            oscan = fit1_poly
-            oscan[idx_split:] = fit2_poly[idx_split:]
+    # this make_splrep() is giving occasional issues, despite this
+    # method being recommended over the UnivariateSpline method
+    # below; for the moment use the latter
+    #
+    #fit = interpolate.make_splrep(xcol[idx_fit][mask_valid[idx_fit]],
+    #                              mean_hos[idx_fit][mask_valid[idx_fit]],
+    #                              w=weights[idx_fit][mask_valid[idx_fit]],
+    #                              k=2, s=npoints)
+    try:
+        m = mask_valid
+
+        # to avoid spline fitting single high points, median
+        # smooth the points to be fit
+        mean_hos_2fit = mean_hos[idx_fit][m[idx_fit]]
+        dpix = 1
+        nfit = len(mean_hos_2fit)
+        mean_hos_2fit[3:] = [np.ma.median(mean_hos_2fit[max(k-dpix,3):
+                                                        min(k+dpix+1,nfit)])
+                             for k in range(3,nfit)]
+
+        splfit = interpolate.UnivariateSpline(xcol[idx_fit][m[idx_fit]],
+                                              mean_hos_2fit,
+                                              #mean_hos[idx_fit][m[idx_fit]],
+                                              w=weights[idx_fit][m[idx_fit]],
+                                              k=2, s=npoints)
+    except UserWarning as uw:
+        log.warning ('problem with fitting spline to channel {} overscan'
+                     '; trying again with k=3 and 50% higher smoothing '
+                     'parameter s; warning: {})'.format(i_chan+1, uw))
+        splfit = interpolate.UnivariateSpline(xcol[idx_fit][m[idx_fit]],
+                                              mean_hos_2fit,
+                                              #mean_hos[idx_fit][m[idx_fit]],
+                                              w=weights[idx_fit][m[idx_fit]],
+                                              k=3, s=1.5*npoints)
+
+
+
+    # lowish order polynomial fit for data beyond idx_switch
+    mask_valid_poly = mask_valid.copy()
+    mask_valid_poly[0:idx_switch-overlap] = False
+
+    # clean from high/low values
+    nsigma = 5
+    mean_hos_poly = mean_hos[mask_valid_poly]
+    mean, median, stddev = sigma_clipped_stats(
+        mean_hos_poly, sigma=nsigma, cenfunc='mean')
+    if stddev==0:
+        mask_fit_tmp = np.ones(len(mean_hos_poly), dtype=bool)
+    else:
+        mask_fit_tmp = (np.abs(mean_hos_poly-mean)/stddev <= nsigma)
 
+    mask_valid_poly[mask_valid_poly] = mask_fit_tmp
 
 
+    if not (tel=='BG2' and i_chan==8):
 
-        # replace columns up to idx_switch with spline fit
-        oscan[0:idx_switch] = splfit(xcol[0:idx_switch])
-        # for first couple of columns, adopt mean if valid
-        oscan[0:3][mask_valid[0:3]] = mean_hos[0:3][mask_valid[0:3]]
+        for it in range(3):
+            p = np.polyfit(xcol[mask_valid_poly],
+                           mean_hos[mask_valid_poly], 7)
+            fit_poly = np.polyval(p, xcol)
+            # reject data
+            #log.info ('it: {}, np.sum(mask_valid_poly): {}'
+            #          .format(it, np.sum(mask_valid_poly)))
+            mask_valid_poly &= (np.abs(fit_poly - mean_hos) <= 3*err_hos)
 
 
-        # use original subtraction of column-by-column for "spline"
-        # columns with no/few saturated pixels, defined in
-        # mask_sat_row already determined above; make sure there are
-        # sufficient values in the overscan column through mask_valid
-        #mask_usemean = ~mask_sat_row & mask_valid
-        mask_usemean = mask_valid
-        # mask_sat_row is only available for BG telescopes
-        if tel[0:2] == 'BG':
-            mask_usemean &= ~mask_sat_row
+        # overscan array to be subtracted
+        oscan = fit_poly
 
+    else:
 
-        # only for column up to idx_switch
-        mask_usemean[idx_switch:] = False
-        #oscan_alt = oscan.copy()
-        oscan[mask_usemean] = mean_hos[mask_usemean]
+        # for channel 9 of BG2, need to split polynomial fit into
+        # two pieces, separated at column x=654
+        idx_split = 654
 
+        mask_fit = mask_valid_poly.copy()
+        mask_fit[idx_split:] = False
+        for it in range(3):
+            p = np.polyfit(xcol[mask_fit], mean_hos[mask_fit], 5)
+            fit1_poly = np.polyval(p, xcol)
+            # reject data
+            #log.info ('it: {}, np.sum(mask_fit) 1: {}'
+            #          .format(it, np.sum(mask_fit)))
+            mask_fit &= (np.abs(fit1_poly - mean_hos) <= 3*err_hos)
 
-        if False:
 
-            #if tel=='BG2' and i_chan==8:
-            #    for i in range(idx_split-10,idx_split+10):
-            #        log.info ('i: {}, oscan[i]: {}, oscan_alt[i]: {}'
-            #                  .format(i, oscan[i], oscan_alt[i]))
-
-
-            plt.errorbar (xcol, mean_hos, yerr=err_hos, color='k',
-                          linestyle="None", capsize=2)
-            plt.plot (xcol, mean_hos, 'k.', label='mean_hos')
-            plt.plot (xcol, oscan_alt, '-', color='purple', label='overscan alt')
-            plt.plot (xcol, oscan, 'g-', label='overscan used')
-            plt.plot (xcol[:idx_switch], splfit(xcol[:idx_switch]), 'b-',
-                      label='spline fit')
-            plt.ylim (max(-50, np.amin(mean_hos)), abs(1.2*np.amax(oscan+10)))
-            plt.title('channel: {}'.format(i_chan+1))
-            plt.legend()
-            plt.savefig('hos_chan{:02}.pdf'.format(i_chan+1))
-            plt.xlim (0,idx_switch+30)
-            plt.savefig('hos_chan{:02}_zoom.pdf'.format(i_chan+1))
-            plt.close()
+        mask_fit = mask_valid_poly.copy()
+        mask_fit[:idx_split] = False
+        for it in range(3):
+            p = np.polyfit(xcol[mask_fit], mean_hos[mask_fit], 5)
+            fit2_poly = np.polyval(p, xcol)
+            # reject data
+            #log.info ('it: {}, np.sum(mask_fit) 2: {}'
+            #          .format(it, np.sum(mask_fit)))
+            mask_fit &= (np.abs(fit2_poly - mean_hos) <= 3*err_hos)
 
 
+        # overscan array to be subtracted
+        oscan = fit1_poly
+        oscan[idx_split:] = fit2_poly[idx_split:]
 
 
-        # finally, subtract horizontal overscan from data section
-        data[data_sec[i_chan]] -= oscan
 
-        # place into [data_out]
-        data_out[data_sec_red[i_chan]] = data[data_sec[i_chan]]
 
+    # replace columns up to idx_switch with spline fit
+    oscan[0:idx_switch] = splfit(xcol[0:idx_switch])
+    # for first couple of columns, adopt mean if valid
+    oscan[0:3][mask_valid[0:3]] = mean_hos[0:3][mask_valid[0:3]]
 
 
-    # add headers outside above loop to make header more readable
-    for i_chan in range(nchans):
-        header['BIASM{}'.format(i_chan+1)] = (
-            mean_vos[i_chan], '[e-] channel {} mean vertical overscan'
-            .format(i_chan+1))
+    # use original subtraction of column-by-column for "spline"
+    # columns with no/few saturated pixels, defined in
+    # mask_sat_row already determined above; make sure there are
+    # sufficient values in the overscan column through mask_valid
+    #mask_usemean = ~mask_sat_row & mask_valid
+    mask_usemean = mask_valid
+    # mask_sat_row is only available for BG telescopes
+    if tel[0:2] == 'BG':
+        mask_usemean &= ~mask_sat_row
 
-    for i_chan in range(nchans):
-        header['RDN{}'.format(i_chan+1)] = (
-            std_vos[i_chan], '[e-] channel {} sigma (STD) vertical overscan'
-            .format(i_chan+1))
 
+    # only for column up to idx_switch
+    mask_usemean[idx_switch:] = False
+    #oscan_alt = oscan.copy()
+    oscan[mask_usemean] = mean_hos[mask_usemean]
 
-    # write the average of both the means and standard deviations
-    # determined for each channel to the header
-    header['BIASMEAN'] = (np.nanmean(mean_vos), '[e-] average all channel means '
-                          'vert. overscan')
-    header['RDNOISE'] = (np.nanmean(std_vos), '[e-] average all channel sigmas '
-                         'vert. overscan')
 
+    if False:
 
-    # reset warnings
-    warnings.resetwarnings()
+        #if tel=='BG2' and i_chan==8:
+        #    for i in range(idx_split-10,idx_split+10):
+        #        log.info ('i: {}, oscan[i]: {}, oscan_alt[i]: {}'
+        #                  .format(i, oscan[i], oscan_alt[i]))
 
 
-    if get_par(set_zogy.timing,tel):
-        log_timing_memory (t0=t, label='in os_corr')
+        plt.errorbar (xcol, mean_hos, yerr=err_hos, color='k',
+                      linestyle="None", capsize=2)
+        plt.plot (xcol, mean_hos, 'k.', label='mean_hos')
+        plt.plot (xcol, oscan_alt, '-', color='purple', label='overscan alt')
+        plt.plot (xcol, oscan, 'g-', label='overscan used')
+        plt.plot (xcol[:idx_switch], splfit(xcol[:idx_switch]), 'b-',
+                  label='spline fit')
+        plt.ylim (max(-50, np.amin(mean_hos)), abs(1.2*np.amax(oscan+10)))
+        plt.title('channel: {}'.format(i_chan+1))
+        plt.legend()
+        plt.savefig('hos_chan{:02}.pdf'.format(i_chan+1))
+        plt.xlim (0,idx_switch+30)
+        plt.savefig('hos_chan{:02}_zoom.pdf'.format(i_chan+1))
+        plt.close()
 
 
-    return data_out
+
+    return oscan
 
 
 ################################################################################
@@ -7145,7 +9443,18 @@ def os_corr_orig (data, header, imgtype, xbin=1, ybin=1, data_limit=2000,
 
 ################################################################################
 
-def xtalk_corr (data, crosstalk_file, data_mask=None):
+def xtalk_corr (data, crosstalk_file, data_mask=None, nrows_block=256,
+                nthreads=1):
+
+    """Function to correct [data] in place for the crosstalk between
+       the channels, using the coefficients in [crosstalk_file]. The
+       image is processed in float32 in blocks of [nrows_block] rows
+       of the bottom channels together with the mirrored rows of the
+       top channels, which are independent of the other blocks and
+       are processed using a pool of [nthreads] threads. Only the
+       non-zero source-victim coefficients are applied.
+
+    """
 
     if get_par(set_zogy.timing,tel):
         t = time.time()
@@ -7155,11 +9464,6 @@ def xtalk_corr (data, crosstalk_file, data_mask=None):
         log.info ('crosstalk file: {}'.format(crosstalk_file))
 
 
-    # should data_mask not be provided, create a zero mask
-    if data_mask is None:
-        data_mask = np.zeros(data.shape, dtype=bool)
-
-
     # read file with corrections
     #table = Table.read(crosstalk_file, format='ascii',
     #                   names=['victim', 'source', 'correction'])
@@ -7183,21 +9487,6 @@ def xtalk_corr (data, crosstalk_file, data_mask=None):
     val_cosmic = mask_value['cosmic ray']
     val_edge = mask_value['edge']
 
-    # use positive fluxes and pixels not affected by bad pixels or
-    # cosmics in source channel
-    mask_source = ((data > 0) &
-                   (data_mask & val_bad == 0) &
-                   (data_mask & val_cosmic == 0))
-
-
-    # avoid pixels that land in edge region in victim channel
-    mask_victim = (data_mask & val_edge == 0)
-
-
-    # use matrix multiplication with np.matmul; it is much faster
-    # (~3s) than looping through the input file and correcting for
-    # each source-victim combination separately (~25s) as done before
-
 
     # create 16x16 matrix with correction coefficients, with source
     # indices along axis=0 and victim indices along axis=1; could have
@@ -7208,56 +9497,89 @@ def xtalk_corr (data, crosstalk_file, data_mask=None):
         coeffs[source[k], victim[k]] = correction[k]
 
 
+    # for each victim channel, list of (source channel, coefficient)
+    # of the non-zero coefficients only
+    coeffs_victim = [[(i_source, np.float32(coeffs[i_source, i_victim]))
+                      for i_source in range(nchans)
+                      if coeffs[i_source, i_victim] != 0]
+                     for i_victim in range(nchans)]
 
-    # data_stack with shape (5280,1320,16) so it can be used in
-    # np.matmul, taking into account mask_source
-    data_stack = np.stack([data[chan_sec[i]] * mask_source[chan_sec[i]]
-                           for i in range(nchans)], axis=2)
-    # same but with channels flipped in y
-    data_stack_flip = np.stack([np.flipud(data[chan_sec[i]] *
-                                          mask_source[chan_sec[i]])
-                                for i in range(nchans)], axis=2)
 
+    # channels 0-7 are in the bottom row and channels 8-15 in the top
+    # row, where the latter are flipped in y with respect to the
+    # former; rows [y1:y2] of the bottom channels are therefore
+    # affected by rows [y1:y2] of the other bottom channels and by
+    # rows [ysize_chan-y2:ysize_chan-y1] of the top channels, flipped
+    # in y, and vice versa
+    ysize_chan = chan_sec[0][0].stop - chan_sec[0][0].start
+    row_chans = [i_chan // 8 for i_chan in range(nchans)]
 
-    # initialize data_corr_chans with shape (16,5280,1320), which will
-    # contain the corrections to be subtracted from the input data
-    ysize_chan = get_par(set_bb.ysize_chan,tel)
-    xsize_chan = get_par(set_bb.xsize_chan,tel)
-    data_corr_chans = np.zeros((nchans, ysize_chan, xsize_chan))
 
+    def xtalk_block (y1):
 
-    # calculate matmul for the 4 quadrants of the 16x16 matrix
-    # separately, because of flipping of data in the non-diagonal
-    # quadrants
-    s1 = slice(0,8)
-    s2 = slice(8,16)
+        y2 = min(y1+nrows_block, ysize_chan)
 
-    # source and victim slices corresponding to quandrants
-    # [q=0 q=2]
-    # [q=1 q=3]
-    sls = [s1, s2, s1, s2]
-    slv = [s1, s1, s2, s2]
+        # block sections of the different channels
+        block_sec = []
+        for i_chan in range(nchans):
+            ysec, xsec = chan_sec[i_chan]
+            if row_chans[i_chan] == 0:
+                ya, yb = ysec.start+y1, ysec.start+y2
+            else:
+                ya, yb = ysec.stop-y2, ysec.stop-y1
 
-    # loop quandrants
-    for q in range(4):
+            block_sec.append((slice(ya,yb), xsec))
 
-        # use (flipped) data stack for (non-) diagonal quandrants
-        if q in [0,3]:
-            data_use = data_stack
-        else:
-            data_use = data_stack_flip
 
-        # apply matmul; the swapaxes commands are to arrange the axes
-        # and shape from the output of np.matmul to the expected ones
-        data_corr_chans[slv[q]] += (np.matmul(data_use[:,:,sls[q]],
-                                              coeffs[sls[q],slv[q]])
-                                    .swapaxes(0,2).swapaxes(1,2))
+        # source data: use positive fluxes and pixels not affected by
+        # bad pixels or cosmics
+        data_source = []
+        for i_chan in range(nchans):
+            data_block = data[block_sec[i_chan]].astype('float32', copy=True)
+            mask_source = (data_block > 0)
+            if data_mask is not None:
+                mask_block = data_mask[block_sec[i_chan]]
+                mask_source &= ((mask_block & val_bad == 0) &
+                                (mask_block & val_cosmic == 0))
+
+            data_block[~mask_source] = 0
+            data_source.append(data_block)
+
+
+        # corrections of all victim channels are determined before
+        # any of them are applied
+        data_corr = []
+        for i_victim in range(nchans):
+
+            if len(coeffs_victim[i_victim]) == 0:
+                data_corr.append(None)
+                continue
+
+            corr = np.zeros(data_source[i_victim].shape, dtype='float32')
+            for i_source, coeff in coeffs_victim[i_victim]:
+                if row_chans[i_source] == row_chans[i_victim]:
+                    corr += coeff * data_source[i_source]
+                else:
+                    corr += coeff * data_source[i_source][::-1]
 
+            data_corr.append(corr)
 
-    # use data_corr_chans to correct original data, taking care of
-    # mask_victim
-    for i in range(nchans):
-        data[chan_sec[i]] -= data_corr_chans[i] * mask_victim[chan_sec[i]]
+
+        # correct the data in place, avoiding pixels that land in the
+        # edge region of the victim channel
+        for i_victim in range(nchans):
+            corr = data_corr[i_victim]
+            if corr is not None:
+                if data_mask is not None:
+                    corr[data_mask[block_sec[i_victim]] & val_edge != 0] = 0
+
+                data[block_sec[i_victim]] -= corr
+
+
+    # loop blocks; numpy releases the GIL during the arithmetic, so
+    # threads are effective
+    y1_list = range(0, ysize_chan, nrows_block)
+    map_threads (xtalk_block, y1_list, nthreads=nthreads)
 
 
 
@@ -7401,14 +9723,47 @@ def xtalk_corr_old (data, crosstalk_file, data_mask=None):
 
 ################################################################################
 
-def nonlin_corr(data, nonlin_corr_file):
+# per-process cache of the non-linearity lookup tables used by
+# [nonlin_corr], with the name of the spline file as key and a list of
+# (counts, correction factor) arrays for the different channels as
+# value
+nonlin_cache = {}
+
+
+def nonlin_corr(data, nonlin_corr_file, lut_min=-1000, lut_max=50000):
+
+    """Function to correct [data] in place for the non-linearity using
+       the channel spline fits in [nonlin_corr_file]. The splines are
+       read once per process and converted to lookup tables sampled
+       every count between [lut_min] and [lut_max], which are
+       linearly interpolated with np.interp.
+
+    """
 
     if get_par(set_zogy.timing,tel):
         t = time.time()
 
-    # read file with list of splinefit objects
-    with open(nonlin_corr_file, 'rb') as f:
-        fit_splines = pickle.load(f)
+
+    if nonlin_corr_file not in nonlin_cache:
+
+        # read file with list of splinefit objects
+        with open(nonlin_corr_file, 'rb') as f:
+            fit_splines = pickle.load(f)
+
+        # spline determines fractional correction:
+        #   splinefit = (data - linear fit) / linear fit
+        # so to correct data to linear fit:
+        #   linear fit = data / (splinefit + 1)
+        #
+        # lookup table of the factor (splinefit + 1) for each channel
+        counts_lut = np.arange(lut_min, lut_max+1, dtype='float64')
+        nonlin_cache[nonlin_corr_file] = [
+            (counts_lut, fit_spline(counts_lut) + 1)
+            for fit_spline in fit_splines]
+
+
+    luts = nonlin_cache[nonlin_corr_file]
+
 
     # spline fit was determined from counts instead of electrons, so
     # need gain and correct channel for channel; could also perform
@@ -7424,21 +9779,15 @@ def nonlin_corr(data, nonlin_corr_file):
     nchans = np.shape(data_sec_red)[0]
     for i_chan in range(nchans):
 
-        # spline determines fractional correction:
-        #   splinefit = (data - linear fit) / linear fit
-        # so to correct data to linear fit:
-        #   linear fit = data / (splinefit + 1)
-
-        # temporary array with channel data in counts
-        data_counts = data[data_sec_red[i_chan]]/gain[i_chan]
+        counts_lut, factor_lut = luts[i_chan]
 
-        # do not correct for data above 50,000 (+bias level)
-        frac_corr = np.ones(data_counts.shape)
-        mask_corr = (data_counts <= 50000)
-        frac_corr[mask_corr] = fit_splines[i_chan](data_counts[mask_corr])
-
-        # correct input data in electrons
-        data[data_sec_red[i_chan]] /= (frac_corr + 1)
+        # correct input data in electrons; counts below [lut_min] are
+        # corrected with the factor at [lut_min]; the spline is not
+        # used for data above [lut_max] (50,000 + bias level), where
+        # frac_corr is 1 as before, i.e. a factor of 2
+        data[data_sec_red[i_chan]] /= np.interp(
+            data[data_sec_red[i_chan]]/gain[i_chan], counts_lut, factor_lut,
+            right=2)
 
 
     if get_par(set_zogy.timing,tel):
@@ -7447,6 +9796,153 @@ def nonlin_corr(data, nonlin_corr_file):
     return data
 
 
+################################################################################
+
+# per-process cache of the channel gains and saturation levels used
+# by [get_chan_pars], with the telescope as key
+chan_pars_cache = {}
+
+
+def get_chan_pars (tel=None):
+
+    """return read-only arrays with the channel gains [e-/ADU] and
+       saturation levels [e-] before bias subtraction, as defined in
+       [set_bb.gain] and [set_bb.satlevel]"""
+
+    if tel not in chan_pars_cache:
+        gain = np.array(get_par(set_bb.gain,tel))
+        satlevel_electrons = np.array(get_par(set_bb.satlevel,tel)) * gain
+        gain.flags.writeable = False
+        satlevel_electrons.flags.writeable = False
+        chan_pars_cache[tel] = (gain, satlevel_electrons)
+
+    return chan_pars_cache[tel]
+
+
+################################################################################
+
+def get_satlevels (header, nchans):
+
+    """Returns array of saturation levels in electrons of the [nchans]
+       channels, using the saturation levels in ADU and gains defined
+       in [set_bb.satlevel] and [set_bb.gain], minus the mean vertical
+       overscan levels BIASM1-BIASM16 recorded in [header]
+
+    """
+
+    # determine saturated pixels for each channel separately
+    biaslevel_chans = np.array([header['BIASM{}'.format(i_chan+1)]
+                                for i_chan in range(nchans)])
+
+    # array of satlevels in e- for different channels
+    __, satlevel_electrons = get_chan_pars (tel=tel)
+    satlevel_chans = satlevel_electrons - biaslevel_chans
+
+    return satlevel_chans
+
+
+################################################################################
+
+def calib_corr (data, data_mbias=None, data_mflat=None, satlevel_chans=None,
+                nrows_block=128, nthreads=1):
+
+    """Function to subtract the master bias [data_mbias] from and divide
+       the master flat [data_mflat] into [data] in place, processing
+       blocks of [nrows_block] rows at a time, using a pool of
+       [nthreads] threads, so that the image is passed through only
+       once and without creating full-size temporary arrays. If the
+       channel saturation levels [satlevel_chans] are provided, the
+       boolean mask of pixels at or above the saturation level after
+       the bias subtraction but before the flat division is
+       determined as well and returned; otherwise None is returned.
+       If an exception is raised, the blocks that were already
+       corrected are restored before it is passed on, so that [data]
+       is not left partly corrected.
+
+    """
+
+    if get_par(set_zogy.timing,tel):
+        t = time.time()
+
+
+    # check the master frames before [data] is modified
+    for data_master in [data_mbias, data_mflat]:
+        if data_master is not None and data_master.shape != data.shape:
+            raise ValueError ('shape of master frame {} is different from '
+                              'that of image {}'.format(data_master.shape,
+                                                        data.shape))
+
+
+    # reduced data channel sections
+    __, __, __, __, data_sec_red = define_sections(np.shape(data), tel=tel)
+
+
+    # initialize saturation mask
+    if satlevel_chans is not None:
+        mask_sat = np.zeros(data.shape, dtype=bool)
+    else:
+        mask_sat = None
+
+
+    # first rows of the blocks that were corrected
+    y1_done = []
+
+
+    def calib_block (y1):
+
+        y2 = min(y1+nrows_block, data.shape[0])
+
+        # correct a copy of the block, which is copied into [data]
+        # at the end, so that a block is either corrected completely
+        # or not at all
+        block = np.array(data[y1:y2])
+
+        if data_mbias is not None:
+            block -= data_mbias[y1:y2]
+
+        if mask_sat is not None:
+            # compare with saturation level of channels that overlap
+            # with this block
+            for i_chan, (ysec, xsec) in enumerate(data_sec_red):
+                ya = max(y1, ysec.start)
+                yb = min(y2, ysec.stop)
+                if yb > ya:
+                    np.greater_equal(block[ya-y1:yb-y1,xsec],
+                                     satlevel_chans[i_chan],
+                                     out=mask_sat[ya:yb,xsec])
+
+        if data_mflat is not None:
+            block /= data_mflat[y1:y2]
+
+        data[y1:y2] = block
+        y1_done.append(y1)
+
+
+    # loop blocks; numpy releases the GIL during the arithmetic, so
+    # threads are effective
+    y1_list = range(0, data.shape[0], nrows_block)
+    try:
+        map_threads (calib_block, y1_list, nthreads=nthreads)
+    except:
+        # undo the correction of the blocks that were corrected; all
+        # threads have finished at this point
+        for y1 in y1_done:
+            y2 = min(y1+nrows_block, data.shape[0])
+            if data_mflat is not None:
+                data[y1:y2] *= data_mflat[y1:y2]
+            if data_mbias is not None:
+                data[y1:y2] += data_mbias[y1:y2]
+
+        raise
+
+
+    if get_par(set_zogy.timing,tel):
+        log_timing_memory (t0=t, label='in calib_corr')
+
+
+    return mask_sat
+
+
 ################################################################################
 
 def gain_corr(data, header, tel=None):
@@ -7629,12 +10125,15 @@ def sort_files(read_path, search_str, recursive=False):
     objects = [] # list of science images
     others = [] # list of other images
 
-    for i, filename in enumerate(all_files): #loop through raw files
 
-        header = read_hdulist(filename, get_data=False, get_header=True,
-                              memmap=None)
+    # read image types from header index of [read_path], which only
+    # reads the headers of files that are new or were modified
+    table_index = header_index (read_path, all_files, tel=tel)
+
 
-        if 'IMAGETYP' not in header:
+    for i, filename in enumerate(all_files): #loop through raw files
+
+        if table_index['IMAGETYP'][i] == '':
             log.info ('keyword IMAGETYP not present in header of image; '
                       'not processing {}'.format(filename))
             # add this file to [others] list, which will not be reduced
@@ -7642,7 +10141,7 @@ def sort_files(read_path, search_str, recursive=False):
 
         else:
 
-            imgtype = header['IMAGETYP'].lower() #get image type
+            imgtype = table_index['IMAGETYP'][i].lower() #get image type
 
             if 'bias' in imgtype: #add bias files to bias list
                 biases.append(filename)
@@ -7659,6 +10158,147 @@ def sort_files(read_path, search_str, recursive=False):
     return biases, darks, flats, objects, others
 
 
+################################################################################
+
+# header keywords recorded in the header index, with their data types
+hdrindex_keys = {'IMAGETYP': str, 'FILTER': str, 'OBJECT': str,
+                 'DATE-OBS': str, 'EXPTIME': float}
+
+
+def header_index (read_path, filenames, tel=None, nthreads=8):
+
+    """Function to return a table with columns FILENAME, SIZE,
+       MTIME and the header keywords [hdrindex_keys] of the files in
+       [filenames], which are located in folder [read_path]; the rows
+       are in the same order as [filenames]. The table is saved as the
+       header index of [read_path] in the local folder
+       set_bb.index_dir, so that on subsequent calls only the headers
+       of files that are new or have a different size or modification
+       time are read, using [nthreads] threads in parallel. A
+       keyword missing from a header is recorded as an empty string,
+       or NaN for EXPTIME. Compatible with Google Cloud buckets.
+
+    """
+
+    if get_par(set_zogy.timing,tel):
+        t = time.time()
+
+
+    # name of header index file
+    index_dir = get_par(set_bb.index_dir,tel)
+    fits_index = '{}/{}_hdrindex.fits'.format(
+        index_dir, read_path.split('://')[-1].strip('/').replace('/','_'))
+
+
+    # sizes and modification times of the files
+    stats = get_file_stats (read_path, filenames)
+
+
+    # read existing index into dictionary with filename as key
+    colnames = ['FILENAME', 'SIZE', 'MTIME'] + list(hdrindex_keys.keys())
+    dtypes = [str, 'i8', 'f8'] + list(hdrindex_keys.values())
+    index = read_table_dict (fits_index)
+
+
+    # files that are not in the index or have been modified
+    files2read = [f for f in filenames
+                  if f not in index or (index[f][2], index[f][1]) != stats[f]]
+    log.info ('reading {} headers for header index {}'
+              .format(len(files2read), fits_index))
+
+
+    def read_row (filename):
+        try:
+            header = read_hdulist(filename, get_data=False, get_header=True,
+                                  memmap=None)
+        except Exception as e:
+            log.warning ('exception was raised while reading header of {}: {}'
+                         .format(filename, e))
+            return None
+
+        mtime, size = stats[filename]
+        row = [filename, size, mtime]
+        for key, dtype in hdrindex_keys.items():
+            try:
+                row.append(dtype(header[key]))
+            except:
+                if dtype is str:
+                    row.append('')
+                else:
+                    row.append(np.nan)
+
+        return row
+
+
+    if len(files2read) > 0:
+
+        rows = map_threads (read_row, files2read, nthreads=nthreads)
+
+        # update index with headers that were read successfully
+        rows_new = {filename: row for filename, row in zip(files2read, rows)
+                    if row is not None}
+        index.update(rows_new)
+
+        # save index; the index is re-read under the lock, so that
+        # rows added by another process in the meantime are kept
+        try:
+            index = locked_table_update (
+                fits_index, lambda index_saved: index_saved.update(rows_new),
+                colnames, dtypes)
+        except Exception as e:
+            log.warning ('exception was raised while saving header index {}: {}'
+                         .format(fits_index, e))
+
+
+    # table to return; files that could not be read are included
+    # with empty values
+    rows = []
+    for filename in filenames:
+        if filename in index:
+            rows.append(index[filename])
+        else:
+            rows.append([filename, -1, np.nan] +
+                        ['' if dtype is str else np.nan
+                         for dtype in hdrindex_keys.values()])
+
+    if len(rows) > 0:
+        table = Table(rows=rows, names=colnames, dtype=dtypes)
+    else:
+        table = Table(names=colnames, dtype=dtypes)
+
+
+    if get_par(set_zogy.timing,tel):
+        log_timing_memory (t0=t, label='in header_index')
+
+
+    return table
+
+
+################################################################################
+
+def get_file_stats (path, filenames):
+
+    """return dictionary with the tuple (modification time, size)
+       of each file in [filenames], which are located in [path]; for
+       a google cloud bucket, the sizes and times are obtained by
+       listing [path] instead of querying each file separately"""
+
+    if path[0:5] == 'gs://':
+
+        bucket_name, bucket_path = get_bucket_name (path)
+        blobs = storage.Client().list_blobs(bucket_name, prefix=bucket_path)
+        stats_path = {'gs://{}/{}'.format(bucket_name, blob.name):
+                      (blob.updated.timestamp(), blob.size) for blob in blobs}
+        stats = {f: stats_path.get(f, (None, None)) for f in filenames}
+
+    else:
+
+        stats = {f: get_file_stat(f) for f in filenames}
+
+
+    return stats
+
+
 ################################################################################
 
 def write_fits (fits_out, data, header, overwrite=True, run_fpack=True,
@@ -7672,6 +10312,12 @@ def write_fits (fits_out, data, header, overwrite=True, run_fpack=True,
     header['DATEFILE'] = (Time.now().isot, 'UTC date of writing file')
 
 
+    # make BITPIX in [header] consistent with [data], as it may still
+    # be that of the raw image, while [write_fpack] uses it to decide
+    # whether the image is compressed losslessly
+    header['BITPIX'] = fits.PrimaryHDU(data=data).header['BITPIX']
+
+
     # dealing with google cloud bucket?
     google_cloud = (fits_out[0:5] == 'gs://')
 
@@ -7682,16 +10328,27 @@ def write_fits (fits_out, data, header, overwrite=True, run_fpack=True,
         # make dir for output file if it doesn't exist yet
         make_dir (os.path.dirname(fits_out))
 
-        # write fits directly to the output [fits_out]
-        fits.writeto(fits_out, data, header, overwrite=overwrite)
+        # write fits directly to the output [fits_out]; if it needs
+        # to be fpacked, it is written compressed straight away
+        if (run_fpack and fits_packable (fits_out, data) and
+            try_write_fpack ('{}.fz'.format(fits_out), data, header,
+                             overwrite=overwrite)):
+            # remove any uncompressed version of the same file
+            if isfile(fits_out):
+                remove_files([fits_out])
 
-        # fpack
-        if run_fpack:
-            fits_out = fpack (fits_out)
+            fits_out = '{}.fz'.format(fits_out)
+
+        else:
+            fits.writeto(fits_out, data, header, overwrite=overwrite)
 
-        # create jpg
+        # create jpg from the data in memory
         if run_create_jpg:
-            file_jpg = create_jpg (fits_out)
+            file_jpg = create_jpg (fits_out, data=data, header=header)
+
+
+        # add calibration file to catalogue
+        calcat_add (fits_out, header, tel=tel)
 
 
         # move the log file
@@ -7730,20 +10387,25 @@ def write_fits (fits_out, data, header, overwrite=True, run_fpack=True,
         # write the tmp fits file
         fits_tmp = '{}/{}'.format(tmp_path, fits_out.split('/')[-1])
         log.info ('writing tmp fits file {}'.format(fits_tmp))
-        fits.writeto(fits_tmp, data, header, overwrite=overwrite)
 
+        # if it needs to be fpacked, it is written compressed straight
+        # away
+        if (run_fpack and fits_packable (fits_tmp, data) and
+            try_write_fpack ('{}.fz'.format(fits_tmp), data, header,
+                             overwrite=overwrite)):
+            fits_tmp = '{}.fz'.format(fits_tmp)
 
-        # fpack
-        if run_fpack:
-            fits_tmp = fpack (fits_tmp)
             # add '.fz' to fits_out, which is returned by function
             if '.fz' not in fits_out:
                 fits_out = '{}.fz'.format(fits_out)
 
+        else:
+            fits.writeto(fits_tmp, data, header, overwrite=overwrite)
+
 
-        # create jpg
+        # create jpg from the data in memory
         if run_create_jpg:
-            file_jpg = create_jpg (fits_tmp)
+            file_jpg = create_jpg (fits_tmp, data=data, header=header)
 
 
         # move fits_tmp to [dest_folder] in bucket
@@ -7751,6 +10413,10 @@ def write_fits (fits_out, data, header, overwrite=True, run_fpack=True,
         copy_file (fits_tmp, dest_folder+'/', move=True)
 
 
+        # add calibration file to catalogue
+        calcat_add (fits_out, header, tel=tel)
+
+
         # move the corresponding jpg file
         if run_create_jpg:
             copy_file (file_jpg, dest_folder+'/', move=True)
@@ -7782,6 +10448,18 @@ def write_fits (fits_out, data, header, overwrite=True, run_fpack=True,
     return fits_out
 
 
+################################################################################
+
+def fits_packable (filename, data):
+
+    """check if [filename] with [data] would be fpacked by [fpack], i.e.
+       whether it is a 2D image with extension .fits that is not an
+       LDAC fits file"""
+
+    return (filename.split('.')[-1] == 'fits' and
+            '_ldac.fits' not in filename and np.ndim(data) == 2)
+
+
 ################################################################################
 
 def copy_flist (filelist, dest, move=False, verbose=True):
@@ -7985,13 +10663,34 @@ def copy_file (src_file, dest, move=False, verbose=True):
 ################################################################################
 
 def add_headkeys (path_full, fits_headers, search_str='', end_str='',
-                  tel=None, nproc=1):
+                  tel=None, nproc=1, nthreads=8):
+
+    """Function to add the headers of the files in [path_full] (and its
+       subfolders) with [search_str] and [end_str] in their names, or
+       of the files listed in the ASCII file [path_full], to the
+       header table [fits_headers]. The modification time and size
+       of each file are recorded in the columns MTIME and SIZE; files
+       already in the table are skipped, unless their current
+       modification time or size differs from that in their row, in
+       which case their rows are replaced. The headers of the files
+       to add are read using [nthreads] threads, or [nproc] processes
+       if [nproc] is larger than 1.
+
+    """
 
     # read [fits_headers]
     log.info ('reading fits table {}'.format(fits_headers))
     table_headers = Table.read(fits_headers, memmap=True)
 
 
+    # add columns MTIME and SIZE if not present yet; they are masked
+    # in the existing rows, so that these files are read again once
+    for colname, dtype in [('MTIME', 'float64'), ('SIZE', 'int64')]:
+        if colname not in table_headers.colnames:
+            table_headers[colname] = np.ma.masked_all(len(table_headers),
+                                                      dtype=dtype)
+
+
     # determine its column names and dtypes
     colnames = table_headers.colnames
     dtypes = [str(table_headers.dtype[n]) for n in colnames]
@@ -8022,18 +10721,46 @@ def add_headkeys (path_full, fits_headers, search_str='', end_str='',
 
 
 
+    # (modification time, size) of the files
+    if isfile (path_full):
+        stats = dict(zip(filenames, map_threads(get_file_stat, filenames,
+                                                nthreads=nthreads)))
+    else:
+        stats = get_file_stats (path_full, filenames)
+
+
+    # files that are already in [fits_headers] are only processed
+    # again if their modification time or size differs from that
+    # recorded in their row; masked values never match
+    stats_table = dict(zip(table_headers['FILENAME'],
+                           zip(np.ma.filled(table_headers['MTIME'], np.nan),
+                               np.ma.filled(table_headers['SIZE'], -1))))
+    files_present = [f for f in filenames if f in stats_table]
+    if len(files_present) > 0:
+
+        files_modified = set([f for f in files_present
+                              if None in stats[f]
+                              or stats[f] != stats_table[f]])
+
+        log.info ('skipping {} files already present in {}'.format(
+            len(files_present)-len(files_modified), fits_headers))
+
+        filenames = [f for f in filenames
+                     if f not in stats_table or f in files_modified]
+
+
+
     log.info ('number of filenames for which to add headers: {}'
               .format(len(filenames)))
 
 
     if len(filenames) > 0:
 
-        # in case of only 1 processor:
+        # in case of only 1 processor, use threads
         if nproc == 1:
-            rows = []
-            for filename in filenames:
-                row = get_head_row (filename, colnames)
-                rows.append(row)
+            rows = map_threads (lambda f: get_head_row(f, colnames,
+                                                       stats[f]),
+                                filenames, nthreads=nthreads)
 
         else:
             # for multiple processors, use pool_func and function
@@ -8044,14 +10771,13 @@ def add_headkeys (path_full, fits_headers, search_str='', end_str='',
         # convert rows to table
         table = Table(rows=rows, names=colnames, masked=True, dtype=dtypes)
 
-        # add table to input table
-        table_headers = vstack([table_headers, table])
-
-        # unique entries, sorted by FILENAME; this works on the entire
-        # table, which is slower than sorting just the table being
-        # added (as was done before), but it allows an entire night to
-        # be added again when some files needed to be re-processed
-        table_headers = unique(table_headers, keys='FILENAME', keep='last')
+        # remove rows of files that are added again and add the new
+        # rows to the end of the input table, rather than sorting
+        # the entire table by FILENAME
+        filenames_set = set(filenames)
+        mask_keep = np.array([f not in filenames_set
+                              for f in table_headers['FILENAME']], dtype=bool)
+        table_headers = vstack([table_headers[mask_keep], table])
 
         # overwrite fits_headers
         if 'gs://' in fits_headers:
@@ -8068,9 +10794,9 @@ def add_headkeys (path_full, fits_headers, search_str='', end_str='',
 
     else:
 
-        log.warning ('no files with path/folder {} (and its subfolders) with '
-                     'search_str {} and end_str {} for which to add header keys'
-                     .format(path_full, search_str, end_str))
+        log.warning ('no new files with path/folder {} (and its subfolders) '
+                     'with search_str {} and end_str {} for which to add '
+                     'header keys'.format(path_full, search_str, end_str))
 
 
     return
@@ -8078,17 +10804,27 @@ def add_headkeys (path_full, fits_headers, search_str='', end_str='',
 
 ################################################################################
 
-def get_head_row (filename, colnames):
+def get_head_row (filename, colnames, stat=None):
 
     log.info ('processing {}'.format(filename))
 
+    # modification time and size of filename, if not provided through
+    # [stat]; determined before reading the header, so that a change
+    # of the file while it is being read is noticed next time
+    if stat is None and ('MTIME' in colnames or 'SIZE' in colnames):
+        stat = get_file_stat (filename)
+
     # read filename header
     header = read_hdulist(filename, get_data=False, get_header=True)
 
     # loop columns to add
     row = []
     for i, colname in enumerate(colnames):
-        if colname in header:
+        if colname == 'MTIME':
+            row += [stat[0]]
+        elif colname == 'SIZE':
+            row += [stat[1]]
+        elif colname in header:
             row += [header[colname]]
         elif colname.lower() == 'filename':
             # add filename with full path
@@ -8098,7 +10834,7 @@ def get_head_row (filename, colnames):
         else:
             row += [np.ma.masked]
 
-        if row[i] == 'None' or row[i] == '':
+        if row[i] is None or row[i] == 'None' or row[i] == '':
             row[i] = np.ma.masked
 
     return row
@@ -8117,13 +10853,16 @@ def unzip(imgname, put_lock=True, timeout=None):
 
     if '.gz' in imgname:
         log.info ('gunzipping {}'.format(imgname))
-        subprocess.run(['gunzip',imgname])
-        imgname = imgname.replace('.gz','')
+        imgname_out = imgname.replace('.gz','')
+        with gzip.open(imgname, 'rb') as f_in, open(imgname_out, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+        os.remove(imgname)
+        imgname = imgname_out
 
     elif '.fz' in imgname:
         log.info ('funpacking {}'.format(imgname))
-        subprocess.run(['funpack', '-D', imgname])
-        imgname = imgname.replace('.fz','')
+        imgname = funpack (imgname)
 
     if put_lock:
         lock.release()
@@ -1346,6 +1346,10 @@ def prep_ref (imagelist, field_ID, filt, radec, image_size, nfiles, limmag_proj,
                     bb.copy_files2keep(tmp_base, ref_base_date,
                                        get_par(set_bb.ref_2keep,tel), move=False)
 
+                    # and replace old reference image in reference index
+                    update_refindex (ref_base_date, header_ref, field_ID, filt,
+                                     files_remove=oldfiles)
+
                 else:
                     log.info ('improvement in limiting magnitude of ref image '
                               'just created (limmag={:.2f}) over existing one '
@@ -1360,6 +1364,10 @@ def prep_ref (imagelist, field_ID, filt, radec, image_size, nfiles, limmag_proj,
                 bb.copy_files2keep(tmp_base, ref_base_date,
                                    get_par(set_bb.ref_2keep,tel), move=False)
 
+                # add reference image to reference index
+                if ref_mode:
+                    update_refindex (ref_base_date, header_ref, field_ID, filt)
+
 
 
     # also build a couple of alternative reference images for
@@ -1420,6 +1428,26 @@ def prep_ref (imagelist, field_ID, filt, radec, image_size, nfiles, limmag_proj,
     return
 
 
+################################################################################
+
+def update_refindex (ref_base, header_ref, field_ID, filt, files_remove=[]):
+
+    """add reference image with base name [ref_base] to the reference
+       index used by [blackbox_reduce] to select the reference image,
+       removing the (old) reference images in [files_remove]"""
+
+    fits_ref = '{}_red.fits.fz'.format(ref_base)
+
+    try:
+        row = bb.refindex_row (fits_ref, header_ref, '{:05d}'.format(field_ID),
+                               filt)
+        bb.refindex_update ([row], files_remove=files_remove, tel=tel)
+
+    except Exception as e:
+        log.exception ('exception was raised while adding {} to reference '
+                       'index: {}'.format(fits_ref, e))
+
+
 ################################################################################
 
 def imcombine_mp (field_ID, imagelist, fits_out, combine_type, filt,